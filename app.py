@@ -1,15 +1,19 @@
+import hashlib
+import hmac
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import os
 from dotenv import load_dotenv
+import threading
 import time
-import random
 
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+# Start of the startup budget reported by create_app()
+IMPORT_STARTED_AT = time.perf_counter()
 
 from flask_session import Session
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session
+from flask import (
+    Blueprint, Flask, Response, g, render_template, request, redirect, url_for, jsonify, session, stream_with_context
+)
 
 from flask_login import (
     LoginManager,
@@ -18,110 +22,331 @@ from flask_login import (
     logout_user,
     current_user
 )
-from models import User
-from database import SessionLocal, init_db
-from utils import compute_user_embedding, deduce_interest_and_relevance
-from vector_db import get_user_vectors, find_similar_users_clustering
+from models import CachedUser, Recommendation, RecommendationRun, User
+from interests import INTEREST_CATALOG, INTEREST_FIELDS, pack_interests
+from database import SessionLocal, announce_population_change, db_session, init_db
+from extraction import extract_interests
+from vector_db import (
+    user_index, similarity_engine, find_similar_users_cosine, configure_ann_index, configure_shards,
+    get_shard_coordinator, start_ann_maintenance,
+    configure_vector_store, find_similar_users_filtered
+)
+from attribute_index import parse_predicates
+from clustering import ClusteringService
+from write_behind import InterestWriteBuffer
+from batch_updates import apply_interest_batch, iter_json_array, iter_ndjson
 
-import numpy as np
 import json
 
-# New imports for Hugging Face API and error handling
-from huggingface_hub import InferenceClient
-from huggingface_hub.utils import HfHubHTTPError
-from functools import lru_cache
+# Text generation; huggingface_hub itself is imported on first use
+from generation import GenerationError, RuleBasedBackend, create_backend, hf_http_errors
+from batching import BatchingBackend
+from circuit_breaker import CircuitBreaker, ResilientBackend, parse_deadlines
+from metrics import (
+    registry as metrics_registry,
+    REQUEST_SECONDS,
+    CHAT_STAGE_SECONDS,
+    RECOMMENDATION_STAGE_SECONDS,
+    RESPONSE_CACHE_REQUESTS,
+    LLM_RETRIES,
+    LLM_FALLBACKS,
+    HF_ERRORS,
+    STARTUP_SECONDS,
+)
+from cache import IdentityCache, ResponseCache, create_cache
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = './.flask_session/'
-app.config['SESSION_PERMANENT'] = False
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=5)
-Session(app)
+# All routes live on this blueprint; create_app() registers it
+bp = Blueprint('main', __name__)
+
+
+# Function to configure where session data is kept
+def configure_session_store(app, backend):
+    """
+    Configure the session store. The session only holds the logged-in user's
+    id (and Flask-Login bookkeeping), so the default is Flask's signed cookie,
+    which needs no server-side storage at all.
+
+    The cookie has to be signed with SECRET_KEY; without one the sessions
+    are kept server-side in SESSION_FILE_DIR instead, as they used to be.
+
+    Args:
+    - app (Flask): The application.
+    - backend (str): 'cookie', 'redis' (shared store with expiry, for
+      several workers or nodes), 'filesystem' (files shared by the workers
+      on one host) or 'memory' (in-process store with expiry, for a single
+      worker).
+    """
+    if backend == 'cookie':
+        if app.config.get('SECRET_KEY'):
+            return
+        logging.warning('SECRET_KEY is not set: keeping sessions on the filesystem instead of in signed cookies')
+        backend = 'filesystem'
+    if backend == 'redis':
+        import redis
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = redis.from_url(os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+    elif backend == 'filesystem':
+        from cachelib import FileSystemCache
+        app.config['SESSION_TYPE'] = 'cachelib'
+        app.config['SESSION_CACHELIB'] = FileSystemCache(
+            os.getenv('SESSION_FILE_DIR', './.flask_session/'),
+            threshold=int(os.getenv('SESSION_FILE_MAXSIZE', '10000')),
+            default_timeout=int(app.config['PERMANENT_SESSION_LIFETIME'].total_seconds())
+        )
+    elif backend == 'memory':
+        from cachelib import SimpleCache
+        app.config['SESSION_TYPE'] = 'cachelib'
+        app.config['SESSION_CACHELIB'] = SimpleCache(
+            threshold=int(os.getenv('SESSION_MEMORY_MAXSIZE', '10000')),
+            default_timeout=int(app.config['PERMANENT_SESSION_LIFETIME'].total_seconds())
+        )
+    else:
+        raise ValueError(f"Unknown session backend: {backend}")
+    # Flask-Session serializes with msgpack, never pickle
+    app.config['SESSION_KEY_PREFIX'] = 'interweave:session:'
+    Session(app)
+
 
 # Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+# Initialize the clustering service, refitted in the background
+cluster_service = ClusteringService(
+    user_index,
+    model_path=os.getenv('CLUSTER_MODEL_PATH', './.cluster_model/kmeans.joblib'),
+    n_clusters=int(os.getenv('CLUSTER_COUNT', 5)),
+    refit_interval=int(os.getenv('CLUSTER_REFIT_INTERVAL', 3600)),
+    refit_after_changes=int(os.getenv('CLUSTER_REFIT_AFTER_CHANGES', 500)),
+)
+user_index.add_listener(cluster_service.record_change)
+
+# Interest updates parsed from chat are journaled and written in batches
+interest_buffer = InterestWriteBuffer(
+    SessionLocal,
+    os.getenv('WRITE_BEHIND_JOURNAL_DIR', './.journal/'),
+    flush_interval=float(os.getenv('WRITE_BEHIND_INTERVAL', 1.0)),
+    max_pending=int(os.getenv('WRITE_BEHIND_MAX_PENDING', 100)),
+    fsync=os.getenv('WRITE_BEHIND_FSYNC', '1') == '1',
+)
 
-# Initialize Hugging Face Inference Client
+# Other workers' committed writes reach this worker's index at most
+# POPULATION_SYNC_INTERVAL seconds later; chat updates still buffered here
+# stay on top of the rows reloaded from the database
+user_index.sync_interval = float(os.getenv('POPULATION_SYNC_INTERVAL', 1.0))
+user_index.pending_overlay = interest_buffer.pending_for
+
+# Map the user index from the shared vector file written by vector_store.py
+if os.getenv('VECTOR_STORE_PATH'):
+    configure_vector_store(
+        os.getenv('VECTOR_STORE_PATH'),
+        check_interval=float(os.getenv('VECTOR_STORE_CHECK_INTERVAL', 5.0)),
+    )
+
+# Use an approximate nearest-neighbour index for cosine ranking if configured
+if os.getenv('ANN_INDEX'):
+    configure_ann_index(
+        os.getenv('ANN_INDEX'),
+        path=os.getenv('ANN_INDEX_PATH'),
+        target_recall=float(os.getenv('ANN_TARGET_RECALL', 0.95)),
+        **({'n_probe': int(os.getenv('ANN_N_PROBE'))} if os.getenv('ANN_N_PROBE') else {})
+    )
+
+# Rank cosine neighbours on shard servers if configured: SHARDS=local:4 starts
+# four shard servers on this host from SHARD_LOCAL_PORT, shared by all workers;
+# SHARDS=host:port,... uses shards started with sharding.py
+if os.getenv('SHARDS'):
+    configure_shards(
+        os.getenv('SHARDS'),
+        authkey=os.getenv('SHARD_AUTHKEY', '').encode('utf-8') or None,
+        timeout=float(os.getenv('SHARD_TIMEOUT_MS', 250)) / 1000,
+        write_timeout=float(os.getenv('SHARD_WRITE_TIMEOUT_MS', 1000)) / 1000,
+        local_port=int(os.getenv('SHARD_LOCAL_PORT', 7101)),
+    )
+
+# Initialize the text generation backends (huggingface, local or rules)
 hf_token = os.getenv('HUGGINGFACE_TOKEN')
-llama_model = "tiiuae/falcon-7b-instruct"
-client = InferenceClient(llama_model, token=hf_token)
+# A model id, or the URL of an inference endpoint (e.g. loadtest.py's fake server)
+llama_model = os.getenv('HF_MODEL', "tiiuae/falcon-7b-instruct")
+
+
+def create_generation_backend(name):
+    backend = create_backend(
+        name,
+        model=llama_model,
+        token=hf_token,
+        timeout=float(os.getenv('HF_TIMEOUT', 30)),
+        model_name=os.getenv('LOCAL_MODEL', 'Qwen/Qwen2.5-0.5B-Instruct'),
+        num_threads=int(os.getenv('LOCAL_NUM_THREADS', 0)) or None,
+    )
+    # Micro-batch concurrent requests (on by default for the local model)
+    if os.getenv('GENERATION_BATCHING', '1' if name == 'local' else '0') == '1':
+        backend = BatchingBackend(
+            backend,
+            max_batch_size=int(os.getenv('GENERATION_MAX_BATCH_SIZE', 8)),
+            max_wait=float(os.getenv('GENERATION_BATCH_WINDOW_MS', 20)) / 1000,
+            # The local model runs one batch at a time anyway; remote endpoints take several
+            max_in_flight=int(os.getenv('GENERATION_MAX_IN_FLIGHT', 1 if name == 'local' else 4)),
+        )
+    return backend
+
+
+# The primary backend sits behind a circuit breaker, so an unhealthy endpoint
+# sends chats straight to the fallback instead of through retries and timeouts
+generation_backend = ResilientBackend(
+    create_generation_backend(os.getenv('GENERATION_BACKEND', 'huggingface')),
+    CircuitBreaker(
+        window_size=int(os.getenv('GENERATION_BREAKER_WINDOW', 50)),
+        min_calls=int(os.getenv('GENERATION_BREAKER_MIN_CALLS', 10)),
+        failure_rate=float(os.getenv('GENERATION_BREAKER_FAILURE_RATE', 0.5)),
+        slow_call_seconds=float(os.getenv('GENERATION_BREAKER_SLOW_CALL_MS', 5000)) / 1000,
+        slow_call_rate=float(os.getenv('GENERATION_BREAKER_SLOW_CALL_RATE', 0.8)),
+        open_seconds=float(os.getenv('GENERATION_BREAKER_OPEN_SECONDS', 30)),
+        half_open_probes=int(os.getenv('GENERATION_BREAKER_PROBES', 2)),
+    ),
+    # e.g. 95: send a second request once the first is slower than p95
+    hedge_percentile=float(os.getenv('GENERATION_HEDGE_PERCENTILE', 0)) or None,
+)
+fallback_backend = create_generation_backend(os.getenv('GENERATION_FALLBACK', 'rules'))
+
+# Time the primary backend gets per conversation state, in seconds, including
+# retries; override with e.g. GENERATION_DEADLINES="start=3,asking_questions=6"
+GENERATION_DEADLINES = {'start': 5.0, 'ready_check': 5.0, 'asking_questions': 10.0, 'end': 5.0}
+GENERATION_DEADLINES.update(parse_deadlines(os.getenv('GENERATION_DEADLINES', '')))
+
+
+# Function to get the absolute deadline for a reply in a conversation state
+def generation_deadline(conversation_state):
+    return time.monotonic() + GENERATION_DEADLINES.get(conversation_state, GENERATION_DEADLINES['end'])
 
 
 # Helper function for retrying API calls
-def retry_api_call(func, max_retries=3, delay=1):
+def retry_api_call(func, max_retries=3, delay=1, deadline=None):
     for i in range(max_retries):
         try:
             return func()
-        except HfHubHTTPError as e:
-            if i == max_retries - 1:
+        except hf_http_errors() as e:
+            # Errors parsed from the response body (e.g. OverloadedError) carry no response object
+            HF_ERRORS.inc(status=getattr(getattr(e, 'response', None), 'status_code', None) or type(e).__name__)
+            # Give up rather than sleep past the deadline
+            if i == max_retries - 1 or (deadline is not None and time.monotonic() + delay * (2 ** i) >= deadline):
                 raise e
-            time.sleep(delay * (2 ** i))  # Exponential backoff
-
-
-# Caching decorator for API calls
-@lru_cache(maxsize=100)
-def cached_text_generation(prompt):
-    return client.text_generation(prompt, max_new_tokens=200)
+            LLM_RETRIES.inc()
+            with CHAT_STAGE_SECONDS.time(stage='retry_wait'):
+                time.sleep(delay * (2 ** i))  # Exponential backoff
+
+
+# Shared, bounded, TTL-aware cache for API calls
+llm_cache = ResponseCache(create_cache(
+    os.getenv('LLM_CACHE_BACKEND', 'memory'),
+    maxsize=int(os.getenv('LLM_CACHE_MAXSIZE', 1000)),
+    ttl=float(os.getenv('LLM_CACHE_TTL', 3600)),
+    path=os.getenv('LLM_CACHE_PATH', './.cache/llm_cache.db'),
+    url=os.getenv('LLM_CACHE_URL'),
+))
+
+# Slim user records for the user loader; per-process by default, set
+# USER_CACHE_BACKEND=redis (or sqlite) to share invalidations across workers
+identity_cache = IdentityCache(create_cache(
+    os.getenv('USER_CACHE_BACKEND', 'memory'),
+    maxsize=int(os.getenv('USER_CACHE_MAXSIZE', 10000)),
+    ttl=float(os.getenv('USER_CACHE_TTL', 300)),
+    path=os.getenv('USER_CACHE_PATH', './.cache/user_cache.db'),
+    url=os.getenv('USER_CACHE_URL'),
+))
+
+# Rendered /connections and /find_similar_users bodies, keyed by user and
+# population version, so entries never need invalidating and just age out
+rendered_cache = create_cache('memory', maxsize=int(os.getenv('RESPONSE_CACHE_MAXSIZE', 10000)))
+# How often to check for a newer recommendations job run, in seconds
+RECOMMENDATION_RUN_POLL = float(os.getenv('RECOMMENDATION_RUN_POLL', 30))
+
+
+# Caching wrapper for API calls
+def cached_text_generation(prompt, deadline=None):
+    def generate():
+        with CHAT_STAGE_SECONDS.time(stage='llm_request'):
+            return generation_backend.generate(prompt, max_new_tokens=200, deadline=deadline)
+    return llm_cache.get_or_generate(prompt, generate)
 
 
 # Fallback method for generating responses
 def fallback_text_generation(prompt):
-    # This is a simple rule-based fallback. You might want to implement a more sophisticated local model.
-    if "greeting" in prompt.lower():
-        return "Hello! I'm here to help create your user profile. Shall we begin?"
-    elif "ready to proceed" in prompt.lower():
-        return "Great! Let's start with your first interest. How much do you enjoy reading on a scale of 1 to 10?"
-    elif "next question" in prompt.lower():
-        interests = ["sports", "music", "cooking", "travel", "movies"]
-        return f"How much do you enjoy {random.choice(interests)} on a scale of 1 to 10?"
-    elif "profile complete" in prompt.lower():
-        return "Your profile is now complete. Is there anything else you'd like to know?"
-    else:
-        return "I understand. Let's move on to the next question."
+    # Uses the configured fallback backend (rules by default, or a local model)
+    LLM_FALLBACKS.inc()
+    try:
+        return fallback_backend.generate(prompt, max_new_tokens=200)
+    except GenerationError as e:
+        logging.error(f"Fallback generation error: {str(e)}")
+        return RuleBasedBackend().generate(prompt)
+
+
+# Record request latency per route when metrics are enabled
+@bp.before_app_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_latency(response):
+    if metrics_registry.enabled and 'request_started_at' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started_at,
+                                route=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+# Prometheus scrape endpoint
+@bp.route('/metrics')
+def metrics():
+    if not metrics_registry.enabled:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Release the request-scoped database session when the request ends
+def remove_db_session(exception=None):
+    db_session.remove()
 
 
 # User loader callback for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    db_session = SessionLocal()
-    user = db_session.query(User).get(int(user_id))
-    db_session.close()
-    return user
+    record = identity_cache.get(user_id)
+    if record is None:
+        row = db_session.query(User.id, User.username, User.email).filter_by(id=int(user_id)).first()
+        if row is None:
+            return None
+        record = CachedUser(row.id, row.username, row.email).to_dict()
+        identity_cache.put(user_id, record)
+    return CachedUser(**record)
 
 
 # Home route redirects to log in or chat
-@app.route('/')
+@bp.route('/')
 def index():
     if current_user.is_authenticated:
-        return redirect(url_for('chat'))
+        return redirect(url_for('main.chat'))
     else:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
 
 # User registration route
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('chat'))
+        return redirect(url_for('main.chat'))
     if request.method == 'POST':
         username = request.form['username']
         email = request.form['email']
         password = request.form['password']
 
-        db_session = SessionLocal()
         # Check if username or email already exists
         if db_session.query(User).filter_by(username=username).first():
-            db_session.close()
             return render_template('register.html', message='Username already exists.')
         if db_session.query(User).filter_by(email=email).first():
-            db_session.close()
             return render_template('register.html', message='Email already registered.')
 
         # Create new user
@@ -129,34 +354,29 @@ def register():
         new_user.set_password(password)
         db_session.add(new_user)
         db_session.commit()
-        db_session.close()
-        return redirect(url_for('login'))
+        announce_population_change([new_user.id])
+        identity_cache.invalidate(new_user.id)
+        user_index.add_user(new_user.id, new_user.username)
+        return redirect(url_for('main.login'))
     else:
         return render_template('register.html')
 
 
 # User login route
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('chat'))
+        return redirect(url_for('main.chat'))
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
 
-        db_session = SessionLocal()
         user = db_session.query(User).filter_by(username=username).first()
-        db_session.close()
 
         if user and user.check_password(password):
+            # Only the user id goes into the session; profile data is read from the database
             login_user(user)
-            # Load user's existing interests and embedding into session
-            user_profile = {
-                'interests': json.loads(user.interests) if user.interests else {},
-                'embedding': np.frombuffer(user.embedding) if user.embedding else None
-            }
-            session['user_profile'] = user_profile
-            return redirect(url_for('chat'))
+            return redirect(url_for('main.chat'))
         else:
             return render_template('login.html', message='Invalid username or password.')
     else:
@@ -164,127 +384,192 @@ def login():
 
 
 # User logout route
-@app.route('/logout', methods=['GET', 'POST'])
+@bp.route('/logout', methods=['GET', 'POST'])
 @login_required
 def logout():
+    # Later requests carrying an old session cookie reload the user from the database
+    identity_cache.invalidate(current_user.id)
     logout_user()
     session.clear()  # Clear the session data
-    return jsonify({"success": True, "redirect": url_for('login')}), 200
+    return jsonify({"success": True, "redirect": url_for('main.login')}), 200
 
 
-@app.route('/profile')
+@bp.route('/profile')
 @login_required
 def profile():
-    return render_template('profile.html', user=current_user)
+    user = db_session.query(User).get(current_user.id)
 
+    # Show chat updates that are still waiting in the write-behind buffer
+    pending = interest_buffer.pending_for(user.id)
+    if pending:
+        db_session.expunge(user)
+        for interest, value in pending.items():
+            setattr(user, interest, value)
+    return render_template('profile.html', user=user, interests=INTEREST_CATALOG)
 
-@app.route('/update_profile', methods=['POST'])
+
+@bp.route('/update_profile', methods=['POST'])
 @login_required
 def update_profile():
     data = request.get_json()
-    db_session = SessionLocal()
-    user = db_session.query(User).get(current_user.id)
 
-    # Map frontend field names to database column names
-    field_mapping = {
-        'sci_fi_movies': 'sci_fi_movies',
-        'cooking': 'cooking',
-        'hiking': 'hiking',
-        'travel': 'travel',
-        'reading': 'reading',
-        'sports': 'sports',
-        'music': 'music',
-        'photography': 'photography',
-        'gardening': 'gardening',
-        'video_games': 'video_games',
-        'board_games': 'board_games',
-        'diy_projects': 'diy_projects',
-        'volunteering': 'volunteering',
-        'movies': 'movies',
-        'podcasts': 'podcasts',
-        'social_media': 'social_media',
-        'pets': 'pets',
-        'workout': 'workout',
-        'meditation': 'meditation',
-        'travel_adventure': 'travel_adventure',
-        'music_instruments': 'music_instruments',
-        'arts_crafts': 'arts_crafts'
-    }
+    # Write buffered chat updates first, so they cannot land after this edit.
+    # Only this worker's buffer is flushed: an update another worker still
+    # holds (at most WRITE_BEHIND_INTERVAL old) can still land afterwards
+    interest_buffer.flush()
+    user = db_session.query(User).get(current_user.id)
 
-    # Update user's interests based on mapping
-    for frontend_field, db_field in field_mapping.items():
-        setattr(user, db_field, data.get(frontend_field))
+    # Update user's interests; frontend field names match the interest registry
+    updated_interests = {field: data.get(field) for field in INTEREST_FIELDS}
+    user.interest_vector = pack_interests(updated_interests)
 
     try:
         db_session.commit()
     except Exception as e:
         print(f"Error committing changes: {e}")
         return jsonify({'status': 'error', 'message': 'Error updating profile'}), 500
+    announce_population_change([current_user.id])
 
-    db_session.close()
+    identity_cache.invalidate(current_user.id)
+    user_index.update_interests(current_user.id, updated_interests)
 
     return jsonify({'status': 'success'})
 
 
+# Keep the caches and the vector index in step with a committed chunk of batch updates
+def apply_committed_updates(updates):
+    for user_id, interests in updates.items():
+        identity_cache.invalidate(user_id)
+        user_index.update_interests(user_id, interests)
+
+
+# Batch interest updates, for one or many users, as a JSON array or NDJSON
+@bp.route('/update_profiles', methods=['POST'])
+def update_profiles():
+    # Import jobs authenticate with BATCH_UPDATE_TOKEN and may update anyone;
+    # logged-in users may only update themselves
+    batch_token = os.getenv('BATCH_UPDATE_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if batch_token and hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {batch_token}".encode('utf-8')):
+        default_user_id = allowed_user_id = None
+    elif current_user.is_authenticated:
+        default_user_id = allowed_user_id = current_user.id
+    else:
+        return login_manager.unauthorized()
+
+    if request.mimetype == 'application/x-ndjson':
+        items = iter_ndjson(request.stream)
+    elif request.mimetype == 'application/json':
+        items = iter_json_array(request.stream)
+    else:
+        return jsonify({'status': 'error', 'message': 'Send application/json or application/x-ndjson'}), 415
+
+    # Write this worker's buffered chat updates first, so they cannot land
+    # after these edits (other workers' buffers are not covered)
+    interest_buffer.flush()
+    results, error = apply_interest_batch(
+        items,
+        SessionLocal,
+        chunk_size=int(os.getenv('BATCH_UPDATE_CHUNK_SIZE', 1000)),
+        default_user_id=default_user_id,
+        allowed_user_id=allowed_user_id,
+        on_commit=apply_committed_updates,
+    )
+
+    applied = sum(1 for result in results if result['status'] == 'ok')
+    body = {
+        'status': 'error' if error else 'success' if applied == len(results) else 'partial',
+        'applied': applied,
+        'failed': len(results) - applied,
+        'results': results,
+    }
+    if error:
+        # Items before the unreadable part have been applied and are reported
+        body['message'] = error
+        return jsonify(body), 400
+    return jsonify(body)
+
+
 # Chat page route
-@app.route('/chat')
+@bp.route('/chat')
 @login_required
 def chat():
     return render_template('chat.html', username=current_user.username)
 
 
-# Modified chat_api route
-@app.route('/chat_api', methods=['POST'])
-@login_required
-def chat_api():
-    data = request.get_json()
-    message = data.get('message')
-    conversation_state = data.get('conversation_state', 'start')
+# Marker separating the user-facing reply from the profile update in asking_questions
+INTERNAL_NOTE_MARKER = 'INTERNAL_NOTE:'
 
-    interest_fields = [
-        'sci_fi_movies', 'cooking', 'hiking', 'travel', 'reading', 'sports',
-        'music', 'photography', 'gardening', 'video_games', 'board_games',
-        'diy_projects', 'volunteering', 'movies', 'podcasts', 'social_media',
-        'pets', 'workout', 'meditation', 'travel_adventure',
-        'music_instruments', 'arts_crafts'
-    ]
 
-    def post_process(response):
-        # Remove any leading/trailing whitespace
-        response = response.strip()
-        # Capitalize the first letter
-        return response[0].upper() + response[1:] if response else ""
+def post_process(response):
+    # Remove any leading/trailing whitespace
+    response = response.strip()
+    # Capitalize the first letter
+    return response[0].upper() + response[1:] if response else ""
 
-    try:
-        if conversation_state == 'start':
-            prompt = """You are an AI assistant helping to create a user profile. Generate a friendly greeting and casually ask if the user is ready to begin talking about their interests. Keep the conversation light, engaging, and casual, as if you're having a relaxed conversation with a friend. Avoid sounding too formal."""
-            reply = post_process(retry_api_call(lambda: cached_text_generation(prompt)))
-            conversation_state = 'ready_check'
 
-        elif conversation_state == 'ready_check':
-            prompt = f"""The user responded '{message}' to your greeting. Now, if they seem ready to proceed, casually ask them about one of their interests from this list: {', '.join(interest_fields)}. Feel free to mix in casual talk like 'By the way,' or 'Just curious,' to make the conversation flow naturally. If the user isn't ready, respond politely and offer to come back later. If you're unsure, ask for clarification, but keep it light and friendly."""
-            response = post_process(retry_api_call(lambda: cached_text_generation(prompt)))
+# Build the LLM prompt for the current conversation state
+def build_chat_prompt(conversation_state, message):
+    interest_fields = INTEREST_FIELDS
 
-            if any(word in response.lower() for word in ["let's begin", "first interest", "tell me about"]):
-                conversation_state = 'asking_questions'
-            elif any(word in response.lower() for word in ["not ready", "come back later", "another time"]):
-                conversation_state = 'end'
+    if conversation_state == 'start':
+        return """You are an AI assistant helping to create a user profile. Generate a friendly greeting and casually ask if the user is ready to begin talking about their interests. Keep the conversation light, engaging, and casual, as if you're having a relaxed conversation with a friend. Avoid sounding too formal."""
 
-            reply = response
+    elif conversation_state == 'ready_check':
+        return f"""The user responded '{message}' to your greeting. Now, if they seem ready to proceed, casually ask them about one of their interests from this list: {', '.join(interest_fields)}. Feel free to mix in casual talk like 'By the way,' or 'Just curious,' to make the conversation flow naturally. If the user isn't ready, respond politely and offer to come back later. If you're unsure, ask for clarification, but keep it light and friendly."""
 
-        elif conversation_state == 'asking_questions':
-            prompt = f"""Based on the user's response '{message}', casually ask them another question about one of their interests from {interest_fields}. For example, if they've already mentioned one, ask how much they enjoy that on a scale of 1-10, or ask them about a new interest that hasn't been discussed. Keep the tone friendly and conversational, as if you're chatting casually. Avoid repeating their message back word-for-word, and be sure to add a touch of casual talk.
+    elif conversation_state == 'asking_questions':
+        return f"""Based on the user's response '{message}', casually ask them another question about one of their interests from {interest_fields}. For example, if they've already mentioned one, ask how much they enjoy that on a scale of 1-10, or ask them about a new interest that hasn't been discussed. Keep the tone friendly and conversational, as if you're chatting casually. Avoid repeating their message back word-for-word, and be sure to add a touch of casual talk.
 
     After generating your response, on a new line, add:
     INTERNAL_NOTE: Interest: [interest_name], Value: [1-10]"""
 
-            response = retry_api_call(lambda: cached_text_generation(prompt))
+    else:
+        return """Wrap up the conversation by informing the user that their profile is complete, but do so in a friendly and conversational tone. Feel free to ask if there's anything else they need help with, and ensure that the conversation stays light and relaxed."""
+
+
+# Record interest updates: journaled for the database, applied to the index right away
+def record_interest_updates(user_id, updates):
+    with CHAT_STAGE_SECONDS.time(stage='interest_enqueue'):
+        for interest, value in updates.items():
+            interest_buffer.record(user_id, interest, value)
+    identity_cache.invalidate(user_id)
+    # Buffered values may not be committed yet, so the index must not reload them from the database later
+    user_index.ensure_loaded()
+    user_index.update_interests(user_id, updates)
+
+
+# Update the profile from interests the user mentions, without waiting on the LLM
+def apply_message_interests(user_id, message):
+    with CHAT_STAGE_SECONDS.time(stage='interest_extract'):
+        extracted = extract_interests(message)
+    if extracted:
+        record_interest_updates(user_id, extracted)
+    return extracted
+
 
-            # Split the response into the user-facing part and the internal note
-            user_response, internal_note = response.split('INTERNAL_NOTE:', 1)
-            user_response = post_process(user_response)
+# Turn a raw LLM response into the reply and next conversation state
+def finish_chat_turn(conversation_state, response, user_id, extracted=()):
+    if conversation_state == 'start':
+        return post_process(response), 'ready_check'
 
-            # Parse the internal note to update user profile
+    elif conversation_state == 'ready_check':
+        response = post_process(response)
+
+        if any(word in response.lower() for word in ["let's begin", "first interest", "tell me about"]):
+            conversation_state = 'asking_questions'
+        elif any(word in response.lower() for word in ["not ready", "come back later", "another time"]):
+            conversation_state = 'end'
+
+        return response, conversation_state
+
+    elif conversation_state == 'asking_questions':
+        # Split the response into the user-facing part and the internal note
+        user_response, _, internal_note = response.partition(INTERNAL_NOTE_MARKER)
+        user_response = post_process(user_response)
+
+        # Parse the internal note to update user profile
+        with CHAT_STAGE_SECONDS.time(stage='internal_note_parse'):
             interest = None
             value = None
             if 'Interest:' in internal_note and 'Value:' in internal_note:
@@ -295,24 +580,39 @@ def chat_api():
                 except ValueError:
                     value = None
 
-            if interest and value is not None and interest in interest_fields:
-                db_session = SessionLocal()
-                user = db_session.query(User).get(current_user.id)
-                setattr(user, interest, value)
-                db_session.commit()
-                db_session.close()
+        # Interests the user rated or expressed a sentiment about in their own
+        # message take precedence over the note; bare mentions do not
+        if interest and value is not None and interest in INTEREST_FIELDS and interest not in extracted:
+            record_interest_updates(user_id, {interest: value})
 
-            if "profile complete" in user_response.lower() or "all interests covered" in user_response.lower():
-                conversation_state = 'end'
+        if "profile complete" in user_response.lower() or "all interests covered" in user_response.lower():
+            conversation_state = 'end'
 
-            reply = user_response
+        return user_response, conversation_state
 
-        else:
-            prompt = """Wrap up the conversation by informing the user that their profile is complete, but do so in a friendly and conversational tone. Feel free to ask if there's anything else they need help with, and ensure that the conversation stays light and relaxed."""
-            reply = post_process(retry_api_call(lambda: cached_text_generation(prompt)))
+    else:
+        return post_process(response), conversation_state
+
+
+# Modified chat_api route
+@bp.route('/chat_api', methods=['POST'])
+@login_required
+def chat_api():
+    data = request.get_json()
+    message = data.get('message')
+    conversation_state = data.get('conversation_state', 'start')
+    extracted = apply_message_interests(current_user.id, message)
+
+    with CHAT_STAGE_SECONDS.time(stage='prompt_build'):
+        prompt = build_chat_prompt(conversation_state, message)
+    deadline = generation_deadline(conversation_state)
+    try:
+        with CHAT_STAGE_SECONDS.time(stage='generation'):
+            response = retry_api_call(lambda: cached_text_generation(prompt, deadline), deadline=deadline)
+        reply, conversation_state = finish_chat_turn(conversation_state, response, current_user.id, extracted)
 
-    except HfHubHTTPError as e:
-        logging.error(f"Hugging Face API error: {str(e)}")
+    except (*hf_http_errors(), GenerationError) as e:
+        logging.error(f"Text generation error: {str(e)}")
         reply = fallback_text_generation(prompt)
 
     return jsonify({
@@ -321,111 +621,313 @@ def chat_api():
     })
 
 
-@app.route('/connections')
-@login_required
-def connections():
-    # Get user vectors and data
-    user_vectors, user_ids, user_data, interest_fields = get_user_vectors()
+# Format a server-sent event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    # Check if there are enough users to perform clustering
-    if len(user_vectors) < 2:
-        # Not enough users to cluster
-        similar_users = []
-    else:
-        # Preprocess the data
-        scaler = StandardScaler()
-        user_vectors_scaled = scaler.fit_transform(user_vectors)
-
-        # Apply K-Means clustering
-        k = 5  # Adjust the number of clusters as needed
-        if len(user_vectors_scaled) < k:
-            k = len(user_vectors_scaled)  # Ensure k is not greater than the number of users
-        kmeans = KMeans(n_clusters=k, random_state=42)
-        kmeans.fit(user_vectors_scaled)
-        cluster_labels = kmeans.labels_
-
-        # Assign users to clusters
-        user_clusters = dict(zip(user_ids, cluster_labels))
-
-        # Find similar users for the current user
-        target_user_id = current_user.id
-        similar_user_ids = find_similar_users_clustering(target_user_id, user_clusters)
-
-        # Get data of similar users
-        similar_users = [
-            {'id': user_id, 'username': user_data[user_id]['username']}
-            for user_id in similar_user_ids
-        ]
 
-    # Render the template with similar users
-    return render_template('connections.html', similar_users=similar_users)
+# Streaming variant of chat_api using server-sent events
+@bp.route('/chat_api/stream', methods=['POST'])
+@login_required
+def chat_api_stream():
+    """
+    Stream the reply token by token as server-sent events.
+
+    'token' events carry the text generated so far in small deltas; the final
+    'done' event carries the post-processed reply and the next conversation
+    state, exactly as /chat_api would return them. In asking_questions the
+    INTERNAL_NOTE is never streamed to the client. The generator holds no
+    worker-blocking sleeps, so it is meant to be served by an async worker
+    class (e.g. gunicorn -k gevent) where each open stream costs a greenlet
+    rather than a thread.
+    """
+    data = request.get_json()
+    message = data.get('message')
+    conversation_state = data.get('conversation_state', 'start')
+    user_id = current_user.id
+    extracted = apply_message_interests(user_id, message)
+
+    prompt = build_chat_prompt(conversation_state, message)
+    hide_note = conversation_state == 'asking_questions'
+    deadline = generation_deadline(conversation_state)
+
+    def generate():
+        cached = llm_cache.get(prompt)
+        tokens = [cached] if cached is not None else None
+        response = ''
+        sent = 0
+        try:
+            if tokens is None:
+                tokens = retry_api_call(lambda: generation_backend.stream(prompt, max_new_tokens=200), deadline=deadline)
+            for token in tokens:
+                response += token
+                visible = response.split(INTERNAL_NOTE_MARKER, 1)[0] if hide_note else response
+                if hide_note and INTERNAL_NOTE_MARKER not in response:
+                    # Hold back a possible partial marker at the end of the text
+                    visible = visible[:max(sent, len(visible) - len(INTERNAL_NOTE_MARKER) + 1)]
+                if len(visible) > sent:
+                    yield sse_event('token', {'text': visible[sent:]})
+                    sent = len(visible)
+            llm_cache.put(prompt, response)
+            reply, next_state = finish_chat_turn(conversation_state, response, user_id, extracted)
+
+        except (*hf_http_errors(), GenerationError) as e:
+            logging.error(f"Text generation error: {str(e)}")
+            reply, next_state = fallback_text_generation(prompt), conversation_state
+
+        yield sse_event('done', {'reply': reply, 'conversation_state': next_state})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Function to read a user's recommendations materialized by recommendations_job.py
+def stored_recommendations(user_id):
+    """
+    Returns the stored neighbours of a user in rank order, or an empty list
+    for users the job has not seen yet.
+    """
+    with RECOMMENDATION_STAGE_SECONDS.time(stage='stored_lookup'):
+        rows = (
+            db_session.query(Recommendation.recommended_user_id, User.username, Recommendation.similarity)
+            .join(User, User.id == Recommendation.recommended_user_id)
+            .filter(Recommendation.user_id == user_id)
+            .order_by(Recommendation.rank)
+            .all()
+        )
+    return [{'id': row[0], 'username': row[1], 'similarity': row[2]} for row in rows]
+
+
+# Function to rank the user's cluster mates on the request path
+def live_recommendations(user_id):
+    # Look up the current user's cluster in the precomputed clustering
+    with RECOMMENDATION_STAGE_SECONDS.time(stage='cluster_lookup'):
+        similar_user_ids = cluster_service.similar_user_ids(user_id)
+
+    # Rank the cluster members by cosine similarity
+    with RECOMMENDATION_STAGE_SECONDS.time(stage='rank'):
+        ranked = similarity_engine.top_k(user_id, top_n=len(similar_user_ids), candidate_ids=similar_user_ids)
+    usernames = user_index.usernames([similar_id for similar_id, _ in ranked])
+
+    return [
+        {'id': similar_id, 'username': usernames[similar_id], 'similarity': similarity}
+        for similar_id, similarity in ranked
+    ]
 
 
-# Route to find similar users
-@app.route('/find_similar_users')
+# Function to read the id and finish time of the latest recommendations job run
+def latest_recommendation_run():
+    run = rendered_cache.get('latest_run')
+    if run is None:
+        row = (
+            db_session.query(RecommendationRun.id, RecommendationRun.finished_at)
+            .filter(RecommendationRun.finished_at.isnot(None))
+            .order_by(RecommendationRun.id.desc())
+            .first()
+        )
+        run = [row[0], row[1]] if row else [0, 0.0]
+        rendered_cache.set('latest_run', run, ttl=RECOMMENDATION_RUN_POLL)
+    return run
+
+
+# Function to stamp everything the recommendation routes read
+def recommendation_version():
+    """
+    Combine the population version this worker's index reflects, the
+    clustering model and the latest job run.
+
+    The index is synced with the shared population change log first, so
+    it holds every write committed up to that version by any worker, and
+    the stamp describes the data the body is rendered from: workers at the
+    same version render the same body. Chat-derived updates this worker
+    applied to its index but has not flushed yet are not in the shared
+    version, so while there are any the stamp also carries the local index
+    version.
+
+    Returns:
+    - stamp (str): The version stamp.
+    - last_modified (datetime): When the newest of those inputs changed.
+    """
+    version = user_index.sync()
+    cluster_service.ensure_ready()
+    local, modified_at = user_index.version_stamp()
+    run_id, run_finished_at = latest_recommendation_run()
+    fitted_at = cluster_service.fitted_at or 0.0
+    stamp = f"{version}.{cluster_service.model_hash}.{run_id}"
+    if interest_buffer.has_pending():
+        stamp = f"{stamp}.{local}"
+    last_modified = max(modified_at, fitted_at, run_finished_at)
+    return stamp, datetime.fromtimestamp(int(last_modified), tz=timezone.utc)
+
+
+# Function to answer a recommendation route conditionally and from the rendered cache
+def conditional_response(render, mimetype, variant=''):
+    """
+    Serve the current user's response with ETag and Last-Modified headers.
+
+    A 304 is returned without computing anything when the client's
+    If-None-Match (or, without one, If-Modified-Since) still matches;
+    otherwise the body comes from rendered_cache or from render().
+
+    Args:
+    - render (callable): Builds the response body.
+    - mimetype (str): Content type of the body.
+    - variant (str): Distinguishes responses of the same route, e.g. by filter.
+
+    Returns:
+    - Response: The full or 304 response.
+    """
+    route = request.endpoint
+    stamp, last_modified = recommendation_version()
+    key = f"{route}:{current_user.id}:{stamp}{variant}"
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+    if not_modified:
+        RESPONSE_CACHE_REQUESTS.inc(route=route, result='not_modified')
+        response = Response(status=304)
+    else:
+        body = rendered_cache.get(key)
+        RESPONSE_CACHE_REQUESTS.inc(route=route, result='hit' if body is not None else 'miss')
+        if body is None:
+            body = render()
+            rendered_cache.set(key, body)
+        response = Response(body, mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Per user, and always revalidated so a changed population shows up at once
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.route('/connections')
 @login_required
-def find_similar_users_route():
-    # Get the updated interests from the session
-    user_profile = session.get('user_profile')
-    if not user_profile:
-        return jsonify({'similar_users': []})
+def connections():
+    # Serve the materialized recommendations; users newer than the last job run are ranked live
+    def render():
+        similar_users = stored_recommendations(current_user.id) or live_recommendations(current_user.id)
 
-    # Update the user's interests in the database
-    db_session = SessionLocal()
-    user = db_session.query(User).get(current_user.id)
+        # Render the template with similar users
+        return render_template('connections.html', similar_users=similar_users)
 
-    # List of interest fields
-    interest_fields = [
-        'sci_fi_movies', 'cooking', 'hiking', 'travel', 'reading', 'sports',
-        'music', 'photography', 'gardening', 'video_games', 'board_games',
-        'diy_projects', 'volunteering', 'movies', 'podcasts', 'social_media',
-        'pets', 'workout', 'meditation', 'travel_adventure',
-        'music_instruments', 'arts_crafts'
-    ]
+    return conditional_response(render, 'text/html')
 
-    # Update user's interests
-    for field in interest_fields:
-        setattr(user, field, user_profile.get(field))
-    db_session.commit()
-    db_session.close()
 
-    # Get all user vectors and data
-    user_vectors, user_ids, user_data, _ = get_user_vectors()
+# Route to find similar users
+@bp.route('/find_similar_users')
+@login_required
+def find_similar_users_route():
+    # The user's interests are already up to date in the database and index
+    # (update_profile and chat_api write them), so nothing is read from the session
+    try:
+        predicates = parse_predicates(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
-    # Check if there are enough users to perform clustering
-    if len(user_vectors) < 2:
-        similar_users_info = []
-    else:
-        # Preprocess the data
-        scaler = StandardScaler()
-        user_vectors_scaled = scaler.fit_transform(user_vectors)
+    # With min_<interest>/max_<interest> filters, rank everyone who matches them
+    if predicates:
+        top_n = min(request.args.get('top_n', default=10, type=int), 100)
 
-        # Apply K-Means clustering
-        k = 5  # Adjust as needed
-        if len(user_vectors_scaled) < k:
-            k = len(user_vectors_scaled)
-        kmeans = KMeans(n_clusters=k, random_state=42)
-        kmeans.fit(user_vectors_scaled)
-        cluster_labels = kmeans.labels_
+        def render_filtered():
+            similar_users = find_similar_users_filtered(current_user.id, predicates, top_n=top_n)
+            return json.dumps({'similar_users': [{'username': user['username']} for user in similar_users]})
 
-        # Assign users to clusters
-        user_clusters = dict(zip(user_ids, cluster_labels))
+        variant = ''.join(f":{field}={low}..{high}" for field, (low, high) in sorted(predicates.items()))
+        return conditional_response(render_filtered, 'application/json', variant=f"{variant}:top{top_n}")
 
-        # Find similar users
-        target_user_id = current_user.id
-        similar_user_ids = find_similar_users_clustering(target_user_id, user_clusters)
+    def render():
+        similar_users = stored_recommendations(current_user.id) or live_recommendations(current_user.id)
 
         # Retrieve usernames of similar users
         similar_users_info = [
-            {'username': user_data[user_id]['username']}
-            for user_id in similar_user_ids
+            {'username': similar_user['username']}
+            for similar_user in similar_users
         ]
+        return json.dumps({'similar_users': similar_users_info})
 
     # Return similar users as JSON
-    return jsonify({'similar_users': similar_users_info})
+    return conditional_response(render, 'application/json')
+
+
+# Route to rank similar users by cosine similarity
+@bp.route('/similar_users_ranked')
+@login_required
+def similar_users_ranked():
+    top_n = min(request.args.get('top_n', default=10, type=int), 100)
+    user_index.sync()
+    similar_users = find_similar_users_cosine(current_user.id, top_n=top_n)
+    return jsonify({'similar_users': similar_users})
+
+
+# Load the heavy subsystems in the background so early requests don't pay for them
+def prewarm():
+    started = time.perf_counter()
+    try:
+        # Creates the generation clients (importing huggingface_hub) or loads the local model
+        generation_backend.load()
+        fallback_backend.load()
+        # Imports scikit-learn and loads the vector index and clustering model
+        cluster_service.ensure_ready()
+        # Starts or attaches to the shards, if configured
+        get_shard_coordinator()
+    except Exception as e:
+        logging.error(f"Prewarm failed: {e}")
+        return
+    logging.info(f"Prewarm finished in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+# Application factory
+def create_app(config=None):
+    """
+    Create and configure the Flask app.
+
+    Nothing heavy happens here: scikit-learn, huggingface_hub and the vector
+    index are loaded by the prewarm thread (PREWARM=1, the default) or on
+    first use, so a new worker can serve /login right away. The time from
+    importing this module to the end of this function is logged and checked
+    against STARTUP_BUDGET_MS.
+
+    Args:
+    - config (dict): Extra config values, e.g. for tests.
+
+    Returns:
+    - Flask: The application.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config['SESSION_PERMANENT'] = False
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=5)
+    app.config.update(config or {})
+
+    configure_session_store(app, os.getenv('SESSION_BACKEND', 'cookie'))
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    app.teardown_appcontext(remove_db_session)
+
+    cluster_service.start()
+    interest_buffer.start()
+    if os.getenv('ANN_INDEX'):
+        start_ann_maintenance(float(os.getenv('ANN_SAVE_INTERVAL', 300)))
+    if os.getenv('PREWARM', '1') == '1':
+        threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+
+    startup = time.perf_counter() - IMPORT_STARTED_AT
+    STARTUP_SECONDS.observe(startup)
+    budget = float(os.getenv('STARTUP_BUDGET_MS', 1000)) / 1000
+    if startup > budget:
+        logging.warning(f"Startup took {startup * 1000:.0f} ms, over the {budget * 1000:.0f} ms budget")
+    else:
+        logging.info(f"Startup took {startup * 1000:.0f} ms")
+    return app
 
 
 # Initialize the database before the app starts
 if __name__ == '__main__':
     init_db()  # Initialize the database (create tables if they don't exist)
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
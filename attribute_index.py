@@ -0,0 +1,232 @@
+# attribute_index.py
+
+import math
+import threading
+
+import numpy as np
+
+from interests import INTEREST_FIELDS
+from metrics import ATTRIBUTE_FILTER_QUERIES
+
+# Whole-score thresholds with a bitmap per interest: bit set when score >= t
+THRESHOLDS = tuple(range(1, 11))
+
+
+class InterestAttributeIndex:
+    """
+    Per-interest sorted and bitmap indexes over the user index, used to
+    resolve predicates such as hiking >= 7 to a candidate set before ranking.
+
+    For every interest there is
+    - a sorted index: the rows ordered by score, with the scores as of the
+      last sort, so the rows in a score range are two binary searches away;
+    - range-encoded bitmaps: one packed bit per row for each threshold t, set
+      when the score is >= t, so a range over whole scores is one bitmap AND
+      NOT another, and predicates on several interests are ANDed a byte
+      (eight users) at a time.
+
+    The narrowest predicate, counted with the sorted index, picks the plan:
+    a range holding at most sorted_plan_ratio of the users is read from the
+    sorted index and only those rows are checked against the other
+    predicates; otherwise every predicate is resolved with the bitmaps.
+    Candidates are then checked against the exact scores, since bitmaps only
+    know whole-score thresholds. Unset interests score 0.
+
+    Bitmaps are updated in place as vectors change. Rows changed since the
+    last sort are kept in a delta that sorted reads add back in, and the
+    sorted indexes are rebuilt once the delta outgrows max_delta.
+    """
+
+    def __init__(self, user_index, interest_fields=INTEREST_FIELDS, thresholds=THRESHOLDS, max_delta=4096,
+                 sorted_plan_ratio=1 / 32):
+        self.user_index = user_index
+        self.interest_fields = list(interest_fields)
+        self.field_positions = {field: i for i, field in enumerate(self.interest_fields)}
+        self.thresholds = np.asarray(thresholds, dtype=np.float32)
+        self.max_delta = max_delta
+        self.sorted_plan_ratio = sorted_plan_ratio
+
+        self.source = None  # The index array the indexes were built from
+        self.user_ids = []  # Row -> user ID; None for rows not announced yet
+        self.id_to_row = {}
+        self.bitmaps = None  # uint8 [n_fields, n_thresholds, capacity / 8]
+        self.order = None  # int32 [n_fields, n_sorted]: rows by ascending score
+        self.sorted_values = None  # float32 [n_fields, n_sorted]: scores in that order
+        self.delta = set()  # Rows changed or added since the last sort
+        self.stale = True
+        self.lock = threading.RLock()
+
+    def _build(self):
+        vectors, user_ids = self.user_index.matrix_view()
+        count = len(user_ids)
+        matrix = vectors[:count]
+        self.bitmaps = np.zeros(
+            (len(self.interest_fields), len(self.thresholds), (vectors.shape[0] + 7) // 8), dtype=np.uint8
+        )
+        for position in range(len(self.interest_fields)):
+            above = matrix[:, position][None, :] >= self.thresholds[:, None]
+            self.bitmaps[position, :, :(count + 7) // 8] = np.packbits(above, axis=1)
+        self.source = vectors
+        self.user_ids = user_ids
+        self.id_to_row = {user_id: i for i, user_id in enumerate(user_ids)}
+        self._sort()
+        self.stale = False
+
+    def _sort(self):
+        matrix = self.source[:len(self.user_ids)]
+        order = np.argsort(matrix, axis=0, kind='stable')
+        self.order = np.ascontiguousarray(order.T, dtype=np.int32)
+        self.sorted_values = np.ascontiguousarray(np.take_along_axis(matrix, order, axis=0).T)
+        self.delta = set()
+
+    def _ensure_fresh(self):
+        self.user_index.ensure_loaded()
+        if self.stale or self.source is not self.user_index.vectors:
+            self._build()
+        elif len(self.delta) > max(self.max_delta, len(self.user_ids) // 16):
+            self._sort()
+
+    def on_vector_changed(self, user_id, vector):
+        """
+        Listener for the user index: update the row's bits and mark it unsorted.
+        """
+        with self.lock:
+            if self.stale or self.bitmaps is None:
+                return  # Built from the current matrix on the next query
+            row = self.id_to_row.get(user_id)
+            if row is None:
+                row = self.user_index.id_to_row.get(user_id)
+                if row is None:
+                    self.stale = True
+                    return
+                if row >= self.bitmaps.shape[2] * 8:
+                    grown = np.zeros(self.bitmaps.shape[:2] + (max(row // 8 + 1, self.bitmaps.shape[2] * 2),),
+                                     dtype=np.uint8)
+                    grown[:, :, :self.bitmaps.shape[2]] = self.bitmaps
+                    self.bitmaps = grown
+                if row >= len(self.user_ids):
+                    self.user_ids.extend([None] * (row + 1 - len(self.user_ids)))
+                self.user_ids[row] = user_id
+                self.id_to_row[user_id] = row
+
+            above = np.asarray(vector, dtype=np.float32)[:, None] >= self.thresholds[None, :]
+            mask = np.uint8(0x80 >> (row & 7))
+            column = self.bitmaps[:, :, row >> 3]
+            self.bitmaps[:, :, row >> 3] = np.where(above, column | mask, column & ~mask)
+            self.delta.add(row)
+
+    def _sorted_range(self, position, low, high):
+        values = self.sorted_values[position]
+        start = 0 if low is None else int(np.searchsorted(values, low, side='left'))
+        stop = len(values) if high is None else int(np.searchsorted(values, high, side='right'))
+        return start, max(start, stop)
+
+    def _sorted_rows(self, position, start, stop):
+        rows = self.order[position, start:stop].astype(np.intp)
+        if self.delta:
+            # Changed rows may have moved into (or out of) the range since the sort
+            rows = np.union1d(rows, np.fromiter(self.delta, dtype=np.intp, count=len(self.delta)))
+        return rows
+
+    def _bitmap_rows(self, predicates, count):
+        result = None
+        for field, (low, high) in predicates.items():
+            position = self.field_positions[field]
+            bitmap = None
+            if low is not None:
+                # Largest threshold <= low: a superset of score >= low
+                i = int(np.searchsorted(self.thresholds, low, side='right')) - 1
+                if i >= 0:
+                    bitmap = self.bitmaps[position, i]
+            if high is not None:
+                # Smallest threshold > high: score < it is a superset of score <= high
+                j = int(np.searchsorted(self.thresholds, high, side='right'))
+                if j < len(self.thresholds):
+                    below = ~self.bitmaps[position, j]
+                    bitmap = below if bitmap is None else bitmap & below
+            if bitmap is not None:
+                result = bitmap if result is None else result & bitmap
+        if result is None:
+            return np.arange(count)
+        return np.flatnonzero(np.unpackbits(result, count=count))
+
+    def _refine(self, rows, predicates):
+        keep = np.ones(len(rows), dtype=bool)
+        for field, (low, high) in predicates.items():
+            values = self.source[rows, self.field_positions[field]]
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+        return rows[keep]
+
+    def candidate_ids(self, predicates):
+        """
+        Return the users whose scores satisfy every predicate.
+
+        Args:
+        - predicates (dict): Mapping of interest field to (low, high), both
+          inclusive; either bound may be None.
+
+        Returns:
+        - list: IDs of the matching users.
+        """
+        with self.lock:
+            self._ensure_fresh()
+            count = len(self.user_ids)
+            if not predicates or not count:
+                return [user_id for user_id in self.user_ids if user_id is not None]
+
+            ranges = {
+                field: self._sorted_range(self.field_positions[field], low, high)
+                for field, (low, high) in predicates.items()
+            }
+            field = min(ranges, key=lambda name: ranges[name][1] - ranges[name][0])
+            start, stop = ranges[field]
+            if stop - start + len(self.delta) <= count * self.sorted_plan_ratio:
+                rows = self._sorted_rows(self.field_positions[field], start, stop)
+                plan = 'sorted'
+            else:
+                rows = self._bitmap_rows(predicates, count)
+                plan = 'bitmap'
+            ATTRIBUTE_FILTER_QUERIES.inc(plan=plan)
+
+            rows = self._refine(rows, predicates)
+            return [self.user_ids[row] for row in rows if self.user_ids[row] is not None]
+
+
+# Function to read interest predicates from query parameters
+def parse_predicates(args, interest_fields=INTEREST_FIELDS):
+    """
+    Read min_<interest> and max_<interest> parameters, e.g. min_hiking=7.
+
+    Args:
+    - args (MultiDict): The request's query parameters.
+
+    Returns:
+    - dict: Mapping of interest field to (low, high), either may be None.
+
+    Raises:
+    - ValueError: For unknown interests, non-numeric bounds or empty ranges.
+    """
+    fields = set(interest_fields)
+    bounds = {}
+    for name, value in args.items():
+        bound, _, field = name.partition('_')
+        if bound not in ('min', 'max') or not field:
+            continue
+        if field not in fields:
+            raise ValueError(f"Unknown interest: {field}")
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError(f"{name} must be a number")
+        if not math.isfinite(number):
+            raise ValueError(f"{name} must be a number")
+        low, high = bounds.get(field, (None, None))
+        bounds[field] = (number, high) if bound == 'min' else (low, number)
+
+    for field, (low, high) in bounds.items():
+        if low is not None and high is not None and low > high:
+            raise ValueError(f"min_{field} is greater than max_{field}")
+    return bounds
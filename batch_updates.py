@@ -0,0 +1,224 @@
+# batch_updates.py
+"""
+Batch interest updates for /update_profiles.
+
+The request body is parsed as a stream, either a JSON array or NDJSON (one
+update per line), so a large import never has to be held in memory at once:
+
+    [{"user_id": 12, "interests": {"cooking": 7, "hiking": null}}, ...]
+
+Each item is validated against the interest registry on its own, valid items
+are applied chunk by chunk with one bulk UPDATE per chunk, and every item
+gets its own status in the response.
+"""
+
+import codecs
+import json
+import logging
+import math
+
+from interests import INTEREST_POSITIONS
+from metrics import BATCH_UPDATE_ITEMS
+from write_behind import write_interest_updates
+
+
+class BatchUpdateError(ValueError):
+    """
+    Raised for an invalid item, or for a body that cannot be parsed further.
+    """
+
+
+# Function to validate one batch item
+def parse_update(item, default_user_id=None):
+    """
+    Validate one update against the interest registry.
+
+    Args:
+    - item (dict): {"user_id": int, "interests": {field: value}}; user_id may
+      be left out when default_user_id is given.
+    - default_user_id (int): The user updated by items without a user_id.
+
+    Returns:
+    - user_id (int): The user to update.
+    - interests (dict): Mapping of interest field to value (None unsets).
+    """
+    if isinstance(item, BatchUpdateError):
+        raise item  # An NDJSON line that was not valid JSON
+    if not isinstance(item, dict):
+        raise BatchUpdateError('Each update must be an object')
+
+    user_id = item.get('user_id', default_user_id)
+    if isinstance(user_id, bool) or not isinstance(user_id, int):
+        raise BatchUpdateError('user_id must be an integer')
+
+    interests = item.get('interests')
+    if not isinstance(interests, dict) or not interests:
+        raise BatchUpdateError('interests must be a non-empty object')
+    unknown = sorted(field for field in interests if field not in INTEREST_POSITIONS)
+    if unknown:
+        raise BatchUpdateError(f"Unknown interests: {', '.join(unknown)}")
+    for field, value in interests.items():
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise BatchUpdateError(f"{field} must be a number or null")
+
+    return user_id, {field: None if value is None else float(value) for field, value in interests.items()}
+
+
+# Function to parse a JSON array of updates incrementally
+def iter_json_array(stream, chunk_size=65536, max_item_size=1 << 20):
+    """
+    Yield the elements of a JSON array read from a file-like stream.
+
+    Raises:
+    - BatchUpdateError: If the body is not a JSON array, is truncated, or an
+      element is larger than max_item_size characters.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer, position = '', 0
+    state = 'start'  # start, first (after '['), item (after ','), after (after an element), done
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        if eof:
+            return False
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        try:
+            buffer = buffer[position:] + text.decode(chunk, final=eof)
+        except UnicodeDecodeError:
+            raise BatchUpdateError('The body is not valid UTF-8')
+        position = 0
+        return True
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+        if position == len(buffer):
+            if read_more():
+                continue
+            break
+
+        char = buffer[position]
+        if state == 'done':
+            raise BatchUpdateError('Unexpected data after the JSON array')
+        if state == 'start':
+            if char != '[':
+                raise BatchUpdateError('Expected a JSON array of updates')
+            position += 1
+            state = 'first'
+        elif char == ']' and state in ('first', 'after'):
+            position += 1
+            state = 'done'
+        elif state == 'after':
+            if char != ',':
+                raise BatchUpdateError("Expected ',' or ']' between updates")
+            position += 1
+            state = 'item'
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # Most likely an element split across reads: fetch more and retry
+                if len(buffer) - position > max_item_size or not read_more():
+                    raise BatchUpdateError(f"Invalid JSON: {e}")
+                continue
+            position = end
+            state = 'after'
+            yield item
+
+    if state != 'done':
+        raise BatchUpdateError('Truncated JSON array')
+
+
+# Function to parse newline-delimited updates incrementally
+def iter_ndjson(stream, max_item_size=1 << 20):
+    """
+    Yield one parsed value per non-blank line of a file-like stream; a line
+    that is not valid JSON yields a BatchUpdateError for that item instead.
+    """
+    while True:
+        line = stream.readline(max_item_size + 1)
+        if not line:
+            return
+        if len(line) > max_item_size:
+            raise BatchUpdateError(f"Update larger than {max_item_size} bytes")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield BatchUpdateError(f"Invalid JSON: {e}")
+
+
+# Function to write one chunk of validated updates
+def _write_chunk(session_factory, chunk, on_commit):
+    # Later items for the same user win, as if applied one by one
+    batch = {}
+    for _, user_id, interests in chunk:
+        batch.setdefault(user_id, {}).update(interests)
+
+    try:
+        found = write_interest_updates(session_factory, batch)
+    except Exception as e:
+        logging.error(f"Batch interest update failed: {e}")
+        for result, _, _ in chunk:
+            result.update(status='error', message='Database error')
+        return
+
+    for result, user_id, _ in chunk:
+        if user_id not in found:
+            result.update(status='error', message='Unknown user')
+    if on_commit is not None:
+        on_commit({user_id: interests for user_id, interests in batch.items() if user_id in found})
+
+
+# Function to validate and apply a stream of interest updates
+def apply_interest_batch(items, session_factory, chunk_size=1000, default_user_id=None, allowed_user_id=None,
+                         on_commit=None):
+    """
+    Apply updates from an iterable, one transaction per chunk of valid items.
+
+    Args:
+    - items (iterable): Parsed items, e.g. from iter_json_array().
+    - session_factory (callable): Creates the database session.
+    - chunk_size (int): Valid items written per bulk UPDATE.
+    - default_user_id (int): The user updated by items without a user_id.
+    - allowed_user_id (int): If set, the only user items may update.
+    - on_commit (callable): Called with {user_id: interests} after each chunk commits.
+
+    Returns:
+    - results (list): One {'index', 'status', ...} dict per item, in order.
+    - error (str): Why the body could not be read to the end, or None.
+    """
+    results = []
+    chunk = []
+    error = None
+    try:
+        for index, item in enumerate(items):
+            try:
+                user_id, interests = parse_update(item, default_user_id)
+                if allowed_user_id is not None and user_id != allowed_user_id:
+                    raise BatchUpdateError('Not allowed to update this user')
+            except BatchUpdateError as e:
+                results.append({'index': index, 'status': 'error', 'message': str(e)})
+                continue
+
+            result = {'index': index, 'user_id': user_id, 'status': 'ok'}
+            results.append(result)
+            chunk.append((result, user_id, interests))
+            if len(chunk) >= chunk_size:
+                _write_chunk(session_factory, chunk, on_commit)
+                chunk = []
+    except BatchUpdateError as e:
+        error = str(e)
+
+    if chunk:
+        _write_chunk(session_factory, chunk, on_commit)
+    for result in results:
+        BATCH_UPDATE_ITEMS.inc(status=result['status'])
+    return results, error
@@ -0,0 +1,201 @@
+# batching.py
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from generation import DeadlineExceeded, GenerationBackend
+from metrics import GENERATION_BATCH_SIZE, GENERATION_QUEUE_DELAY
+
+
+class _PendingRequest:
+    def __init__(self, prompt, max_new_tokens, deadline=None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.deadline = deadline
+        self.abandoned = False  # The caller stopped waiting at its deadline
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collects prompts arriving within a short window and dispatches them as one batch.
+
+    A batch is sent when max_batch_size prompts are waiting or max_wait
+    seconds have passed since the first one arrived, whichever comes first.
+    Batches are dispatched on a pool of max_in_flight threads, so the
+    collector fills the next batch while earlier ones are still running;
+    once max_in_flight batches are running, prompts wait in the queue and
+    go out together in the next batch. Results (or per-prompt errors) are
+    handed back to the waiting callers.
+
+    A caller with a deadline stops waiting at it; a prompt whose caller gave
+    up before its batch went out is left out of the batch, and dispatch gets
+    the latest deadline of the prompts it does carry.
+    """
+
+    def __init__(self, dispatch, max_batch_size=8, max_wait=0.02, max_in_flight=4, name='generation'):
+        self.dispatch = dispatch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self.name = name
+        self.requests = queue.Queue()
+        self.worker = None
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.batches = 0
+        self.prompts = 0
+        self.batch_sizes = {}  # batch size -> number of batches
+        self.queue_delay_total = 0.0
+        self.queue_delay_max = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.worker is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                                   thread_name_prefix=f'{self.name}-batch')
+                self.worker = threading.Thread(target=self._run, name=f'{self.name}-batcher', daemon=True)
+                self.worker.start()
+
+    def submit(self, prompt, max_new_tokens=200, deadline=None):
+        """
+        Queue a prompt and block until its batch has been processed.
+
+        Args:
+        - prompt (str): The prompt.
+        - max_new_tokens (int): Token limit for the response.
+        - deadline (float): time.monotonic() value to give up at, or None.
+
+        Raises:
+        - DeadlineExceeded: The batch did not finish before the deadline.
+        """
+        self.start()
+        request = _PendingRequest(prompt, max_new_tokens, deadline)
+        self.requests.put(request)
+        if not request.done.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+            request.abandoned = True
+            raise DeadlineExceeded(f"No response from {self.name} within the deadline")
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.requests.get(timeout=remaining))
+                else:
+                    # Past the window (e.g. after waiting for a slot): take what is already queued
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self.slots.acquire()  # Released when a running batch finishes
+            batch = self._collect()
+            dispatched_at = time.monotonic()
+            self._record(batch, dispatched_at)
+            self.executor.submit(self._dispatch_batch, batch)
+
+    def _dispatch_batch(self, batch):
+        try:
+            batch = [request for request in batch if not request.abandoned]
+            if not batch:
+                return
+            # Requests in one batch share max_new_tokens; use the largest asked for
+            max_new_tokens = max(request.max_new_tokens for request in batch)
+            deadlines = [request.deadline for request in batch]
+            deadline = None if None in deadlines else max(deadlines)
+            try:
+                results = self.dispatch([request.prompt for request in batch], max_new_tokens, deadline)
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    request.error = result
+                else:
+                    request.response = result
+                request.done.set()
+        finally:
+            self.slots.release()
+
+    def _record(self, batch, dispatched_at):
+        GENERATION_BATCH_SIZE.observe(len(batch))
+        for request in batch:
+            GENERATION_QUEUE_DELAY.observe(dispatched_at - request.enqueued_at)
+        with self.lock:
+            self.batches += 1
+            self.prompts += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for request in batch:
+                delay = dispatched_at - request.enqueued_at
+                self.queue_delay_total += delay
+                self.queue_delay_max = max(self.queue_delay_max, delay)
+
+    def stats(self):
+        """
+        Return batch size and queue delay metrics.
+        """
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'prompts': self.prompts,
+                'mean_batch_size': self.prompts / self.batches if self.batches else 0.0,
+                'batch_sizes': dict(self.batch_sizes),
+                'mean_queue_delay': self.queue_delay_total / self.prompts if self.prompts else 0.0,
+                'max_queue_delay': self.queue_delay_max,
+                'queued': self.requests.qsize(),
+            }
+
+
+class BatchingBackend(GenerationBackend):
+    """
+    Generation backend that micro-batches generate() calls to another backend.
+
+    Identical prompts within a batch are sent only once. Streaming bypasses
+    the batcher, since each stream needs its own connection.
+    """
+
+    def __init__(self, backend, max_batch_size=8, max_wait=0.02, max_in_flight=4):
+        self.backend = backend
+        self.name = backend.name
+        self.batcher = MicroBatcher(self._dispatch, max_batch_size=max_batch_size, max_wait=max_wait,
+                                    max_in_flight=max_in_flight, name=backend.name)
+
+    def load(self):
+        self.backend.load()
+        self.batcher.start()
+
+    def _dispatch(self, prompts, max_new_tokens, deadline=None):
+        unique_prompts = list(dict.fromkeys(prompts))
+        results = dict(zip(unique_prompts, self.backend.generate_batch(unique_prompts, max_new_tokens, deadline)))
+        if len(unique_prompts) < len(prompts):
+            logging.debug(f"Deduplicated {len(prompts) - len(unique_prompts)} prompts in a batch")
+        return [results[prompt] for prompt in prompts]
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        return self.batcher.submit(prompt, max_new_tokens=max_new_tokens, deadline=deadline)
+
+    def generate_batch(self, prompts, max_new_tokens=200, deadline=None):
+        return self._dispatch(prompts, max_new_tokens, deadline)
+
+    def stream(self, prompt, max_new_tokens=200):
+        return self.backend.stream(prompt, max_new_tokens=max_new_tokens)
+
+    def stats(self):
+        return self.batcher.stats()
@@ -0,0 +1,222 @@
+# benchmark.py
+"""
+Scale benchmark for the matching pipeline.
+
+Seeds a scratch database with synthetic users for each population size,
+times every stage of the recommendation path and its peak memory, and
+writes the results as JSON:
+
+    python benchmark.py --sizes 10000 100000 1000000 --output bench.json
+    python benchmark.py --sizes 10000 --compare bench.json --tolerance 0.25
+
+With --compare the run exits non-zero if any stage got slower than the
+baseline by more than the tolerance, so it can gate deployments.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+# Function to generate synthetic interest vectors
+def synthetic_interests(n_users, dim, seed=42, n_personas=12):
+    """
+    Generate realistic-looking interest scores.
+
+    Each user is a mix of a few personas (e.g. outdoorsy, gamer, artsy), so
+    interests are correlated the way real profiles are; roughly a third of
+    the interests are left unset, and scores are whole numbers from 0 to 10.
+
+    Returns:
+    - np.ndarray: float32 array of shape (n_users, dim) with NaN for unset.
+    """
+    rng = np.random.default_rng(seed)
+    personas = rng.beta(0.6, 0.9, size=(n_personas, dim)) * 10
+    mixtures = rng.dirichlet(np.full(n_personas, 0.3), size=n_users).astype(np.float32)
+    scores = mixtures @ personas + rng.normal(0, 1.2, size=(n_users, dim))
+    scores = np.clip(np.rint(scores), 0, 10).astype(np.float32)
+    scores[rng.random((n_users, dim)) < 0.35] = np.nan
+    return scores
+
+
+# Function to (re)seed the users table
+def seed_users(engine, n_users, seed):
+    from sqlalchemy import text
+    from interests import INTEREST_DIM
+
+    vectors = synthetic_interests(n_users, INTEREST_DIM, seed=seed)
+    with engine.begin() as connection:
+        connection.execute(text('DELETE FROM users'))
+        batch_size = 50000
+        for start in range(0, n_users, batch_size):
+            connection.execute(
+                text('INSERT INTO users (username, email, password_hash, interest_vector) '
+                     'VALUES (:username, :email, :password_hash, :interest_vector)'),
+                [
+                    {
+                        'username': f'bench{i}',
+                        'email': f'bench{i}@example.com',
+                        'password_hash': 'x',
+                        'interest_vector': vectors[i].tobytes(),
+                    }
+                    for i in range(start, min(start + batch_size, n_users))
+                ]
+            )
+
+
+class StageTimer:
+    """
+    Records wall time and tracemalloc peak for each stage of one run.
+
+    Tracing every allocation slows the traced code down, so stages are timed
+    with tracemalloc off and the peak is measured in a separate, untimed call
+    afterwards; with measure_memory=False that call is skipped.
+    """
+
+    def __init__(self, n_users, measure_memory=True):
+        self.n_users = n_users
+        self.measure_memory = measure_memory
+        self.results = []
+
+    def run(self, stage, func, repeat=1):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            value = func()
+        seconds = (time.perf_counter() - start) / repeat
+
+        peak = None
+        if self.measure_memory:
+            tracemalloc.start()
+            try:
+                func()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        self.results.append({'users': self.n_users, 'stage': stage, 'seconds': seconds, 'peak_bytes': peak})
+        memory = f"{peak / 2 ** 20:8.1f} MiB" if peak is not None else ''
+        print(f"{self.n_users:>9} users  {stage:<22} {seconds * 1000:10.2f} ms  {memory}")
+        return value
+
+
+# Function to benchmark the pipeline for one population size
+def benchmark_population(n_users, queries, seed, n_clusters, model_dir, measure_memory=True):
+    from sklearn.cluster import KMeans
+    from sklearn.preprocessing import StandardScaler
+
+    from clustering import ClusteringService
+    from database import ReadSessionLocal, engine
+    from interests import unpack_interest_matrix
+    from models import User
+    from vector_db import CosineSimilarityEngine, UserVectorIndex
+
+    seed_users(engine, n_users, seed)
+    timer = StageTimer(n_users, measure_memory=measure_memory)
+
+    def load():
+        db_session = ReadSessionLocal()
+        rows = db_session.query(User.id, User.username, User.interest_vector).all()
+        db_session.close()
+        return rows
+
+    rows = timer.run('load', load)
+    vectors = timer.run('vectorize', lambda: unpack_interest_matrix([row[2] for row in rows]))
+    user_ids = [row[0] for row in rows]
+    del rows
+
+    index = UserVectorIndex()
+    timer.run('index_load', index.load)
+
+    scaled = timer.run('scale', lambda: StandardScaler().fit_transform(vectors))
+    if n_users <= 100000:
+        # The per-request refit the routes used to do; too slow to run at 1M
+        timer.run('fit_kmeans_full', lambda: KMeans(n_clusters=n_clusters, random_state=42).fit(scaled))
+
+    clustering = ClusteringService(index, os.path.join(model_dir, f'kmeans_{n_users}.joblib'), n_clusters=n_clusters)
+    timer.run('fit_clustering', clustering.fit)
+
+    rng = np.random.default_rng(seed)
+    targets = [user_ids[i] for i in rng.choice(len(user_ids), min(queries, len(user_ids)), replace=False)]
+    target_iter = iter(targets * 2)  # One extra lookup for the memory pass
+    timer.run('lookup_cluster', lambda: clustering.similar_user_ids(next(target_iter)), repeat=len(targets))
+
+    similarity = CosineSimilarityEngine(index)
+    timer.run('cosine_prepare', similarity.refresh)
+    target_iter = iter(targets * 2)
+    timer.run('lookup_cosine_top10', lambda: similarity.top_k(next(target_iter), 10), repeat=len(targets))
+    timer.run('lookup_cosine_batch', lambda: similarity.top_k_batch(targets, 10))
+
+    return timer.results
+
+
+# Function to find stages that got slower than a baseline run
+def find_regressions(results, baseline, tolerance):
+    previous = {(entry['users'], entry['stage']): entry['seconds'] for entry in baseline['results']}
+    regressions = []
+    for entry in results:
+        before = previous.get((entry['users'], entry['stage']))
+        if before and entry['seconds'] > before * (1 + tolerance):
+            regressions.append({**entry, 'baseline_seconds': before})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the matching pipeline at several population sizes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--queries', type=int, default=100, help='lookups timed per population size')
+    parser.add_argument('--clusters', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='baseline results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, e.g. 0.25 = 25%%')
+    parser.add_argument('--no-memory', action='store_true', help='skip the separate peak-memory pass per stage')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='interweave-bench-')
+    # Point the app's database at a scratch file before it is imported
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from database import init_db
+    init_db()
+
+    import sklearn
+    results = []
+    for n_users in args.sizes:
+        results.extend(benchmark_population(n_users, args.queries, args.seed, args.clusters, workdir,
+                                            measure_memory=not args.no_memory))
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'seed': args.seed,
+            'queries': args.queries,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for entry in regressions:
+            print(f"REGRESSION {entry['users']} users {entry['stage']}: "
+                  f"{entry['baseline_seconds'] * 1000:.2f} ms -> {entry['seconds'] * 1000:.2f} ms")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
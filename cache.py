@@ -0,0 +1,259 @@
+# cache.py
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import LLM_CACHE_REQUESTS
+
+
+class MemoryCache:
+    """
+    In-process LRU cache with optional per-entry TTL.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.entries[key] = (time.time() + ttl if ttl else None, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteCache:
+    """
+    Cache stored in a SQLite file, shared by every worker on the host.
+
+    Values are stored as JSON. When the cache grows past maxsize the oldest
+    writes are evicted, so reads never have to write.
+    """
+
+    def __init__(self, path, maxsize=10000, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, written_at REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_written_at ON cache (written_at)')
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, expires_at FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, written_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + ttl if ttl else None, now)
+            )
+            connection.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+            connection.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY written_at DESC LIMIT -1 OFFSET ?)',
+                (self.maxsize,)
+            )
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+
+
+class RedisCache:
+    """
+    Cache in any Redis-compatible server, shared across hosts.
+
+    Size-based eviction is delegated to the server's maxmemory policy
+    (e.g. allkeys-lru); entries are written with their TTL.
+    """
+
+    def __init__(self, url, ttl=None, namespace='interweave'):
+        import redis  # Optional dependency, only needed for this backend
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.namespace = namespace
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self._key(key), json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.namespace}:*"):
+            self.client.delete(key)
+
+
+def create_cache(backend='memory', maxsize=1000, ttl=None, path=None, url=None):
+    """
+    Create a cache backend by name.
+
+    Args:
+    - backend (str): 'memory', 'sqlite' or 'redis'.
+    - maxsize (int): Maximum number of entries (memory and sqlite).
+    - ttl (float): Default time to live in seconds, None for no expiry.
+    - path (str): Database file for the sqlite backend.
+    - url (str): Server URL for the redis backend.
+    """
+    if backend == 'memory':
+        return MemoryCache(maxsize=maxsize, ttl=ttl)
+    elif backend == 'sqlite':
+        return SQLiteCache(path or './.cache/cache.db', maxsize=maxsize, ttl=ttl)
+    elif backend == 'redis':
+        return RedisCache(url or 'redis://localhost:6379/0', ttl=ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+class IdentityCache:
+    """
+    Cache of slim user records for the Flask-Login user loader, keyed by user id.
+
+    Entries expire after the backend's TTL and are dropped explicitly whenever
+    the user row is written, so a stale record never outlives a write made by
+    this process (or by any process, with a shared backend).
+    """
+
+    def __init__(self, backend, namespace='user'):
+        self.backend = backend
+        self.namespace = namespace
+
+    def key(self, user_id):
+        return f"{self.namespace}:{int(user_id)}"
+
+    def get(self, user_id):
+        return self.backend.get(self.key(user_id))
+
+    def put(self, user_id, record):
+        self.backend.set(self.key(user_id), record)
+
+    def invalidate(self, user_id):
+        self.backend.delete(self.key(user_id))
+
+
+# Function to normalize a prompt so near-identical prompts share a cache entry
+def normalize_prompt(prompt):
+    """
+    Lowercases the prompt and collapses whitespace, so e.g. "Yes " and "yes"
+    in a user message produce the same key. Punctuation is kept: "no." and
+    "no?" can call for different replies.
+    """
+    return ' '.join(prompt.lower().split())
+
+
+class ResponseCache:
+    """
+    Cache of LLM responses keyed by normalized prompt, with hit/miss counters.
+
+    Only successful, non-empty responses are stored; a failed generation is
+    simply not cached and the next request tries again.
+    """
+
+    def __init__(self, backend, namespace='llm'):
+        self.backend = backend
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, prompt):
+        digest = hashlib.sha256(normalize_prompt(prompt).encode('utf-8')).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    def get(self, prompt):
+        """
+        Return the cached response for prompt, or None, counting the hit or miss.
+        """
+        response = self.backend.get(self.key(prompt))
+        with self.lock:
+            if response is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        LLM_CACHE_REQUESTS.inc(result='hit' if response is not None else 'miss')
+        return response
+
+    def put(self, prompt, response):
+        if response:
+            self.backend.set(self.key(prompt), response)
+
+    def get_or_generate(self, prompt, generate):
+        """
+        Return the cached response for prompt, calling generate() on a miss.
+        """
+        response = self.get(prompt)
+        if response is None:
+            response = generate()
+            self.put(prompt, response)
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
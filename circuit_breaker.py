@@ -0,0 +1,317 @@
+# circuit_breaker.py
+
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from generation import DeadlineExceeded, GenerationBackend, GenerationError
+from metrics import LLM_CIRCUIT_REJECTIONS, LLM_CIRCUIT_TRANSITIONS, LLM_DEADLINES_EXCEEDED, LLM_HEDGED_REQUESTS
+
+
+class CircuitOpenError(GenerationError):
+    """
+    Raised instead of calling the backend while the circuit is open.
+    """
+
+
+# Admission ticket for one call; epoch is the breaker state it was admitted under
+Permit = namedtuple('Permit', ['epoch', 'probe'])
+
+
+class CircuitBreaker:
+    """
+    Error-rate and latency circuit breaker over a sliding window of calls.
+
+    While closed, every call is admitted and its outcome recorded. Once the
+    window holds min_calls outcomes and the share of failures reaches
+    failure_rate, or the share of calls slower than slow_call_seconds reaches
+    slow_call_rate, the circuit opens and calls are rejected for open_seconds.
+    It then goes half-open and admits half_open_probes trial calls: if they
+    all succeed in time it closes again, otherwise it reopens.
+
+    Outcomes of calls admitted before the last state change are ignored, so
+    stragglers from an outage cannot reopen a circuit that just recovered.
+    open_seconds is measured with clock (time.monotonic unless given).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window_size=50, min_calls=10, failure_rate=0.5, slow_call_seconds=5.0,
+                 slow_call_rate=0.8, open_seconds=30.0, half_open_probes=2, name='generation', clock=time.monotonic):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.name = name
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self.epoch = 0
+        self.opened_at = None
+        self.outcomes = deque(maxlen=window_size)  # (success, slow)
+        self.latencies = deque(maxlen=window_size)  # durations of successful calls
+        self.probes_admitted = 0
+        self.probes_passed = 0
+        self.lock = threading.Lock()
+
+    def _transition(self, state):
+        # Called with the lock held
+        self.state = state
+        self.epoch += 1
+        self.outcomes.clear()
+        self.probes_admitted = 0
+        self.probes_passed = 0
+        if state == self.OPEN:
+            self.opened_at = self.clock()
+        LLM_CIRCUIT_TRANSITIONS.inc(state=state)
+        logging.warning(f"Circuit '{self.name}' is now {state}")
+
+    def acquire(self):
+        """
+        Ask to make a call.
+
+        Returns:
+        - Permit to pass to record(), or None if the call must not be made.
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.open_seconds:
+                    return None
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self.probes_admitted >= self.half_open_probes:
+                    return None
+                self.probes_admitted += 1
+                return Permit(self.epoch, True)
+            return Permit(self.epoch, False)
+
+    def record(self, permit, duration, success):
+        """
+        Record the outcome of an admitted call.
+
+        Args:
+        - permit (Permit): The permit returned by acquire().
+        - duration (float): Call latency in seconds.
+        - success (bool): False if the call raised or timed out.
+        """
+        slow = duration >= self.slow_call_seconds
+        with self.lock:
+            if success:
+                self.latencies.append(duration)
+            if permit.epoch != self.epoch:
+                return
+            if permit.probe:
+                if not success or slow:
+                    self._transition(self.OPEN)
+                else:
+                    self.probes_passed += 1
+                    if self.probes_passed >= self.half_open_probes:
+                        self._transition(self.CLOSED)
+                return
+
+            self.outcomes.append((success, slow))
+            if len(self.outcomes) < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self.outcomes if not ok) / len(self.outcomes)
+            slow_calls = sum(1 for _, was_slow in self.outcomes if was_slow) / len(self.outcomes)
+            if failures >= self.failure_rate or slow_calls >= self.slow_call_rate:
+                self._transition(self.OPEN)
+
+    def latency_percentile(self, percentile):
+        """
+        Return the given percentile (0-100) of recent successful call
+        latencies, or None until min_calls of them have been seen.
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_calls:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def stats(self):
+        with self.lock:
+            calls = len(self.outcomes)
+            return {
+                'state': self.state,
+                'calls': calls,
+                'failure_rate': sum(1 for ok, _ in self.outcomes if not ok) / calls if calls else 0.0,
+                'slow_call_rate': sum(1 for _, slow in self.outcomes if slow) / calls if calls else 0.0,
+            }
+
+
+class _Call:
+    def __init__(self, breaker, permit):
+        self.breaker = breaker
+        self.permit = permit
+        self.started = time.monotonic()
+        self.future = None
+        self.recorded = False
+        self.lock = threading.Lock()
+
+    def finish(self, success):
+        # Whichever comes first, completion or the caller's deadline, is recorded
+        with self.lock:
+            if self.recorded:
+                return
+            self.recorded = True
+        self.breaker.record(self.permit, time.monotonic() - self.started, success)
+
+
+class ResilientBackend(GenerationBackend):
+    """
+    Generation backend that guards another one with a circuit breaker,
+    per-call deadlines and optional hedged requests.
+
+    generate() runs the call on a bounded thread pool and waits at most until
+    the caller's deadline. When hedge_percentile is set and the first call is
+    still running after that percentile of recent latencies, a second,
+    identical call is sent and whichever answers first wins. Streams are
+    guarded by the breaker (time to first token counts as latency) but are
+    neither hedged nor cut off, since a stream cannot be resumed.
+    """
+
+    def __init__(self, backend, breaker, hedge_percentile=None, min_hedge_delay=0.05, max_concurrency=32):
+        self.backend = backend
+        self.name = backend.name
+        self.breaker = breaker
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f'{backend.name}-call')
+
+    def load(self):
+        self.backend.load()
+
+    def _admit(self):
+        permit = self.breaker.acquire()
+        if permit is None:
+            LLM_CIRCUIT_REJECTIONS.inc()
+            raise CircuitOpenError(f"Circuit '{self.breaker.name}' is open")
+        return permit
+
+    def _run(self, call, prompt, max_new_tokens, deadline):
+        try:
+            response = self.backend.generate(prompt, max_new_tokens=max_new_tokens, deadline=deadline)
+        except Exception:
+            call.finish(False)
+            raise
+        call.finish(True)
+        return response
+
+    def _submit(self, permit, prompt, max_new_tokens, deadline):
+        call = _Call(self.breaker, permit)
+        call.future = self.executor.submit(self._run, call, prompt, max_new_tokens, deadline)
+        return call
+
+    def _hedge_delay(self):
+        if not self.hedge_percentile:
+            return None
+        latency = self.breaker.latency_percentile(self.hedge_percentile)
+        return None if latency is None else max(self.min_hedge_delay, latency)
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        """
+        Generate a response through the breaker.
+
+        Args:
+        - prompt (str): The prompt.
+        - max_new_tokens (int): Token limit for the response.
+        - deadline (float): time.monotonic() value to give up at, or None.
+
+        Returns:
+        - str: The first successful response.
+        """
+        permit = self._admit()
+        calls = [self._submit(permit, prompt, max_new_tokens, deadline)]
+        # Probes are never hedged: half-open admits a fixed number of calls
+        hedge_at = None if permit.probe else self._hedge_delay()
+        pending = {calls[0].future}
+        error = None
+
+        while True:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if hedge_at is not None and len(calls) == 1:
+                until_hedge = calls[0].started + hedge_at - time.monotonic()
+                timeout = until_hedge if timeout is None else min(timeout, until_hedge)
+            done, pending = wait(pending, timeout=None if timeout is None else max(timeout, 0),
+                                 return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    if len(calls) > 1:
+                        LLM_HEDGED_REQUESTS.inc(result='won' if future is calls[1].future else 'lost')
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+
+            if deadline is not None and time.monotonic() >= deadline:
+                for call in calls:
+                    call.finish(False)
+                LLM_DEADLINES_EXCEEDED.inc()
+                raise DeadlineExceeded(f"No response from {self.name} within the deadline")
+
+            if hedge_at is not None and len(calls) == 1 and time.monotonic() - calls[0].started >= hedge_at:
+                hedge_permit = self.breaker.acquire()
+                if hedge_permit is None:
+                    hedge_at = None
+                else:
+                    calls.append(self._submit(hedge_permit, prompt, max_new_tokens, deadline))
+                    pending.add(calls[1].future)
+                    LLM_HEDGED_REQUESTS.inc(result='issued')
+
+    def generate_batch(self, prompts, max_new_tokens=200, deadline=None):
+        permit = self._admit()
+        call = _Call(self.breaker, permit)
+        try:
+            results = self.backend.generate_batch(prompts, max_new_tokens=max_new_tokens, deadline=deadline)
+        except Exception:
+            call.finish(False)
+            raise
+        call.finish(not any(isinstance(result, Exception) for result in results))
+        return results
+
+    def stream(self, prompt, max_new_tokens=200):
+        call = _Call(self.breaker, self._admit())
+        try:
+            tokens = iter(self.backend.stream(prompt, max_new_tokens=max_new_tokens))
+        except Exception:
+            call.finish(False)
+            raise
+        return self._observe_stream(call, tokens)
+
+    def _observe_stream(self, call, tokens):
+        try:
+            for token in tokens:
+                call.finish(True)
+                yield token
+        except Exception:
+            call.finish(False)
+            raise
+        finally:
+            # An empty stream, or one the client closed before the first token
+            call.finish(True)
+
+    def stats(self):
+        return self.breaker.stats()
+
+
+# Function to parse per conversation state deadlines
+def parse_deadlines(spec):
+    """
+    Parse "state=seconds" pairs, e.g. "start=4,asking_questions=8".
+
+    Returns:
+    - dict: Mapping of conversation state to seconds.
+    """
+    deadlines = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        state, _, seconds = item.partition('=')
+        deadlines[state.strip()] = float(seconds)
+    return deadlines
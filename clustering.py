@@ -0,0 +1,264 @@
+# clustering.py
+
+import copy
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from metrics import RECOMMENDATION_STAGE_SECONDS
+
+
+class ClusteringService:
+    """
+    Precomputed K-Means clustering of the user population.
+
+    The scaler and centroids are fitted off the request path (on a schedule
+    or after a number of profile changes) and persisted to disk. Requests only
+    look up the current user's cluster in a cluster -> members index; changed
+    or new users are assigned to the nearest centroid right away, and folded
+    into the model with MiniBatchKMeans.partial_fit by the background thread
+    every partial_fit_interval seconds until the next full refit.
+
+    scikit-learn and joblib are imported on first load or fit, not at import.
+    """
+
+    def __init__(self, user_index, model_path, n_clusters=5, refit_interval=3600,
+                 refit_after_changes=500, partial_fit_interval=5.0, random_state=42):
+        self.user_index = user_index
+        self.model_path = model_path
+        self.n_clusters = n_clusters
+        self.refit_interval = refit_interval
+        self.refit_after_changes = refit_after_changes
+        self.partial_fit_interval = partial_fit_interval
+        self.random_state = random_state
+
+        self.scaler = None
+        self.kmeans = None
+        self.user_clusters = {}  # user_id -> cluster label
+        self.cluster_members = {}  # cluster label -> set of user_ids
+        self.fitted_at = None
+        self.model_hash = None  # Digest of the fitted parameters, see _hash_model()
+        self.changes_since_fit = 0
+        self.pending_vectors = []  # Scaled vectors waiting for partial_fit
+
+        self.lock = threading.RLock()
+        self.refit_requested = threading.Event()
+        self.worker = None
+
+    def load(self):
+        """
+        Load a persisted scaler and centroids, then assign every user to a cluster.
+
+        Returns:
+        - bool: True if a model was found on disk.
+        """
+        if not os.path.exists(self.model_path):
+            return False
+        import joblib
+        try:
+            model = joblib.load(self.model_path)
+        except Exception as e:
+            logging.error(f"Could not load clustering model: {e}")
+            return False
+
+        user_vectors, user_ids, _ = self.user_index.snapshot()
+        with self.lock:
+            self.scaler = model['scaler']
+            self.kmeans = model['kmeans']
+            self.fitted_at = model['fitted_at']
+            self.model_hash = self._hash_model()
+            self._assign_all(user_vectors, user_ids)
+        return True
+
+    def _hash_model(self):
+        # The fitted parameters only: a refit that reproduces the same model
+        # (e.g. another worker refitting unchanged data) keeps the same hash
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (self.scaler.mean_, self.scaler.scale_, self.kmeans.cluster_centers_):
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def save(self):
+        """
+        Persist the scaler and centroids atomically.
+
+        Each save writes its own temporary file, so workers saving at the same
+        time never write into each other's file; the last rename wins.
+        """
+        import joblib
+
+        directory = os.path.dirname(self.model_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(self.model_path)}.", suffix='.tmp')
+        os.close(fd)
+        try:
+            with self.lock:
+                model = {'scaler': self.scaler, 'kmeans': self.kmeans, 'fitted_at': self.fitted_at}
+                joblib.dump(model, tmp_path)
+            os.replace(tmp_path, self.model_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def fit(self):
+        """
+        Refit the scaler and centroids on the whole population and persist them.
+        """
+        from sklearn.cluster import MiniBatchKMeans
+        from sklearn.preprocessing import StandardScaler
+
+        user_vectors, user_ids, _ = self.user_index.snapshot()
+
+        # Check if there are enough users to perform clustering
+        if len(user_vectors) < 2:
+            with self.lock:
+                self.scaler = None
+                self.kmeans = None
+                self.user_clusters = {}
+                self.cluster_members = {}
+                self.model_hash = None
+                self.changes_since_fit = 0
+            return
+
+        with RECOMMENDATION_STAGE_SECONDS.time(stage='scale'):
+            scaler = StandardScaler()
+            user_vectors_scaled = scaler.fit_transform(user_vectors)
+
+        # Ensure k is not greater than the number of users
+        k = min(self.n_clusters, len(user_vectors_scaled))
+        with RECOMMENDATION_STAGE_SECONDS.time(stage='kmeans_fit'):
+            kmeans = MiniBatchKMeans(n_clusters=k, random_state=self.random_state, n_init=3)
+            kmeans.fit(user_vectors_scaled)
+
+        with self.lock:
+            self.scaler = scaler
+            self.kmeans = kmeans
+            self.fitted_at = time.time()
+            self.model_hash = self._hash_model()
+            self.changes_since_fit = 0
+            self.pending_vectors = []  # Already part of the population just fitted
+            self._assign_all(user_vectors, user_ids, labels=kmeans.labels_)
+        self.save()
+
+    def _assign_all(self, user_vectors, user_ids, labels=None):
+        if labels is None:
+            labels = self.kmeans.predict(self.scaler.transform(user_vectors)) if len(user_ids) else []
+        self.user_clusters = dict(zip(user_ids, (int(label) for label in labels)))
+        self.cluster_members = {}
+        for user_id, label in self.user_clusters.items():
+            self.cluster_members.setdefault(label, set()).add(user_id)
+
+    def ensure_ready(self):
+        """
+        Make sure a model is available, loading it from disk or fitting it once.
+        """
+        if self.kmeans is not None:
+            return
+        with self.lock:
+            if self.kmeans is None and not self.load():
+                self.fit()
+
+    def record_change(self, user_id, vector):
+        """
+        Fold a new or changed user vector into the clustering.
+
+        The user is moved to the nearest centroid; the centroids are nudged
+        with partial_fit later, off the request path (see apply_partial_fit).
+        A full refit is requested once enough changes pile up.
+
+        Args:
+        - user_id (int): The ID of the changed user.
+        - vector (np.ndarray): The user's current interest vector.
+        """
+        with self.lock:
+            if self.kmeans is None:
+                return
+            scaled = self.scaler.transform(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+            self.pending_vectors.append(scaled)
+            label = int(self.kmeans.predict(scaled)[0])
+
+            previous = self.user_clusters.get(user_id)
+            if previous is not None:
+                self.cluster_members[previous].discard(user_id)
+            self.user_clusters[user_id] = label
+            self.cluster_members.setdefault(label, set()).add(user_id)
+
+            self.changes_since_fit += 1
+            if self.changes_since_fit >= self.refit_after_changes:
+                self.refit_requested.set()
+
+    def apply_partial_fit(self):
+        """
+        Nudge the centroids with the vectors recorded since the last call.
+
+        partial_fit runs on a copy of the model, so requests keep assigning
+        users with the current one meanwhile; the copy is swapped in unless a
+        full refit replaced the model in the meantime.
+
+        Returns:
+        - int: The number of vectors folded in.
+        """
+        with self.lock:
+            batch, self.pending_vectors = self.pending_vectors, []
+            kmeans = self.kmeans
+        if not batch or kmeans is None:
+            return 0
+        updated = copy.deepcopy(kmeans)
+        updated.partial_fit(np.vstack(batch))
+        with self.lock:
+            if self.kmeans is kmeans:
+                self.kmeans = updated
+        return len(batch)
+
+    def similar_user_ids(self, target_user_id):
+        """
+        Return the IDs of the users sharing the target user's cluster.
+
+        Args:
+        - target_user_id (int): The ID of the target user.
+
+        Returns:
+        - List of user IDs of similar users.
+        """
+        self.ensure_ready()
+        with self.lock:
+            target_cluster = self.user_clusters.get(target_user_id)
+            if target_cluster is None:
+                return []
+            return [
+                user_id for user_id in self.cluster_members.get(target_cluster, ())
+                if user_id != target_user_id
+            ]
+
+    def start(self):
+        """
+        Start the background thread that refits the model on a schedule.
+        """
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self._run, name='clustering-refit', daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        next_refit = time.monotonic() + self.refit_interval
+        while True:
+            timeout = max(0.0, min(self.partial_fit_interval, next_refit - time.monotonic()))
+            if self.refit_requested.wait(timeout=timeout) or time.monotonic() >= next_refit:
+                self.refit_requested.clear()
+                next_refit = time.monotonic() + self.refit_interval
+                if self.kmeans is not None and self.changes_since_fit == 0:
+                    continue  # Nothing changed since the last fit
+                try:
+                    self.fit()
+                except Exception as e:
+                    logging.error(f"Background re-clustering failed: {e}")
+            else:
+                try:
+                    self.apply_partial_fit()
+                except Exception as e:
+                    logging.error(f"Folding changes into the clustering failed: {e}")
@@ -1,68 +1,248 @@
-from sqlalchemy import create_engine, text
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, delete, event, insert, make_url, text, update
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from metrics import DB_SESSIONS
+
+load_dotenv()
+
+SQLALCHEMY_DATABASE_URL = os.getenv('DATABASE_URL', "sqlite:///./test.db")
+# Optional read replica for the read-heavy recommendation queries
+SQLALCHEMY_READ_DATABASE_URL = os.getenv('DATABASE_READ_URL')
+# Population versions whose changed users are kept for workers catching up
+POPULATION_CHANGE_RETENTION = int(os.getenv('POPULATION_CHANGE_RETENTION', 100000))
+
+
+def create_db_engine(url):
+    """
+    Create an engine with pooling and pre-ping; SQLite connections also get
+    WAL journaling and pragmas suited to concurrent readers and writers.
+
+    An in-memory SQLite database lives in its connection, so it gets a single
+    connection shared by all threads instead of a pool.
+    """
+    pool_options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+    if not url.startswith('sqlite'):
+        return create_engine(url, **pool_options)
+
+    parsed = make_url(url)
+    database = parsed.database or ''
+    if database in ('', ':memory:') or database.startswith('file::memory:') or parsed.query.get('mode') == 'memory':
+        pool_options = {'poolclass': StaticPool}
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+    engine = create_engine(url, connect_args={'check_same_thread': False}, **pool_options)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')  # Readers no longer block the writer
+        cursor.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL, far fewer fsyncs
+        cursor.execute(f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', 268435456))}")
+        cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))}")
+        cursor.close()
+
+    return engine
+
+
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+read_engine = create_db_engine(SQLALCHEMY_READ_DATABASE_URL) if SQLALCHEMY_READ_DATABASE_URL else engine
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# Request-scoped session; the app removes it when the request ends
+db_session = scoped_session(SessionLocal)
+
+
+# Count session transactions opened and closed, for /metrics
+@event.listens_for(Session, 'after_begin')
+def count_session_open(session, transaction, connection):
+    DB_SESSIONS.inc(event='open')
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def count_session_close(session, transaction):
+    if transaction.parent is None:
+        DB_SESSIONS.inc(event='close')
 
 Base = declarative_base()
 
 
 def init_db():
     import models  # Import here to avoid circular imports
+    from interests import INTEREST_FIELDS, pack_interests
     Base.metadata.create_all(bind=engine)
 
-    # Check if the new columns exist, if not, add them
+    # Check if the packed interest column exists, if not, add it
     from sqlalchemy import inspect
-    from sqlalchemy.sql import text
     inspector = inspect(engine)
     existing_columns = [c['name'] for c in inspector.get_columns('users')]
+    run_columns = [c['name'] for c in inspector.get_columns('recommendation_runs')]
+    version_columns = [c['name'] for c in inspector.get_columns('population_version')]
+    state_columns = [c['name'] for c in inspector.get_columns('recommendation_state')]
 
     with engine.connect() as connection:
-        if 'sci_fi_movies' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN sci_fi_movies FLOAT'))
-        if 'cooking' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN cooking FLOAT'))
-        if 'hiking' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN hiking FLOAT'))
-        if 'travel' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN travel FLOAT'))
-        if 'reading' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN reading FLOAT'))
-        if 'sports' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN sports FLOAT'))
-        if 'music' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN music FLOAT'))
-        if 'photography' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN photography FLOAT'))
-        if 'gardening' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN gardening FLOAT'))
-        if 'video_games' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN video_games FLOAT'))
-        if 'board_games' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN board_games FLOAT'))
-        if 'diy_projects' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN diy_projects FLOAT'))
-        if 'volunteering' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN volunteering FLOAT'))
-        if 'movies' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN movies FLOAT'))
-        if 'podcasts' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN podcasts FLOAT'))
-        if 'social_media' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN social_media FLOAT'))
-        if 'pets' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN pets FLOAT'))
-        if 'workout' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN workout FLOAT'))
-        if 'meditation' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN meditation FLOAT'))
-        if 'travel_adventure' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN travel_adventure FLOAT'))
-        if 'music_instruments' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN music_instruments FLOAT'))
-        if 'arts_crafts' not in existing_columns:
-            connection.execute(text('ALTER TABLE users ADD COLUMN arts_crafts FLOAT'))
-        connection.commit()
\ No newline at end of file
+        if 'interest_vector' not in existing_columns:
+            connection.execute(text('ALTER TABLE users ADD COLUMN interest_vector BLOB'))
+        if 'model_hash' not in run_columns:
+            connection.execute(text('ALTER TABLE recommendation_runs ADD COLUMN model_hash VARCHAR(32)'))
+        if 'cluster_label' not in state_columns:
+            connection.execute(text('ALTER TABLE recommendation_state ADD COLUMN cluster_label INTEGER'))
+        if 'pruned_through' not in version_columns:
+            connection.execute(text(
+                'ALTER TABLE population_version ADD COLUMN pruned_through INTEGER NOT NULL DEFAULT 0'
+            ))
+
+        # Migrate scores from the legacy one-column-per-interest layout
+        legacy_fields = [field for field in INTEREST_FIELDS if field in existing_columns]
+        if legacy_fields:
+            rows = connection.execute(text(
+                f"SELECT id, {', '.join(legacy_fields)} FROM users WHERE interest_vector IS NULL"
+            )).all()
+            if rows:
+                connection.execute(
+                    text('UPDATE users SET interest_vector = :interest_vector WHERE id = :id'),
+                    [
+                        {'id': row[0], 'interest_vector': pack_interests(dict(zip(legacy_fields, row[1:])))}
+                        for row in rows
+                    ]
+                )
+
+        # The shared population version counter lives in a single row
+        connection.execute(text(
+            'INSERT INTO population_version (id, version, modified_at, pruned_through) '
+            'SELECT 1, 0, 0.0, 0 WHERE NOT EXISTS (SELECT 1 FROM population_version WHERE id = 1)'
+        ))
+        connection.commit()
+
+
+# Function to take the write lock before a read-modify-write on SQLite
+def begin_write(session):
+    """
+    Start the session's transaction with SQLite's write lock held, so rows
+    read next cannot change before the commit. SQLite ignores SELECT ... FOR
+    UPDATE, and pysqlite only starts a transaction at the first write, so a
+    read-then-write would otherwise overwrite a concurrent commit. A no-op
+    elsewhere: use with_for_update() on the SELECT there.
+    """
+    if session.get_bind().dialect.name == 'sqlite':
+        session.execute(text('UPDATE users SET id = id WHERE 0'))
+
+
+# Function to bump the shared population version after a write
+def bump_population_version(user_ids=(), session_factory=None):
+    """
+    Mark the population as changed for every worker. Call it after
+    committing a write to users' interests or a registration: it runs in a
+    short transaction of its own, so writers only hold the counter row's
+    lock for this one UPDATE rather than for their whole transaction.
+
+    The changed users are logged under the new version for workers catching
+    up (see read_population_changes); every 1000 versions the log is pruned
+    to the last POPULATION_CHANGE_RETENTION versions.
+
+    Args:
+    - user_ids (iterable): IDs of the users the write changed.
+    - session_factory (callable): Creates the session; defaults to SessionLocal.
+
+    Returns:
+    - int: The new version.
+    """
+    from models import PopulationChange, PopulationVersion
+    session = (session_factory or SessionLocal)()
+    try:
+        now = time.time()
+        result = session.execute(
+            update(PopulationVersion)
+            .where(PopulationVersion.id == 1)
+            .values(version=PopulationVersion.version + 1, modified_at=now)
+        )
+        if result.rowcount == 0:
+            session.add(PopulationVersion(id=1, version=1, modified_at=now, pruned_through=0))
+            session.flush()
+        version = session.query(PopulationVersion.version).filter_by(id=1).scalar()
+
+        user_ids = {int(user_id) for user_id in user_ids}
+        if user_ids:
+            session.execute(
+                insert(PopulationChange), [{'version': version, 'user_id': user_id} for user_id in user_ids]
+            )
+        if version % 1000 == 0 and version > POPULATION_CHANGE_RETENTION:
+            pruned_through = version - POPULATION_CHANGE_RETENTION
+            session.execute(delete(PopulationChange).where(PopulationChange.version <= pruned_through))
+            session.execute(
+                update(PopulationVersion).where(PopulationVersion.id == 1).values(pruned_through=pruned_through)
+            )
+        session.commit()
+        return version
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# Function to bump the shared population version without failing the caller
+def announce_population_change(user_ids=(), session_factory=None):
+    """
+    bump_population_version() for callers whose own write is already
+    committed: a failure is logged, and other workers see the change with
+    the next bump (or reload everything once the log is pruned past it).
+    """
+    try:
+        return bump_population_version(user_ids, session_factory)
+    except Exception as e:
+        logging.error(f"Could not bump the population version: {e}")
+        return None
+
+
+# Function to read the shared population version
+def read_population_version(session):
+    """
+    Returns:
+    - version (int): Bumped by every committed write to the population.
+    - modified_at (float): Unix time of that write.
+    """
+    from models import PopulationVersion
+    row = session.query(PopulationVersion.version, PopulationVersion.modified_at).filter_by(id=1).first()
+    return (row[0], row[1]) if row else (0, 0.0)
+
+
+# Function to read which users changed since a population version
+def read_population_changes(session, since):
+    """
+    Args:
+    - session (Session): The session to read with.
+    - since (int): The population version the caller is up to date with.
+
+    Returns:
+    - version (int): The current population version.
+    - user_ids (list): IDs of the users changed after `since`, or None if
+      the log no longer reaches back that far and everything must be reloaded.
+    """
+    from models import PopulationChange, PopulationVersion
+    row = session.query(PopulationVersion.version, PopulationVersion.pruned_through).filter_by(id=1).first()
+    version, pruned_through = row if row else (0, 0)
+    if version <= since:
+        return version, []
+    if pruned_through > since:
+        return version, None
+    rows = (
+        session.query(PopulationChange.user_id)
+        .filter(PopulationChange.version > since, PopulationChange.version <= version)
+        .distinct()
+        .all()
+    )
+    return version, [row[0] for row in rows]
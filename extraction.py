@@ -0,0 +1,246 @@
+# extraction.py
+
+import re
+from collections import namedtuple
+
+from interests import INTEREST_FIELDS
+
+# Keyword lexicon per interest field. 'core' keywords name the interest
+# itself, 'related' ones only hint at it, so they count for less relevance.
+# A keyword may only belong to one field; plurals are matched automatically.
+INTEREST_LEXICON = {
+    'sci_fi_movies': {
+        'core': ['sci-fi movie', 'sci fi movie', 'scifi movie', 'science fiction movie', 'sci-fi', 'scifi', 'sci fi',
+                 'science fiction'],
+        'related': ['star wars', 'star trek', 'dune', 'blade runner', 'alien', 'spaceship', 'cyberpunk'],
+    },
+    'cooking': {
+        'core': ['cooking', 'cook', 'baking', 'bake', 'chef'],
+        'related': ['recipe', 'kitchen', 'cuisine', 'grilling', 'barbecue', 'bbq', 'pastry', 'dinner party'],
+    },
+    'hiking': {
+        'core': ['hiking', 'hike', 'hiker', 'trekking', 'trek'],
+        'related': ['trail', 'mountain', 'backpacking', 'summit', 'nature walk'],
+    },
+    'travel': {
+        'core': ['travel', 'traveling', 'travelling', 'trip', 'vacation', 'holiday'],
+        'related': ['abroad', 'sightseeing', 'tourist', 'passport', 'road trip', 'new countries'],
+    },
+    'reading': {
+        'core': ['reading', 'read', 'book', 'novel', 'reader'],
+        'related': ['author', 'library', 'kindle', 'literature', 'poetry', 'fiction', 'book club'],
+    },
+    'sports': {
+        'core': ['sport', 'sports'],
+        'related': ['football', 'soccer', 'basketball', 'tennis', 'baseball', 'hockey', 'golf', 'cricket',
+                    'rugby', 'volleyball', 'league'],
+    },
+    'music': {
+        'core': ['music', 'song', 'album', 'concert'],
+        'related': ['singer', 'band', 'playlist', 'spotify', 'rock', 'pop', 'jazz', 'hip hop', 'rap',
+                    'classical', 'festival', 'singing'],
+    },
+    'photography': {
+        'core': ['photography', 'photographer', 'photo', 'taking pictures'],
+        'related': ['camera', 'lens', 'dslr', 'portrait', 'landscape shot', 'lightroom'],
+    },
+    'gardening': {
+        'core': ['gardening', 'garden', 'gardener'],
+        'related': ['plant', 'flower', 'vegetable patch', 'compost', 'greenhouse', 'houseplant'],
+    },
+    'video_games': {
+        'core': ['video game', 'videogame', 'gaming', 'gamer'],
+        'related': ['playstation', 'xbox', 'nintendo', 'console', 'steam', 'esports', 'minecraft', 'rpg'],
+    },
+    'board_games': {
+        'core': ['board game', 'boardgame', 'tabletop'],
+        'related': ['chess', 'monopoly', 'catan', 'card game', 'dungeons and dragons', 'd&d', 'puzzle'],
+    },
+    'diy_projects': {
+        'core': ['diy', 'do it yourself', 'home improvement'],
+        'related': ['woodworking', 'carpentry', 'renovation', 'building things', 'upcycling'],
+    },
+    'volunteering': {
+        'core': ['volunteering', 'volunteer', 'charity'],
+        'related': ['community service', 'nonprofit', 'non-profit', 'food bank', 'shelter', 'fundraiser'],
+    },
+    'movies': {
+        'core': ['movie', 'film', 'cinema'],
+        'related': ['actor', 'actress', 'director', 'netflix', 'blockbuster', 'documentary', 'theater'],
+    },
+    'podcasts': {
+        'core': ['podcast', 'podcasting'],
+        'related': ['audio show', 'talk show', 'listening to shows'],
+    },
+    'social_media': {
+        'core': ['social media', 'social network'],
+        'related': ['instagram', 'tiktok', 'twitter', 'facebook', 'youtube', 'reddit', 'influencer'],
+    },
+    'pets': {
+        'core': ['pet', 'pets'],
+        'related': ['dog', 'cat', 'puppy', 'kitten', 'hamster', 'rabbit', 'parrot', 'aquarium'],
+    },
+    'workout': {
+        'core': ['workout', 'working out', 'work out', 'exercise', 'fitness'],
+        'related': ['gym', 'lifting', 'weights', 'running', 'jogging', 'crossfit', 'cardio', 'pilates',
+                    'cycling', 'swimming'],
+    },
+    'meditation': {
+        'core': ['meditation', 'meditate', 'meditating', 'mindfulness'],
+        'related': ['yoga', 'breathing exercise', 'headspace', 'relaxation'],
+    },
+    'travel_adventure': {
+        'core': ['adventure travel', 'adventure'],
+        'related': ['skydiving', 'bungee', 'rafting', 'scuba', 'diving', 'climbing', 'safari', 'expedition',
+                    'camping', 'surfing'],
+    },
+    'music_instruments': {
+        'core': ['instrument', 'playing music', 'musician'],
+        'related': ['guitar', 'piano', 'drums', 'violin', 'bass', 'ukulele', 'saxophone', 'cello', 'keyboard',
+                    'flute'],
+    },
+    'arts_crafts': {
+        'core': ['arts and crafts', 'arts & crafts', 'crafts', 'crafting', 'art'],
+        'related': ['painting', 'drawing', 'sketching', 'knitting', 'sewing', 'pottery', 'sculpture',
+                    'scrapbooking', 'crochet'],
+    },
+}
+
+CORE_RELEVANCE = 1.0
+RELATED_RELEVANCE = 0.6
+
+# Sentiment cues in the same clause as the keyword, negations first. The
+# first cue found decides the score on the profile's 0-10 scale; a mention
+# with neither a cue nor a rating is not scored at all.
+NEGATIVE_SCORE = 2.0
+SENTIMENT_CUES = [
+    (NEGATIVE_SCORE, ["don't like", 'do not like', "don't enjoy", 'do not enjoy', 'dislike', 'hate', 'not into',
+                      'not a fan', 'not a big fan', 'not so much', "can't stand", 'cannot stand', 'never',
+                      'not really', 'not much', 'boring', 'not interested', 'no interest', 'zero interest',
+                      'not my thing', "don't care", 'do not care']),
+    (9.0, ['love', 'adore', 'obsessed', 'passionate', 'favorite', 'favourite', 'huge fan', 'big fan',
+           'really enjoy', 'really like', 'live for']),
+    (7.0, ['like', 'enjoy', 'into', 'fan of', 'fond of', 'keen on', 'interested in', 'do a lot of']),
+    (4.0, ['sometimes', 'occasionally', 'a bit', 'kind of', 'kinda', 'sort of', 'now and then', 'once in a while']),
+]
+
+# A negation shortly before a positive cue flips it, e.g. "don't really love"
+NEGATED = re.compile(r"(?:\b(?:not|no|never|hardly|zero)|n't)\s+(?:\w+\s+){0,2}$", re.IGNORECASE)
+
+# Clause boundaries: a cue only applies to keywords in its own clause
+CLAUSE_BREAK = re.compile(r"[.!?;,]|\bbut\b|\bhowever\b|\bthough\b")
+
+# An explicit rating right after the keyword, e.g. "hiking 8/10",
+# "Hiking? 8/10", "cooking is a 7 out of 10" or "gardening: 5"
+RATING = re.compile(
+    r"(?:\s*[?!])?[^.!?;,]{0,20}?\b(10|[0-9])(?:\s*/\s*10|\s+out\s+of\s+10)\b"
+    r"|\s*(?:(?:is|at)\s+|[:-]\s*)(?:(?:a|an|like|solid|about|around)\s+)*(10|[0-9])(?!\d|\.\d)",
+    re.IGNORECASE)
+
+InterestMatch = namedtuple('InterestMatch', ['interest', 'keyword', 'start', 'end', 'score', 'relevance'])
+
+
+def _alternation(phrases):
+    # Longest phrases first, so 'board game' wins over 'game' and 'sci fi' over 'fi'
+    escaped = (re.escape(phrase).replace(r'\ ', r'\s+') for phrase in sorted(phrases, key=len, reverse=True))
+    return '|'.join(escaped)
+
+
+class InterestExtractor:
+    """
+    Single-pass keyword matcher for interests mentioned in free text.
+
+    The whole lexicon is compiled into one regular expression at
+    construction, so a message is scanned once regardless of how many
+    keywords there are. Scores are deterministic: an explicit rating wins,
+    then a sentiment cue in the same clause (before the keyword, then after
+    it), with a negated positive cue counting as negative. A bare mention
+    ("I'm running late", "I don't have a pet") says nothing about how much
+    the user likes something, so it is not scored.
+    """
+
+    def __init__(self, lexicon=INTEREST_LEXICON):
+        self.keywords = {}  # keyword -> (interest, relevance)
+        for interest, groups in lexicon.items():
+            if interest not in INTEREST_FIELDS:
+                raise ValueError(f"Unknown interest in lexicon: {interest}")
+            for group, relevance in (('core', CORE_RELEVANCE), ('related', RELATED_RELEVANCE)):
+                for keyword in groups.get(group, ()):
+                    keyword = keyword.lower()
+                    if keyword in self.keywords and self.keywords[keyword][0] != interest:
+                        raise ValueError(f"Keyword '{keyword}' is listed for more than one interest")
+                    self.keywords[keyword] = (interest, relevance)
+
+        self.pattern = re.compile(
+            rf"(?<![\w-])({_alternation(self.keywords)})(?:e?s)?(?![\w-])", re.IGNORECASE)
+        self.cues = [
+            (score, re.compile(rf"(?<!\w)(?:{_alternation(phrases)})(?!\w)", re.IGNORECASE))
+            for score, phrases in SENTIMENT_CUES
+        ]
+
+    def _score(self, message, start, end):
+        rating = RATING.match(message, end)
+        if rating:
+            return float(rating.group(1) or rating.group(2))
+
+        # The clause up to the keyword, then the rest of the clause after it
+        clause_start = 0
+        for boundary in CLAUSE_BREAK.finditer(message, 0, start):
+            clause_start = boundary.end()
+        clause_end = CLAUSE_BREAK.search(message, end)
+        clause_end = clause_end.start() if clause_end else len(message)
+        for clause in (message[clause_start:start], message[end:clause_end]):
+            for score, cue in self.cues:
+                found = cue.search(clause)
+                if found:
+                    if score > NEGATIVE_SCORE and NEGATED.search(clause, 0, found.start()):
+                        return NEGATIVE_SCORE
+                    return score
+        return None
+
+    def extract(self, message):
+        """
+        Find the interests mentioned in a message.
+
+        Args:
+        - message (str): The user's message.
+
+        Returns:
+        - List of InterestMatch, at most one per interest (its most relevant
+          scored mention, the first one on ties), in order of appearance.
+        """
+        if not message:
+            return []
+        best = {}
+        for match in self.pattern.finditer(message):
+            keyword = ' '.join(match.group(1).lower().split())
+            interest, relevance = self.keywords[keyword]
+            if interest in best and best[interest].relevance >= relevance:
+                continue
+            score = self._score(message, match.start(), match.end())
+            if score is None:
+                continue
+            best[interest] = InterestMatch(interest, keyword, match.start(), match.end(), score, relevance)
+        return sorted(best.values(), key=lambda found: found.start)
+
+    def extract_batch(self, messages):
+        """
+        Run extract() over many messages, e.g. to reprocess stored transcripts.
+
+        Returns:
+        - List with one list of InterestMatch per message.
+        """
+        return [self.extract(message) for message in messages]
+
+
+# Built once at import; shared by every request
+interest_extractor = InterestExtractor()
+
+
+# Function to extract interest scores from a message
+def extract_interests(message):
+    """
+    Returns a dict of interest field -> score (0-10) for every interest the
+    message rates or expresses a sentiment about.
+    """
+    return {found.interest: found.score for found in interest_extractor.extract(message)}
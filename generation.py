@@ -0,0 +1,270 @@
+# generation.py
+
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class GenerationError(Exception):
+    """
+    Raised by a generation backend that could not produce a response.
+    """
+
+
+class DeadlineExceeded(GenerationError):
+    """
+    Raised when no response arrived before the caller's deadline.
+    """
+
+
+# Function to get huggingface_hub's error types without importing it
+def hf_http_errors():
+    """
+    Returns the errors the inference client raises for a failed request
+    (HfHubHTTPError, TextGenerationError such as OverloadedError for an
+    overloaded endpoint, and InferenceTimeoutError) once huggingface_hub has
+    been imported, else an empty tuple. Such an error can only be raised
+    after the import, and `except ()` matches nothing, so this is safe in an
+    except clause.
+    """
+    errors = sys.modules.get('huggingface_hub.errors')
+    if errors is None:
+        return ()
+    return errors.HfHubHTTPError, errors.TextGenerationError, errors.InferenceTimeoutError
+
+
+class GenerationBackend:
+    """
+    Interface for text generation backends used by the chat.
+    """
+
+    name = 'base'
+
+    def load(self):
+        """
+        Prepare the backend (e.g. load model weights). Called once at startup.
+        """
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        """
+        Generate a response. deadline is a time.monotonic() value after which
+        the caller stops waiting; backends that can give up early do so with
+        DeadlineExceeded, the others ignore it.
+        """
+        raise NotImplementedError
+
+    def generate_batch(self, prompts, max_new_tokens=200, deadline=None):
+        """
+        Generate responses for several prompts; backends that can run a real
+        batch override this. A prompt that failed on its own may have its
+        exception in place of the response, e.g. DeadlineExceeded for one
+        not answered before deadline.
+        """
+        results = []
+        for prompt in prompts:
+            if deadline is not None and time.monotonic() >= deadline:
+                results.append(DeadlineExceeded(f"No response from {self.name} within the deadline"))
+                continue
+            try:
+                results.append(self.generate(prompt, max_new_tokens=max_new_tokens, deadline=deadline))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stream(self, prompt, max_new_tokens=200):
+        """
+        Yield the response in chunks; by default the whole response at once.
+        """
+        yield self.generate(prompt, max_new_tokens=max_new_tokens)
+
+
+class HuggingFaceBackend(GenerationBackend):
+    """
+    Remote generation through the Hugging Face InferenceClient.
+
+    HTTP errors are raised as HfHubHTTPError so retry_api_call can retry
+    them; transport errors become GenerationError and go to the fallback.
+    huggingface_hub is imported and the client created on first use (or by
+    load()), keeping both off the worker's startup path.
+    """
+
+    name = 'huggingface'
+
+    def __init__(self, model, token=None, timeout=None, max_concurrency=16):
+        self.model = model
+        self.token = token
+        self.timeout = timeout
+        self._client = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='hf-generation')
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    from huggingface_hub import InferenceClient
+                    self._client = InferenceClient(self.model, token=self.token, timeout=self.timeout)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def load(self):
+        self.client
+
+    def _call(self, prompt, max_new_tokens, stream=False):
+        try:
+            return self.client.text_generation(prompt, max_new_tokens=max_new_tokens, stream=stream)
+        except hf_http_errors():
+            raise
+        except Exception as e:
+            # Transport errors (e.g. the endpoint is unreachable) are not HTTP errors
+            raise GenerationError(f"Inference request failed: {e}") from e
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        # A single call is bounded by the client's timeout
+        return self._call(prompt, max_new_tokens)
+
+    def generate_batch(self, prompts, max_new_tokens=200, deadline=None):
+        # The Inference API takes one prompt per call, so a batch is sent as
+        # concurrent calls over the client's shared connection pool
+        futures = [self.executor.submit(self.generate, prompt, max_new_tokens) for prompt in prompts]
+        wait(futures, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        results = []
+        for future in futures:
+            if not future.done():
+                future.cancel()  # Calls still queued for the pool are not sent at all
+                results.append(DeadlineExceeded(f"No response from {self.name} within the deadline"))
+                continue
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stream(self, prompt, max_new_tokens=200):
+        return self._iterate(self._call(prompt, max_new_tokens, stream=True))
+
+    def _iterate(self, tokens):
+        # The connection can also fail while the stream is being read
+        try:
+            yield from tokens
+        except hf_http_errors():
+            raise
+        except Exception as e:
+            raise GenerationError(f"Inference stream failed: {e}") from e
+
+
+class RuleBasedBackend(GenerationBackend):
+    """
+    Keyword rules returning canned responses; needs no model at all.
+    """
+
+    name = 'rules'
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        if "greeting" in prompt.lower():
+            return "Hello! I'm here to help create your user profile. Shall we begin?"
+        elif "ready to proceed" in prompt.lower():
+            return "Great! Let's start with your first interest. How much do you enjoy reading on a scale of 1 to 10?"
+        elif "next question" in prompt.lower():
+            interests = ["sports", "music", "cooking", "travel", "movies"]
+            return f"How much do you enjoy {random.choice(interests)} on a scale of 1 to 10?"
+        elif "profile complete" in prompt.lower():
+            return "Your profile is now complete. Is there anything else you'd like to know?"
+        else:
+            return "I understand. Let's move on to the next question."
+
+
+class LocalBackend(GenerationBackend):
+    """
+    Small causal language model running on the CPU via transformers.
+
+    The model is loaded once and its Linear layers are quantized to int8.
+    generate_batch() runs all prompts through one padded forward pass; wrap
+    the backend in batching.BatchingBackend so concurrent chats share it.
+    """
+
+    name = 'local'
+
+    def __init__(self, model_name, quantize=True, num_threads=None):
+        self.model_name = model_name
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.model = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.model is not None:
+                return
+            # Optional dependencies, only needed for this backend
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
+            if self.num_threads:
+                torch.set_num_threads(self.num_threads)
+            start = time.time()
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name, padding_side='left')
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+            model.eval()
+            if self.quantize:
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            self.tokenizer = tokenizer
+            self.model = model
+            logging.info(f"Loaded local model {self.model_name} in {time.time() - start:.1f}s")
+
+    def generate_batch(self, prompts, max_new_tokens=200, deadline=None):
+        # One forward pass cannot be cut short, so the deadline is not used;
+        # the batcher leaves out prompts whose callers already gave up
+        import torch
+
+        self.load()
+        try:
+            inputs = self.tokenizer(list(prompts), return_tensors='pt', padding=True)
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
+        except Exception as e:
+            raise GenerationError(f"Local generation failed: {e}") from e
+        # Only decode the newly generated tokens
+        new_tokens = outputs[:, inputs['input_ids'].shape[1]:]
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        return self.generate_batch([prompt], max_new_tokens=max_new_tokens)[0]
+
+
+def create_backend(name, **options):
+    """
+    Create a generation backend by name.
+
+    Args:
+    - name (str): 'huggingface', 'local' or 'rules'.
+    - options: Backend options, e.g. model, token and timeout for 'huggingface',
+      model_name and num_threads for 'local'.
+    """
+    if name == 'huggingface':
+        return HuggingFaceBackend(options['model'], token=options.get('token'), timeout=options.get('timeout'))
+    elif name == 'local':
+        return LocalBackend(
+            options['model_name'],
+            quantize=options.get('quantize', True),
+            num_threads=options.get('num_threads'),
+        )
+    elif name == 'rules':
+        return RuleBasedBackend()
+    raise ValueError(f"Unknown generation backend: {name}")
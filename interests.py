@@ -0,0 +1,123 @@
+# interests.py
+
+import numpy as np
+
+# Interest catalog: (field name, display label). The order defines the
+# position of each interest in every packed vector, so new interests must be
+# appended at the end; stored vectors from before are padded on read.
+INTEREST_CATALOG = [
+    ('sci_fi_movies', 'Sci-fi Movies'),
+    ('cooking', 'Cooking'),
+    ('hiking', 'Hiking'),
+    ('travel', 'Travel'),
+    ('reading', 'Reading'),
+    ('sports', 'Sports'),
+    ('music', 'Music'),
+    ('photography', 'Photography'),
+    ('gardening', 'Gardening'),
+    ('video_games', 'Video Games'),
+    ('board_games', 'Board Games'),
+    ('diy_projects', 'DIY Projects'),
+    ('volunteering', 'Volunteering'),
+    ('movies', 'Movies'),
+    ('podcasts', 'Podcasts'),
+    ('social_media', 'Social Media'),
+    ('pets', 'Pets'),
+    ('workout', 'Workout'),
+    ('meditation', 'Meditation'),
+    ('travel_adventure', 'Adventure Travel'),
+    ('music_instruments', 'Playing Musical Instruments'),
+    ('arts_crafts', 'Arts & Crafts'),
+]
+
+INTEREST_FIELDS = [field for field, _ in INTEREST_CATALOG]
+INTEREST_LABELS = dict(INTEREST_CATALOG)
+INTEREST_POSITIONS = {field: i for i, field in enumerate(INTEREST_FIELDS)}
+INTEREST_DIM = len(INTEREST_FIELDS)
+
+# Packed vectors are little-endian float32; NaN marks an interest never set
+INTEREST_DTYPE = np.dtype('<f4')
+
+
+# Function to decode a packed interest vector
+def unpack_interests(blob):
+    """
+    Decode a packed interest vector.
+
+    Args:
+    - blob (bytes): The stored vector, or None for a user without interests.
+
+    Returns:
+    - np.ndarray: float32 vector of length INTEREST_DIM with NaN for unset
+      interests. Zero-copy (read-only) unless the stored vector predates
+      interests added to the catalog.
+    """
+    if not blob:
+        return np.full(INTEREST_DIM, np.nan, dtype=INTEREST_DTYPE)
+    vector = np.frombuffer(blob, dtype=INTEREST_DTYPE)
+    if len(vector) < INTEREST_DIM:
+        padded = np.full(INTEREST_DIM, np.nan, dtype=INTEREST_DTYPE)
+        padded[:len(vector)] = vector
+        return padded
+    return vector[:INTEREST_DIM]
+
+
+# Function to encode interest values as a packed vector
+def pack_interests(values):
+    """
+    Encode interest values as packed float32 bytes.
+
+    Args:
+    - values: A vector in catalog order, or a dict of field -> value
+      (missing fields and None are stored as unset).
+
+    Returns:
+    - bytes: The packed vector.
+    """
+    if isinstance(values, dict):
+        vector = np.full(INTEREST_DIM, np.nan, dtype=INTEREST_DTYPE)
+        for field, value in values.items():
+            if value is not None:
+                vector[INTEREST_POSITIONS[field]] = float(value)
+    else:
+        vector = np.asarray(values, dtype=INTEREST_DTYPE)
+    return vector.tobytes()
+
+
+# Function to decode many packed vectors into one matrix
+def unpack_interest_matrix(blobs):
+    """
+    Decode packed vectors into an (n, INTEREST_DIM) float32 matrix with unset
+    interests as 0.
+
+    When every vector is complete the blobs are decoded with a single
+    np.frombuffer call over their concatenation.
+    """
+    full_size = INTEREST_DIM * INTEREST_DTYPE.itemsize
+    if all(blob is not None and len(blob) == full_size for blob in blobs):
+        matrix = np.frombuffer(b''.join(blobs), dtype=INTEREST_DTYPE).reshape(len(blobs), INTEREST_DIM)
+    else:
+        matrix = np.array([unpack_interests(blob) for blob in blobs], dtype=INTEREST_DTYPE).reshape(-1, INTEREST_DIM)
+    return np.nan_to_num(matrix, nan=0.0).astype(np.float32, copy=False)
+
+
+class InterestAttribute:
+    """
+    Descriptor exposing one interest of the packed vector as a plain attribute,
+    so user.hiking reads and writes the 'hiking' slot of user.interest_vector.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.position = INTEREST_POSITIONS[field]
+
+    def __get__(self, user, owner=None):
+        if user is None:
+            return self
+        value = unpack_interests(user.interest_vector)[self.position]
+        return None if np.isnan(value) else float(value)
+
+    def __set__(self, user, value):
+        vector = unpack_interests(user.interest_vector).copy()
+        vector[self.position] = np.nan if value is None else float(value)
+        user.interest_vector = vector.tobytes()
@@ -0,0 +1,446 @@
+# loadtest.py
+"""
+End-to-end load test for the chat and recommendation routes.
+
+Boots the app on a scratch database against a local stand-in for the
+Hugging Face inference server, lets many simulated users register, log in,
+chat through every conversation state and fetch their connections, and
+reports throughput, latency percentiles and error rates per route:
+
+    python loadtest.py --users 50 --duration 60
+    python loadtest.py --fake-latency-ms 800 --fake-error-rate 0.1 --output load.json
+
+To load-test an app running elsewhere (e.g. under gunicorn), run only the
+fake server, start the app with HF_MODEL pointing at it, and drive the app:
+
+    python loadtest.py --fake-only --fake-port 8081
+    HF_MODEL=http://127.0.0.1:8081 gunicorn -w 4 'app:create_app()'
+    python loadtest.py --app-url http://127.0.0.1:8000 --users 200
+"""
+
+import argparse
+import http.cookiejar
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from extraction import INTEREST_LEXICON
+from interests import INTEREST_FIELDS
+
+
+class FakeInferenceHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeInference/1.0'
+
+    def do_POST(self):
+        fake = self.server.fake
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        latency, fail, text = fake.plan(payload.get('inputs', ''))
+
+        if fail:
+            time.sleep(latency)
+            self._send_json(503, {'error': 'Model is overloaded', 'error_type': 'overloaded'})
+        elif payload.get('stream'):
+            self._stream(text, latency)
+        else:
+            time.sleep(latency)
+            self._send_json(200, [{'generated_text': text}])
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, text, latency):
+        # The first token takes a third of the latency, the rest arrive evenly
+        tokens = [token + ' ' for token in text.split(' ')]
+        tokens[-1] = tokens[-1][:-1]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        time.sleep(latency / 3)
+        for i, token in enumerate(tokens):
+            event = {'index': i, 'token': {'id': i, 'text': token, 'logprob': 0.0, 'special': False},
+                     'generated_text': None, 'details': None}
+            self.wfile.write(f"data:{json.dumps(event)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(latency * 2 / 3 / len(tokens))
+        final = {'index': len(tokens), 'token': {'id': len(tokens), 'text': '', 'logprob': 0.0, 'special': True},
+                 'generated_text': text, 'details': None}
+        self.wfile.write(f"data:{json.dumps(final)}\n\n".encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeInferenceServer:
+    """
+    Local stand-in for a Hugging Face text-generation endpoint.
+
+    Speaks the protocol InferenceClient uses for an endpoint URL: a JSON POST
+    of inputs, parameters and stream, answered with [{"generated_text": ...}]
+    or, when streaming, server-sent events carrying one token each. Latency
+    is log-normal around latency_ms, error_rate of the requests get a 503,
+    and replies follow the app's prompt for each conversation state,
+    including the INTERNAL_NOTE line in asking_questions.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=300, latency_sigma=0.5, error_rate=0.0,
+                 end_rate=0.2, seed=None):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.end_rate = end_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.httpd = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.httpd.server_port}"
+
+    def reply(self, prompt):
+        """
+        Return a plausible reply to one of the app's chat prompts.
+        """
+        field = self.rng.choice(INTEREST_FIELDS)
+        if 'friendly greeting' in prompt:
+            return "Hey there! Ready to chat a bit about the things you enjoy?"
+        elif 'to your greeting' in prompt:
+            return f"Awesome, let's begin! Tell me about {field.replace('_', ' ')}: how much do you enjoy it?"
+        elif 'INTERNAL_NOTE' in prompt:
+            if self.rng.random() < self.end_rate:
+                question = "Thanks, that's everything I needed. Profile complete!"
+            else:
+                question = f"By the way, how much do you enjoy {self.rng.choice(INTEREST_FIELDS).replace('_', ' ')} on a scale of 1-10?"
+            return f"{question}\nINTERNAL_NOTE: Interest: {field}, Value: {self.rng.randint(1, 10)}"
+        return "All done, your profile is complete. Anything else I can help with?"
+
+    def plan(self, prompt):
+        """
+        Decide latency, failure and reply text for one request.
+
+        Returns:
+        - latency (float): Seconds to wait before answering.
+        - fail (bool): True to answer with a 503.
+        - text (str): The reply.
+        """
+        with self.lock:
+            self.requests += 1
+            latency = self.rng.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma)
+            fail = self.rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            text = self.reply(prompt)
+        return latency, fail, text
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), FakeInferenceHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        threading.Thread(target=self.httpd.serve_forever, name='fake-inference', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors}
+
+
+class RouteStats:
+    """
+    Latencies and outcomes of every request, per route.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.statuses = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def record(self, route, seconds, status, ok):
+        with self.lock:
+            self.latencies[route].append(seconds)
+            self.statuses[route][str(status)] += 1
+            if not ok:
+                self.errors[route] += 1
+
+    def report(self, elapsed):
+        """
+        Returns:
+        - List of per-route dicts with requests, errors, error_rate,
+          throughput (requests/s) and latency percentiles in milliseconds.
+        """
+        rows = []
+        with self.lock:
+            for route in sorted(self.latencies):
+                latencies = np.array(self.latencies[route]) * 1000
+                p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+                rows.append({
+                    'route': route,
+                    'requests': len(latencies),
+                    'errors': self.errors[route],
+                    'error_rate': self.errors[route] / len(latencies),
+                    'throughput': len(latencies) / elapsed,
+                    'p50_ms': float(p50),
+                    'p90_ms': float(p90),
+                    'p99_ms': float(p99),
+                    'max_ms': float(latencies.max()),
+                    'statuses': dict(self.statuses[route]),
+                })
+        return rows
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Redirects are recorded as responses, not followed
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class SimulatedUser:
+    """
+    One logged-in user with its own cookie jar, running scripted sessions.
+    """
+
+    def __init__(self, base_url, name, stats, rng, stream_ratio=0.0, max_turns=12):
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.stats = stats
+        self.rng = rng
+        self.stream_ratio = stream_ratio
+        self.max_turns = max_turns
+        self.etags = {}
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, route, path, form=None, json_body=None, headers=None, ok_statuses=(200,)):
+        headers = dict(headers or {})
+        data = None
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            data = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=120) as response:
+                body, status, response_headers = response.read(), response.status, response.headers
+        except urllib.error.HTTPError as e:
+            body, status, response_headers = e.read(), e.code, e.headers
+        except OSError as e:
+            body, status, response_headers = b'', type(e).__name__, {}
+        self.stats.record(route, time.perf_counter() - start, status, status in ok_statuses)
+        return status, body, response_headers
+
+    def message_for(self, conversation_state):
+        if conversation_state == 'start':
+            return self.rng.choice(['Hi!', 'Hello there', 'hey'])
+        elif conversation_state == 'ready_check':
+            return self.rng.choice(["Sure, let's do it", 'Yes, ready!', 'ok, go ahead'])
+        elif conversation_state == 'asking_questions':
+            keyword = self.rng.choice(INTEREST_LEXICON[self.rng.choice(list(INTEREST_LEXICON))]['core'])
+            rating = self.rng.randint(1, 10)
+            return self.rng.choice([
+                f"I love {keyword}", f"{keyword} is a {rating} out of 10 for me", f"not really into {keyword}",
+                f"I'd say {keyword} {rating}/10", f"I sometimes do {keyword}, but I hate crowds",
+            ])
+        return 'Thanks, bye!'
+
+    def chat_turn(self, conversation_state):
+        message = self.message_for(conversation_state)
+        body = {'message': message, 'conversation_state': conversation_state}
+        if self.rng.random() < self.stream_ratio:
+            status, data, _ = self.request('POST /chat_api/stream', '/chat_api/stream', json_body=body)
+            done = [event for event in data.decode('utf-8').split('\n\n') if event.startswith('event: done')]
+            if status != 200 or not done:
+                return None
+            return json.loads(done[-1].split('data: ', 1)[1])['conversation_state']
+        status, data, _ = self.request('POST /chat_api', '/chat_api', json_body=body)
+        return json.loads(data)['conversation_state'] if status == 200 else None
+
+    def fetch(self, route):
+        # Revalidate with the last ETag, the way a browser would
+        headers = {'If-None-Match': self.etags[route]} if route in self.etags else {}
+        status, _, response_headers = self.request(f"GET {route}", route, headers=headers, ok_statuses=(200, 304))
+        if response_headers and response_headers.get('ETag'):
+            self.etags[route] = response_headers['ETag']
+
+    def register(self):
+        self.request('POST /register', '/register', form={
+            'username': self.name, 'email': f"{self.name}@example.com", 'password': 'loadtest'},
+            ok_statuses=(302,))
+
+    def session(self):
+        """
+        Log in, chat from 'start' through 'end', look at connections, log out.
+        """
+        status, _, _ = self.request('POST /login', '/login', form={'username': self.name, 'password': 'loadtest'},
+                                    ok_statuses=(302,))
+        if status != 302:
+            return
+
+        conversation_state = 'start'
+        for _ in range(self.max_turns):
+            next_state = self.chat_turn(conversation_state)
+            if next_state is None or conversation_state == 'end':
+                break
+            conversation_state = next_state
+
+        for route in ('/connections', '/find_similar_users', '/connections'):
+            self.fetch(route)
+        self.request('POST /logout', '/logout', form={})
+
+
+# Function to boot the app in this process on a scratch database
+def boot_app(workdir, fake_url, population, seed, port=0):
+    """
+    Returns:
+    - str: Base URL of the running app.
+    """
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    # Point the app at the scratch files and the fake server before it is imported
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+    os.environ['HF_MODEL'] = fake_url
+    os.environ['GENERATION_BACKEND'] = 'huggingface'
+    os.environ['WRITE_BEHIND_JOURNAL_DIR'] = os.path.join(workdir, 'journal')
+    os.environ['CLUSTER_MODEL_PATH'] = os.path.join(workdir, 'kmeans.joblib')
+    os.environ.setdefault('SECRET_KEY', 'loadtest')
+
+    from database import engine, init_db
+    init_db()
+    if population:
+        from benchmark import seed_users
+        seed_users(engine, population, seed)
+
+    import app as appmod
+    server = make_server('127.0.0.1', port, appmod.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+# Function to drive the app with simulated users for a fixed time
+def run_load(base_url, users, duration, ramp_up, stream_ratio, seed):
+    """
+    Returns:
+    - stats (RouteStats): Per-route measurements.
+    - elapsed (float): Wall time of the run in seconds.
+    """
+    stats = RouteStats()
+    run_id = f"{int(time.time()) % 100000:05d}"
+    stop_at = time.monotonic() + ramp_up + duration
+
+    def drive(i):
+        time.sleep(ramp_up * i / max(users, 1))
+        user = SimulatedUser(base_url, f"load{run_id}_{i}", stats, random.Random(seed + i), stream_ratio)
+        user.register()
+        while time.monotonic() < stop_at:
+            user.session()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=drive, args=(i,), name=f'user-{i}', daemon=True) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.monotonic() - started
+
+
+def print_report(rows):
+    print(f"{'route':<26}{'requests':>9}{'errors':>8}{'err%':>7}{'req/s':>9}"
+          f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for row in rows:
+        print(f"{row['route']:<26}{row['requests']:>9}{row['errors']:>8}{row['error_rate'] * 100:>6.1f}%"
+              f"{row['throughput']:>9.1f}{row['p50_ms']:>10.1f}{row['p90_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load-test the app against a fake inference server.')
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which users start')
+    parser.add_argument('--stream-ratio', type=float, default=0.3, help='share of chat turns using /chat_api/stream')
+    parser.add_argument('--population', type=int, default=1000, help='synthetic users seeded before the run')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--app-url', help='drive an already running app instead of booting one')
+    parser.add_argument('--fake-only', action='store_true', help='only run the fake inference server')
+    parser.add_argument('--fake-port', type=int, default=0)
+    parser.add_argument('--fake-latency-ms', type=float, default=300, help='median generation latency')
+    parser.add_argument('--fake-latency-sigma', type=float, default=0.5, help='log-normal spread of the latency')
+    parser.add_argument('--fake-error-rate', type=float, default=0.0, help='share of generation requests failing')
+    parser.add_argument('--fake-end-rate', type=float, default=0.2, help='chance a question ends the profile')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--max-error-rate', type=float, help='exit non-zero if any route has more errors')
+    args = parser.parse_args(argv)
+
+    fake = FakeInferenceServer(port=args.fake_port, latency_ms=args.fake_latency_ms,
+                               latency_sigma=args.fake_latency_sigma, error_rate=args.fake_error_rate,
+                               end_rate=args.fake_end_rate, seed=args.seed)
+    if args.fake_only or not args.app_url:
+        fake.start()
+        print(f"Fake inference server at {fake.url}")
+    if args.fake_only:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return 0
+
+    base_url = args.app_url or boot_app(tempfile.mkdtemp(prefix='interweave-load-'), fake.url, args.population, args.seed)
+    print(f"Driving {base_url} with {args.users} users for {args.duration:.0f}s")
+    stats, elapsed = run_load(base_url, args.users, args.duration, args.ramp_up, args.stream_ratio, args.seed)
+
+    rows = stats.report(elapsed)
+    print_report(rows)
+    report = {
+        'meta': {'timestamp': time.time(), 'users': args.users, 'elapsed': elapsed, 'app_url': args.app_url,
+                 'fake_latency_ms': args.fake_latency_ms, 'fake_error_rate': args.fake_error_rate},
+        'routes': rows,
+    }
+    if fake.httpd is not None:
+        report['fake_inference'] = fake.stats()
+        print(f"Fake inference server: {report['fake_inference']}")
+    if not args.app_url:
+        import app as appmod
+        report['llm_cache'] = appmod.llm_cache.stats()
+        report['circuit'] = appmod.generation_backend.stats()
+        print(f"LLM cache: {report['llm_cache']}  circuit: {report['circuit']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    if args.max_error_rate is not None and any(row['error_rate'] > args.max_error_rate for row in rows):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+# metrics.py
+
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Metrics are only recorded when enabled, so they cost a single attribute
+# check per call when nobody scrapes /metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_noop_timer = nullcontext()
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels.
+    """
+
+    type = 'counter'
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in values.items()]
+
+
+class Gauge:
+    """
+    Value that can go up and down, optionally split by labels.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def set(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in values.items()]
+
+
+class _HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets, optionally split by labels.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        """
+        Context manager observing the duration of its block in seconds.
+        """
+        if not self.registry.enabled:
+            return _noop_timer
+        return _HistogramTimer(self, labels)
+
+    def render(self):
+        with self.lock:
+            values = {key: list(state) for key, state in self.values.items()}
+        lines = []
+        for key, state in values.items():
+            for bound, count in zip(self.buckets, state):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", bound))} {count}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", "+Inf"))} {state[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}')
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(self, name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, labelnames=()):
+        metric = Gauge(self, name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Request and stage latencies
+STARTUP_SECONDS = registry.histogram(
+    'interweave_startup_seconds', 'Time from importing the app to the end of create_app().')
+REQUEST_SECONDS = registry.histogram(
+    'interweave_request_seconds', 'Request latency by route.', ['route', 'status'])
+CHAT_STAGE_SECONDS = registry.histogram(
+    'interweave_chat_stage_seconds', 'Time spent in each stage of chat_api.', ['stage'])
+RECOMMENDATION_STAGE_SECONDS = registry.histogram(
+    'interweave_recommendation_stage_seconds', 'Time spent in each stage of the recommendation path.', ['stage'])
+SHARD_TIMEOUTS = registry.counter(
+    'interweave_shard_timeouts_total', 'Similarity queries a shard did not answer before the deadline.', ['shard'])
+SHARD_ERRORS = registry.counter(
+    'interweave_shard_errors_total', 'Similarity queries a shard failed to answer.', ['shard'])
+ANN_RECALL = registry.gauge(
+    'interweave_ann_recall', 'recall@10 of the ANN index against exact search, last measured.', ['kind'])
+ANN_N_PROBE = registry.gauge(
+    'interweave_ann_n_probe', 'Inverted lists probed per ANN query.')
+ATTRIBUTE_FILTER_QUERIES = registry.counter(
+    'interweave_attribute_filter_queries_total', 'Filtered similarity searches by candidate plan (sorted, bitmap).',
+    ['plan'])
+RESPONSE_CACHE_REQUESTS = registry.counter(
+    'interweave_response_cache_requests_total',
+    'Conditional recommendation responses by route and result (not_modified, hit, miss).', ['route', 'result'])
+
+# Text generation
+LLM_CACHE_REQUESTS = registry.counter(
+    'interweave_llm_cache_requests_total', 'LLM response cache lookups.', ['result'])
+LLM_RETRIES = registry.counter(
+    'interweave_llm_retries_total', 'Retried text generation calls.')
+LLM_FALLBACKS = registry.counter(
+    'interweave_llm_fallbacks_total', 'Replies produced by fallback_text_generation.')
+HF_ERRORS = registry.counter(
+    'interweave_hf_errors_total', 'HfHubHTTPError raised by the inference client, by HTTP status.', ['status'])
+LLM_CIRCUIT_TRANSITIONS = registry.counter(
+    'interweave_llm_circuit_transitions_total', 'Generation circuit breaker state changes, by new state.', ['state'])
+LLM_CIRCUIT_REJECTIONS = registry.counter(
+    'interweave_llm_circuit_rejections_total', 'Generation calls refused while the circuit was open.')
+LLM_HEDGED_REQUESTS = registry.counter(
+    'interweave_llm_hedged_requests_total', 'Hedged generation requests issued, won and lost.', ['result'])
+LLM_DEADLINES_EXCEEDED = registry.counter(
+    'interweave_llm_deadlines_exceeded_total', 'Generation calls abandoned at their deadline.')
+GENERATION_BATCH_SIZE = registry.histogram(
+    'interweave_generation_batch_size', 'Prompts per dispatched generation batch.',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+GENERATION_QUEUE_DELAY = registry.histogram(
+    'interweave_generation_queue_delay_seconds', 'Time prompts wait in the batcher before dispatch.')
+
+# Database
+WRITE_BEHIND_FLUSH_SECONDS = registry.histogram(
+    'interweave_write_behind_flush_seconds', 'Time to write one batch of buffered interest updates.')
+WRITE_BEHIND_UPDATES = registry.counter(
+    'interweave_write_behind_updates_total', 'Buffered interest updates written to the database.')
+BATCH_UPDATE_ITEMS = registry.counter(
+    'interweave_batch_update_items_total', 'Items received by /update_profiles, by outcome (ok, error).', ['status'])
+DB_SESSIONS = registry.counter(
+    'interweave_db_sessions_total', 'Database session transactions opened and closed.', ['event'])
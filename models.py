@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, LargeBinary, Text, Float
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String, LargeBinary, Text
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from database import Base
+from interests import INTEREST_FIELDS, InterestAttribute
 
 
 class User(Base, UserMixin):
@@ -15,29 +16,8 @@ class User(Base, UserMixin):
     interests = Column(Text, nullable=True)
     embedding = Column(LargeBinary, nullable=True)
 
-    # New columns
-    sci_fi_movies = Column(Float, nullable=True)
-    cooking = Column(Float, nullable=True)
-    hiking = Column(Float, nullable=True)
-    travel = Column(Float, nullable=True)
-    reading = Column(Float, nullable=True)
-    sports = Column(Float, nullable=True)
-    music = Column(Float, nullable=True)
-    photography = Column(Float, nullable=True)
-    gardening = Column(Float, nullable=True)
-    video_games = Column(Float, nullable=True)
-    board_games = Column(Float, nullable=True)
-    diy_projects = Column(Float, nullable=True)
-    volunteering = Column(Float, nullable=True)
-    movies = Column(Float, nullable=True)
-    podcasts = Column(Float, nullable=True)
-    social_media = Column(Float, nullable=True)
-    pets = Column(Float, nullable=True)
-    workout = Column(Float, nullable=True)
-    meditation = Column(Float, nullable=True)
-    travel_adventure = Column(Float, nullable=True)
-    music_instruments = Column(Float, nullable=True)
-    arts_crafts = Column(Float, nullable=True)
+    # Interest scores, packed as float32 in the order of interests.INTEREST_FIELDS
+    interest_vector = Column(LargeBinary, nullable=True)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -63,3 +43,87 @@ class User(Base, UserMixin):
     # Flask-Login requires this method to return the user ID.
     def get_id(self):
         return str(self.id)
+
+
+class Recommendation(Base):
+    """
+    One precomputed neighbour of a user, written by recommendations_job.py.
+    """
+    __tablename__ = 'recommendations'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    recommended_user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    similarity = Column(Float, nullable=False)
+
+
+class RecommendationState(Base):
+    """
+    Hash of the interest vector each user's recommendations were computed from.
+    """
+    __tablename__ = 'recommendation_state'
+
+    user_id = Column(Integer, primary_key=True)
+    vector_hash = Column(String(32), nullable=False)
+    cluster_label = Column(Integer, nullable=True)  # Cluster at that time, in the job's stable numbering
+    computed_at = Column(Float, nullable=False)
+
+
+class PopulationVersion(Base):
+    """
+    Single-row counter bumped right after every committed write to the
+    users' interests or registrations, so every worker sees the same
+    population version (see database.bump_population_version).
+    """
+    __tablename__ = 'population_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified_at = Column(Float, nullable=False, default=0.0)
+    pruned_through = Column(Integer, nullable=False, default=0)  # population_changes kept after this version
+
+
+class PopulationChange(Base):
+    """
+    The users each population version changed, so a worker can reload just
+    those rows of its index (see UserVectorIndex.sync).
+    """
+    __tablename__ = 'population_changes'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    version = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
+
+
+class RecommendationRun(Base):
+    __tablename__ = 'recommendation_runs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    started_at = Column(Float, nullable=False)
+    finished_at = Column(Float, nullable=True)
+    model_fitted_at = Column(Float, nullable=True)  # Clustering model the run used
+    model_hash = Column(String(32), nullable=True)  # Digest of that model's parameters
+    full = Column(Boolean, nullable=False, default=False)
+    users_computed = Column(Integer, nullable=False, default=0)
+
+
+class CachedUser(UserMixin):
+    """
+    Slim, detached user record for Flask-Login's current_user.
+
+    Holds only what most requests need, so it can live in the identity cache;
+    routes that need interests or the password hash load the full User.
+    """
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+    def to_dict(self):
+        return {'id': self.id, 'username': self.username, 'email': self.email}
+
+
+# Expose each interest as an attribute backed by the packed vector (e.g. user.hiking)
+for interest_field in INTEREST_FIELDS:
+    setattr(User, interest_field, InterestAttribute(interest_field))
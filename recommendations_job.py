@@ -0,0 +1,355 @@
+# recommendations_job.py
+"""
+Offline job that materializes every user's recommendations.
+
+Reads all interest vectors, ranks each user's cluster mates by cosine
+similarity in parallel chunks on a process pool, and bulk-writes the top k
+to the recommendations table, which /connections and /find_similar_users
+serve from:
+
+    python recommendations_job.py                # incremental
+    python recommendations_job.py --full --workers 8
+
+An incremental run only recomputes users whose vector or cluster changed
+since their last run, plus users whose stored neighbours changed. A changed
+user can also become a new neighbour of unchanged users, which only a full
+run picks up, so schedule one regularly (e.g. nightly).
+
+Refits renumber and nudge clusters without necessarily moving anyone, so
+the job does not compare models: it matches the current clusters to the
+labels stored by the previous run and keeps those labels. Users who really
+moved are recomputed like changed users; a run is only forced full when
+more than FULL_RUN_MOVED_SHARE of the users moved.
+"""
+
+import argparse
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import MetaData, delete, insert, select
+
+from ann_index import normalize_rows
+
+# Work per matrix product block, in similarity scores, to bound memory
+BLOCK_SCORES = 2 ** 24
+
+# Share of users changing cluster above which an incremental run turns full
+FULL_RUN_MOVED_SHARE = float(os.getenv('RECOMMENDATIONS_FULL_RUN_MOVED_SHARE', 0.05))
+
+_worker = {}
+
+
+def _init_worker(normalized, labels, user_ids, top_k):
+    _worker['normalized'] = normalized
+    _worker['labels'] = labels
+    _worker['user_ids'] = user_ids
+    _worker['top_k'] = top_k
+    _worker['members'] = {label: np.flatnonzero(labels == label) for label in np.unique(labels)}
+
+
+# Function to rank the cluster mates of a chunk of users
+def _compute_chunk(rows):
+    normalized = _worker['normalized']
+    labels = _worker['labels']
+    user_ids = _worker['user_ids']
+    top_k = _worker['top_k']
+
+    rows = np.asarray(rows)
+    results = []
+    for label in np.unique(labels[rows]):
+        targets = rows[labels[rows] == label]
+        members = _worker['members'][label]
+        member_vectors = normalized[members]
+        k = min(top_k, len(members) - 1)
+        block = max(1, BLOCK_SCORES // len(members))
+
+        for start in range(0, len(targets), block):
+            block_rows = targets[start:start + block]
+            scores = normalized[block_rows] @ member_vectors.T
+            # Members are sorted row numbers, so each target's own column is found by bisection
+            scores[np.arange(len(block_rows)), np.searchsorted(members, block_rows)] = -np.inf
+            for row, row_scores in zip(block_rows, scores):
+                if k <= 0:
+                    results.append((int(user_ids[row]), []))
+                    continue
+                top = np.argpartition(-row_scores, k - 1)[:k]
+                top = top[np.argsort(-row_scores[top], kind='stable')]
+                results.append((
+                    int(user_ids[row]),
+                    [(int(user_ids[members[j]]), float(row_scores[j])) for j in top]
+                ))
+    return results
+
+
+# Function to hash what a user's recommendations depend on
+def state_hash(vector, label):
+    digest = hashlib.blake2b(np.ascontiguousarray(vector).tobytes(), digest_size=16)
+    digest.update(str(label).encode())
+    return digest.hexdigest()
+
+
+# Function to carry the previous run's cluster labels over to the current clusters
+def match_labels(previous, current):
+    """
+    Map each current cluster label to the previous label it shares the most
+    users with, so a refit that only renumbers the clusters changes nothing.
+
+    Args:
+    - previous (dict): user_id -> label stored by the previous run.
+    - current (dict): user_id -> label from the current model (-1: unassigned).
+
+    Returns:
+    - tuple: (dict of current label -> stable label, list of user_ids whose
+      stable label differs from their previous one).
+    """
+    overlap = collections.Counter(
+        (label, previous[user_id]) for user_id, label in current.items()
+        if label >= 0 and previous.get(user_id, -1) >= 0
+    )
+    translation = {-1: -1}
+    taken = set()
+    for (label, old_label), _ in overlap.most_common():
+        if label not in translation and old_label not in taken:
+            translation[label] = old_label
+            taken.add(old_label)
+    # Clusters without a counterpart get labels the previous run never used
+    fresh = max([*previous.values(), *current.values(), -1]) + 1
+    for label in sorted(set(current.values()) - set(translation)):
+        translation[label] = fresh
+        fresh += 1
+    moved = [
+        user_id for user_id, label in current.items()
+        if user_id in previous and translation[label] != previous[user_id]
+    ]
+    return translation, moved
+
+
+# Function to write one chunk of results and their state hashes in a single transaction
+def write_results(engine, results, hashes, labels, computed_at):
+    from models import Recommendation, RecommendationState
+
+    user_ids = [user_id for user_id, _ in results]
+    recommendations = [
+        {'user_id': user_id, 'rank': rank, 'recommended_user_id': recommended_user_id, 'similarity': similarity}
+        for user_id, neighbours in results
+        for rank, (recommended_user_id, similarity) in enumerate(neighbours)
+    ]
+    states = [
+        {'user_id': user_id, 'vector_hash': hashes[user_id], 'cluster_label': labels[user_id],
+         'computed_at': computed_at}
+        for user_id in user_ids
+    ]
+    with engine.begin() as connection:
+        connection.execute(delete(Recommendation).where(Recommendation.user_id.in_(user_ids)))
+        connection.execute(delete(RecommendationState).where(RecommendationState.user_id.in_(user_ids)))
+        if recommendations:
+            connection.execute(insert(Recommendation.__table__), recommendations)
+        connection.execute(insert(RecommendationState.__table__), states)
+
+
+# Function to define a build table with the live table's schema
+def build_table(live):
+    """
+    Return a copy of live named <name>_build, with the same columns, keys and
+    foreign keys but without secondary indexes, which are created after the swap.
+    """
+    metadata = MetaData()
+    for foreign_key in live.foreign_keys:
+        # Referenced tables must be known to the metadata, but are not created
+        if foreign_key.column.table.name not in metadata.tables:
+            foreign_key.column.table.to_metadata(metadata)
+    build = live.to_metadata(metadata, name=f'{live.name}_build')
+    build.indexes.clear()
+    return build
+
+
+# Function to load a full run into a fresh table and swap it in
+def write_full(engine, results_iter, hashes, labels, computed_at):
+    """
+    Bulk-load every user's results into a build table without the secondary
+    index, then replace the live table in one transaction. Readers keep
+    seeing the previous run until the swap.
+
+    Returns:
+    - int: The number of users written.
+    """
+    from models import Recommendation, RecommendationState
+
+    build = build_table(Recommendation.__table__)
+    build.drop(engine, checkfirst=True)
+    build.create(engine)
+
+    written = []
+    for results in results_iter:
+        recommendations = [
+            {'user_id': user_id, 'rank': rank, 'recommended_user_id': recommended_user_id, 'similarity': similarity}
+            for user_id, neighbours in results
+            for rank, (recommended_user_id, similarity) in enumerate(neighbours)
+        ]
+        if recommendations:
+            with engine.begin() as connection:
+                connection.execute(insert(build), recommendations)
+        written.extend(user_id for user_id, _ in results)
+
+    live = Recommendation.__table__
+    with engine.begin() as connection:
+        live.drop(connection)
+        connection.exec_driver_sql(f'ALTER TABLE {build.name} RENAME TO {live.name}')
+        for index in live.indexes:
+            index.create(connection)
+        connection.execute(delete(RecommendationState))
+        for chunk in _chunks(written, 10000):
+            connection.execute(insert(RecommendationState.__table__), [
+                {'user_id': user_id, 'vector_hash': hashes[user_id], 'cluster_label': labels[user_id],
+                 'computed_at': computed_at}
+                for user_id in chunk
+            ])
+    return len(written)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def run(top_k=50, workers=None, chunk_size=1000, full=False):
+    """
+    Compute and store recommendations.
+
+    Args:
+    - top_k (int): Neighbours stored per user.
+    - workers (int): Pool size; defaults to the number of CPUs.
+    - chunk_size (int): Users per task and per write transaction.
+    - full (bool): Recompute every user, not only the changed ones.
+
+    Returns:
+    - int: The number of users recomputed.
+    """
+    from clustering import ClusteringService
+    from database import SessionLocal, engine, init_db
+    from models import Recommendation, RecommendationRun, RecommendationState
+    from vector_db import UserVectorIndex
+
+    init_db()
+    started_at = time.time()
+
+    index = UserVectorIndex()
+    index.load()
+    vectors, user_ids, _ = index.snapshot()
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+
+    clustering = ClusteringService(
+        index,
+        model_path=os.getenv('CLUSTER_MODEL_PATH', './.cluster_model/kmeans.joblib'),
+        n_clusters=int(os.getenv('CLUSTER_COUNT', 5)),
+    )
+    clustering.ensure_ready()
+    assigned = {int(user_id): clustering.user_clusters.get(int(user_id), -1) for user_id in user_ids}
+
+    db_session = SessionLocal()
+    previous_run = db_session.query(RecommendationRun).filter(
+        RecommendationRun.finished_at.isnot(None)).order_by(RecommendationRun.id.desc()).first()
+    stored = {}
+    previous_labels = {}
+    for user_id, vector_hash, cluster_label in db_session.query(
+            RecommendationState.user_id, RecommendationState.vector_hash, RecommendationState.cluster_label):
+        stored[user_id] = vector_hash
+        if cluster_label is not None:
+            previous_labels[user_id] = cluster_label
+
+    translation, moved = match_labels(previous_labels, assigned)
+    stable_labels = {user_id: translation[label] for user_id, label in assigned.items()}
+    labels = np.array([stable_labels[int(user_id)] for user_id in user_ids], dtype=np.int64)
+    hashes = {int(user_id): state_hash(vector, label) for user_id, vector, label in zip(user_ids, vectors, labels)}
+
+    # Without stored labels (first run, or states from before they were kept) nothing can be matched
+    if previous_run is None or len(previous_labels) < len(stored):
+        full = True
+    elif len(moved) > FULL_RUN_MOVED_SHARE * max(len(previous_labels), 1):
+        logging.info(f"{len(moved)} users changed cluster since the previous run, recomputing everyone")
+        full = True
+
+    run_record = RecommendationRun(started_at=started_at, model_fitted_at=clustering.fitted_at,
+                                   model_hash=clustering.model_hash, full=full)
+    db_session.add(run_record)
+    db_session.commit()
+    run_id = run_record.id
+
+    removed = [user_id for user_id in stored if user_id not in hashes]
+    if full:
+        targets = set(hashes)
+    else:
+        changed = [user_id for user_id, digest in hashes.items() if stored.get(user_id) != digest]
+        targets = set(changed)
+        # Users whose stored neighbours changed or are gone
+        for chunk in _chunks(changed + removed, 500):
+            targets.update(db_session.execute(
+                select(Recommendation.user_id).where(Recommendation.recommended_user_id.in_(chunk)).distinct()
+            ).scalars())
+        targets &= set(hashes)
+    db_session.close()
+
+    for chunk in _chunks(removed, 500):
+        with engine.begin() as connection:
+            connection.execute(delete(Recommendation).where(Recommendation.user_id.in_(chunk)))
+            connection.execute(delete(RecommendationState).where(RecommendationState.user_id.in_(chunk)))
+
+    row_of = {int(user_id): row for row, user_id in enumerate(user_ids)}
+    rows = sorted(row_of[user_id] for user_id in targets)
+    tasks = list(_chunks(rows, chunk_size))
+    normalized = normalize_rows(vectors)
+    logging.info(f"Recomputing recommendations for {len(rows)} of {len(user_ids)} users ({'full' if full else 'incremental'})")
+
+    workers = workers or os.cpu_count() or 1
+    computed = 0
+    if workers == 1 or len(tasks) <= 1:
+        _init_worker(normalized, labels, user_ids, top_k)
+        results_iter = map(_compute_chunk, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(normalized, labels, user_ids, top_k))
+        results_iter = pool.imap_unordered(_compute_chunk, tasks)
+    try:
+        if full:
+            computed = write_full(engine, results_iter, hashes, stable_labels, time.time())
+        else:
+            for results in results_iter:
+                write_results(engine, results, hashes, stable_labels, time.time())
+                computed += len(results)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    db_session = SessionLocal()
+    run_record = db_session.get(RecommendationRun, run_id)
+    run_record.finished_at = time.time()
+    run_record.users_computed = computed
+    db_session.commit()
+    db_session.close()
+    return computed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Materialize user recommendations.')
+    parser.add_argument('--top-k', type=int, default=int(os.getenv('RECOMMENDATIONS_TOP_K', 50)))
+    parser.add_argument('--workers', type=int, default=None, help='pool size (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='users per task and per transaction')
+    parser.add_argument('--full', action='store_true', help='recompute every user')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    computed = run(top_k=args.top_k, workers=args.workers, chunk_size=args.chunk_size, full=args.full)
+    print(f"Recomputed recommendations for {computed} users in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
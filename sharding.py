@@ -0,0 +1,682 @@
+# sharding.py
+"""
+Sharded cosine similarity search.
+
+The user vector space is partitioned by a consistent hash of the user id
+across shard servers, each holding only its slice and answering local top-k
+queries. A ShardCoordinator fans a query out to every shard, merges the
+partial top-k lists and returns whatever arrived before its deadline, so a
+slow shard degrades the answer instead of stalling the request. Writes are
+queued and sent by a background thread with their own deadline, so they
+never hold up a request either. Adding a shard moves only the users the new
+shard now owns.
+
+Shards talk multiprocessing.connection over TCP, so they can run on other
+nodes:
+
+    SHARD_AUTHKEY=secret python sharding.py --host 0.0.0.0 --port 7001
+
+or on this host, started once and shared by every worker
+(ensure_local_shards).
+
+The connection pickles messages, so shards must only listen where the
+coordinator can reach them and always use an authkey.
+"""
+
+import argparse
+import bisect
+import fcntl
+import hashlib
+import heapq
+import logging
+import os
+import queue
+import secrets
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Connection, Listener, answer_challenge, deliver_challenge
+
+import numpy as np
+
+from metrics import SHARD_ERRORS, SHARD_TIMEOUTS
+
+
+class ShardError(Exception):
+    """
+    Raised when a shard could not answer a call.
+    """
+
+
+class ShardTimeout(ShardError):
+    """
+    Raised when a shard did not answer before the deadline.
+    """
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping user ids to shard addresses.
+
+    Each shard gets `replicas` points on the ring, so load stays even and
+    adding a shard only takes over about 1/N of the users.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []  # sorted hashes
+        self.owners = []  # node at each point
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            i = bisect.bisect(self.points, point)
+            self.points.insert(i, point)
+            self.owners.insert(i, node)
+
+    def copy(self):
+        ring = HashRing(replicas=self.replicas)
+        ring.points = list(self.points)
+        ring.owners = list(self.owners)
+        return ring
+
+    def owner(self, user_id):
+        i = bisect.bisect(self.points, self._hash(user_id)) % len(self.points)
+        return self.owners[i]
+
+
+class ShardStore:
+    """
+    One shard's slice of the interest matrix, kept L2-normalized for ranking.
+    """
+
+    def __init__(self, dim=None, initial_capacity=1024):
+        self.dim = dim
+        self.capacity = initial_capacity
+        self.vectors = None
+        self.normalized = None
+        self.user_ids = []
+        self.id_to_row = {}
+        self.lock = threading.RLock()
+
+    def _ensure_capacity(self, dim, needed):
+        if self.vectors is None:
+            self.dim = dim
+            self.vectors = np.zeros((max(self.capacity, needed), dim), dtype=np.float32)
+            self.normalized = np.zeros_like(self.vectors)
+        elif needed > self.vectors.shape[0]:
+            size = max(needed, self.vectors.shape[0] * 2)
+            for name in ('vectors', 'normalized'):
+                grown = np.zeros((size, self.dim), dtype=np.float32)
+                grown[:len(self.user_ids)] = getattr(self, name)[:len(self.user_ids)]
+                setattr(self, name, grown)
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def upsert(self, user_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(user_ids), -1)
+        with self.lock:
+            new = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in self.id_to_row]
+            self._ensure_capacity(vectors.shape[1], len(self.user_ids) + len(new))
+            for user_id in new:
+                self.id_to_row[user_id] = len(self.user_ids)
+                self.user_ids.append(user_id)
+            rows = np.array([self.id_to_row[user_id] for user_id in user_ids], dtype=np.intp)
+            self.vectors[rows] = vectors
+            self.normalized[rows] = self._normalize(vectors)
+        return len(new)
+
+    def remove(self, user_ids):
+        # Swap-remove, so rows stay contiguous
+        with self.lock:
+            for user_id in user_ids:
+                row = self.id_to_row.pop(user_id, None)
+                if row is None:
+                    continue
+                last = len(self.user_ids) - 1
+                if row != last:
+                    moved = self.user_ids[last]
+                    self.user_ids[row] = moved
+                    self.id_to_row[moved] = row
+                    self.vectors[row] = self.vectors[last]
+                    self.normalized[row] = self.normalized[last]
+                self.user_ids.pop()
+        return len(self.user_ids)
+
+    def clear(self):
+        with self.lock:
+            self.user_ids = []
+            self.id_to_row = {}
+
+    def export(self, user_ids):
+        with self.lock:
+            known = [user_id for user_id in user_ids if user_id in self.id_to_row]
+            rows = np.array([self.id_to_row[user_id] for user_id in known], dtype=np.intp)
+            vectors = self.vectors[rows].copy() if len(rows) else np.zeros((0, self.dim or 0), dtype=np.float32)
+        return known, vectors
+
+    def ids(self):
+        with self.lock:
+            return list(self.user_ids)
+
+    def top_k(self, vector, k, exclude=()):
+        """
+        Returns:
+        - List of (user_id, similarity) for this shard's k best matches.
+        """
+        query = self._normalize(np.asarray(vector, dtype=np.float32))
+        with self.lock:
+            count = len(self.user_ids)
+            if count == 0 or k <= 0:
+                return []
+            scores = self.normalized[:count] @ query
+            for user_id in exclude:
+                row = self.id_to_row.get(user_id)
+                if row is not None:
+                    scores[row] = -np.inf
+            if k < count:
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(count)
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [(self.user_ids[row], float(scores[row])) for row in top if np.isfinite(scores[row])]
+
+    def stats(self):
+        with self.lock:
+            return {'users': len(self.user_ids), 'dim': self.dim}
+
+
+# Function to serve one shard until the process exits
+def serve_shard(address, authkey, ready=None):
+    """
+    Answer (op, args) calls from coordinators, one thread per connection.
+
+    Args:
+    - address (tuple): (host, port) to listen on; port 0 picks a free one.
+    - authkey (bytes): Shared secret coordinators must present.
+    - ready (Connection): Optional pipe the bound address is sent to.
+    """
+    store = ShardStore()
+    listener = Listener(address, authkey=authkey)
+    if ready is not None:
+        ready.send(listener.address)
+        ready.close()
+    operations = {
+        'upsert': store.upsert, 'remove': store.remove, 'clear': store.clear, 'export': store.export,
+        'ids': store.ids, 'top_k': store.top_k, 'stats': store.stats,
+    }
+
+    def handle(connection):
+        with connection:
+            while True:
+                try:
+                    op, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', operations[op](*args))
+                except Exception as e:
+                    reply = ('error', f"{type(e).__name__}: {e}")
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return  # The coordinator gave up on this call and closed the connection
+
+    while True:
+        try:
+            connection = listener.accept()
+        except Exception as e:
+            logging.error(f"Shard rejected a connection: {e}")
+            continue
+        threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+
+# Function to open an authenticated shard connection within a time limit
+def _connect(address, authkey, timeout):
+    """
+    Like multiprocessing.connection.Client, but neither the TCP connect nor
+    the authentication handshake can wait longer than timeout seconds.
+
+    Raises:
+    - TimeoutError: The shard did not connect or authenticate in time.
+    - OSError: The shard could not be reached.
+    - AuthenticationError: The shard uses a different authkey.
+    """
+    timeout = max(timeout, 0.001)  # A zero limit would mean none below
+    sock = socket.create_connection(address, timeout=timeout)
+    try:
+        # The handshake reads the file descriptor directly, so it is bounded
+        # with socket options rather than the socket's own timeout
+        sock.settimeout(None)
+        limit = struct.pack('ll', int(timeout), int(timeout % 1 * 1e6))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, limit)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, limit)
+        connection = Connection(os.dup(sock.fileno()))
+        try:
+            answer_challenge(connection, authkey)
+            deliver_challenge(connection, authkey)
+        except BlockingIOError as e:
+            connection.close()
+            raise TimeoutError(f"No authentication from {address[0]}:{address[1]} in time") from e
+        except BaseException:
+            connection.close()
+            raise
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 0, 0))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack('ll', 0, 0))
+        return connection
+    finally:
+        sock.close()
+
+
+# Function to check whether a shard server answers on an address
+def _shard_running(address, authkey, timeout=1.0):
+    try:
+        connection = _connect(address, authkey, timeout)
+    except OSError:
+        return False
+    except AuthenticationError as e:
+        raise ShardError(f"A shard on {address[0]}:{address[1]} uses a different authkey") from e
+    connection.close()
+    return True
+
+
+# Function to read the local shards' authkey, creating it on first use
+def _local_authkey(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    authkey = secrets.token_hex(16).encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+# Function to start the local shard servers unless they are already running
+def ensure_local_shards(count, authkey=None, base_port=7101, host='127.0.0.1', state_dir=None, start_timeout=30.0):
+    """
+    Make sure `count` shard servers listen on consecutive ports from
+    base_port, starting the missing ones as detached processes.
+
+    Every worker on the host calls this and gets the same shards; a lock file
+    keeps two workers from starting the same one. The servers outlive the
+    workers, like shard nodes, so a restarted worker finds its data there.
+
+    Args:
+    - count (int): Number of shards.
+    - authkey (bytes): Shared secret; if None, one is generated once and
+      kept in a 0600 file in state_dir.
+    - base_port (int): Port of the first shard.
+    - state_dir (str): Directory for the lock and key files; defaults to
+      interweave-shards-<base_port> in the temp directory.
+    - start_timeout (float): Seconds to wait for started shards to listen.
+
+    Returns:
+    - addresses (list): (host, port) of each shard.
+    - authkey (bytes): The authkey the shards use.
+    - processes (list): The shard processes started by this call.
+    """
+    state_dir = state_dir or os.path.join(tempfile.gettempdir(), f'interweave-shards-{base_port}')
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    addresses = [(host, base_port + i) for i in range(count)]
+    processes = []
+    with open(os.path.join(state_dir, 'start.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if authkey is None:
+            authkey = _local_authkey(os.path.join(state_dir, 'authkey'))
+        env = dict(os.environ, SHARD_AUTHKEY=authkey.decode('utf-8'))
+        for address in addresses:
+            if not _shard_running(address, authkey):
+                processes.append(subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--host', host, '--port', str(address[1])],
+                    env=env, stdin=subprocess.DEVNULL, start_new_session=True,
+                ))
+
+        deadline = time.monotonic() + start_timeout
+        for address in addresses:
+            while not _shard_running(address, authkey):
+                if any(process.poll() is not None for process in processes) or time.monotonic() > deadline:
+                    raise ShardError(f"Local shard {address[0]}:{address[1]} did not start")
+                time.sleep(0.05)
+    if processes:
+        logging.info(f"Started {len(processes)} of {count} local shards from port {base_port}")
+    return addresses, authkey, processes
+
+
+class ShardClient:
+    """
+    Pool of connections to one shard; each call uses one connection.
+
+    A call that misses its deadline leaves its reply in flight, so that
+    connection is closed rather than returned to the pool. Opening a new
+    connection takes at most connect_timeout seconds, and counts against
+    the call's timeout.
+    """
+
+    def __init__(self, address, authkey, pool_size=8, connect_timeout=1.0):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self.idle = queue.LifoQueue(maxsize=pool_size)
+
+    def __repr__(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def call(self, op, *args, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            connect_timeout = self.connect_timeout if timeout is None else min(timeout, self.connect_timeout)
+            try:
+                connection = _connect(self.address, self.authkey, connect_timeout)
+            except TimeoutError as e:
+                raise ShardTimeout(f"Shard {self} did not accept a connection in time") from e
+            except OSError as e:
+                raise ShardError(f"Shard {self} is unreachable: {e}") from e
+        try:
+            connection.send((op, args))
+            if deadline is not None and not connection.poll(max(deadline - time.monotonic(), 0)):
+                connection.close()
+                raise ShardTimeout(f"Shard {self} did not answer {op} in time")
+            status, result = connection.recv()
+        except (EOFError, OSError) as e:
+            connection.close()
+            raise ShardError(f"Shard {self} dropped the connection: {e}") from e
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+        if status == 'error':
+            raise ShardError(f"Shard {self} failed {op}: {result}")
+        return result
+
+    def close(self):
+        """
+        Close the idle connections; calls still running close their own.
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ShardCoordinator:
+    """
+    Scatter-gather top-k search over shard servers.
+
+    Writes go to the shard that owns the user on the hash ring; queries go
+    to every shard in parallel and the partial results are merged. Shards
+    that miss the deadline (or fail) are left out of that answer and
+    counted in interweave_shard_timeouts_total / interweave_shard_errors_total.
+
+    upsert() only queues the user's latest vector; a writer thread sends the
+    queue to the shards, each call bounded by write_timeout. Writes to a
+    shard that fails or times out stay queued and are retried every
+    retry_interval seconds, unless the user changed again in the meantime.
+    close() stops the writer thread.
+    """
+
+    def __init__(self, addresses, authkey, timeout=0.25, write_timeout=1.0, retry_interval=1.0, replicas=64,
+                 chunk_size=50000):
+        self.authkey = authkey
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.retry_interval = retry_interval
+        self.chunk_size = chunk_size
+        self.shards = {repr(client): client for client in (ShardClient(address, authkey) for address in addresses)}
+        self.ring = HashRing(self.shards, replicas=replicas)
+        self.executor = ThreadPoolExecutor(max_workers=max(4, 4 * len(self.shards)), thread_name_prefix='shard-query')
+        # Writes and rebalancing are serialized; queries read self.shards and self.ring lock-free
+        self.lock = threading.RLock()
+        self.pending_writes = {}  # user_id -> latest vector not yet sent to its shard
+        self.write_ready = threading.Condition()
+        self.writer = None
+        self.closed = False
+
+    def _partition(self, user_ids, ring=None):
+        ring = ring or self.ring
+        parts = {}
+        for i, user_id in enumerate(user_ids):
+            parts.setdefault(ring.owner(user_id), []).append(i)
+        return parts
+
+    def _load(self, names, user_ids, vectors):
+        parts = self._partition(user_ids)
+        loaded = 0
+        for name in names:
+            rows = parts.get(name, [])
+            for start in range(0, len(rows), self.chunk_size):
+                chunk = rows[start:start + self.chunk_size]
+                self.shards[name].call('upsert', [user_ids[i] for i in chunk], vectors[chunk])
+            loaded += len(rows)
+        return loaded
+
+    def build(self, user_ids, vectors):
+        """
+        Replace the contents of every shard with the given vectors.
+        """
+        user_ids = [int(user_id) for user_id in user_ids]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            for client in self.shards.values():
+                client.call('clear')
+            self._load(self.shards, user_ids, vectors)
+
+    def load_missing(self, user_ids, vectors):
+        """
+        Load the given vectors into the shards that hold no users, i.e. on
+        first start or after a shard restarted. Shards that already hold
+        users are left alone: other workers keep them up to date, and a
+        snapshot from this worker could be older than what they wrote.
+
+        Returns:
+        - int: The number of users loaded.
+        """
+        user_ids = [int(user_id) for user_id in user_ids]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            empty = [
+                name for name, client in self.shards.items()
+                if client.call('stats', timeout=self.write_timeout)['users'] == 0
+            ]
+            return self._load(empty, user_ids, vectors)
+
+    def upsert(self, user_id, vector):
+        """
+        Queue a user's new vector for its shard; never waits for the shard.
+        """
+        with self.write_ready:
+            self.pending_writes[int(user_id)] = np.asarray(vector, dtype=np.float32)
+            if self.writer is None and not self.closed:
+                self.writer = threading.Thread(target=self._write_loop, name='shard-writer', daemon=True)
+                self.writer.start()
+            self.write_ready.notify()
+
+    def flush_writes(self):
+        """
+        Send the queued writes, one call per shard bounded by write_timeout.
+
+        Returns:
+        - int: The number of writes still queued, e.g. for a shard that is down.
+        """
+        with self.write_ready:
+            writes, self.pending_writes = self.pending_writes, {}
+        failed = {}
+        if writes:
+            user_ids = list(writes)
+            with self.lock:
+                for name, rows in self._partition(user_ids).items():
+                    ids = [user_ids[i] for i in rows]
+                    try:
+                        self.shards[name].call('upsert', ids, np.stack([writes[user_id] for user_id in ids]),
+                                               timeout=self.write_timeout)
+                    except ShardError as e:
+                        (SHARD_TIMEOUTS if isinstance(e, ShardTimeout) else SHARD_ERRORS).inc(shard=name)
+                        logging.error(f"Could not write {len(ids)} users to shard {name}: {e}")
+                        failed.update((user_id, writes[user_id]) for user_id in ids)
+        with self.write_ready:
+            for user_id, vector in failed.items():
+                self.pending_writes.setdefault(user_id, vector)  # A newer vector wins
+            return len(self.pending_writes)
+
+    def _write_loop(self):
+        while True:
+            with self.write_ready:
+                self.write_ready.wait_for(lambda: self.pending_writes or self.closed)
+                if self.closed:
+                    return
+            if self.flush_writes():
+                with self.write_ready:
+                    self.write_ready.wait_for(lambda: self.closed, timeout=self.retry_interval)
+
+    def close(self):
+        """
+        Stop the writer thread and close the shard connections. Writes still
+        queued are dropped; call flush_writes() first to send them.
+        """
+        with self.write_ready:
+            self.closed = True
+            self.write_ready.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        self.executor.shutdown(wait=False)
+        for client in self.shards.values():
+            client.close()
+
+    def search(self, vector, k, exclude=(), timeout=None):
+        """
+        Return the k most similar users across all shards.
+
+        Args:
+        - vector (np.ndarray): The query interest vector.
+        - k (int): Number of results.
+        - exclude (iterable): User ids to leave out (e.g. the target user).
+        - timeout (float): Seconds to wait for shards; defaults to self.timeout.
+
+        Returns:
+        - List of (user_id, similarity), most similar first.
+        """
+        shards = self.shards
+        exclude = list(exclude)
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        futures = {
+            self.executor.submit(client.call, 'top_k', vector, k, exclude, timeout=deadline - time.monotonic()): name
+            for name, client in shards.items()
+        }
+        done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+
+        best = {}
+        for future in done:
+            try:
+                results = future.result()
+            except ShardTimeout:
+                not_done.add(future)
+                continue
+            except ShardError as e:
+                SHARD_ERRORS.inc(shard=futures[future])
+                logging.error(f"Shard query failed: {e}")
+                continue
+            for user_id, similarity in results:
+                # During a rebalance a user can briefly be on two shards
+                if similarity > best.get(user_id, -np.inf):
+                    best[user_id] = similarity
+        for future in not_done:
+            SHARD_TIMEOUTS.inc(shard=futures[future])
+        if not_done:
+            logging.warning(f"Partial similarity results: {len(not_done)} of {len(futures)} shards timed out")
+        return heapq.nlargest(k, best.items(), key=lambda item: item[1])
+
+    def add_shard(self, address):
+        """
+        Add a shard and move over the users it now owns.
+
+        Only this coordinator's ring changes, and every web worker has its
+        own: run it from a one-off script, then restart the workers with the
+        new shard list.
+
+        The new shard is loaded before it joins the ring, and the moved users
+        are removed from their old shards only after queries can reach them
+        on the new one, so they never disappear from results.
+
+        Returns:
+        - int: The number of users moved.
+        """
+        client = ShardClient(address, self.authkey)
+        name = repr(client)
+        with self.lock:
+            if name in self.shards:
+                return 0
+            ring = self.ring.copy()
+            ring.add(name)
+            moves = {}
+            for old_name, old_client in self.shards.items():
+                moving = [user_id for user_id in old_client.call('ids') if ring.owner(user_id) == name]
+                for start in range(0, len(moving), self.chunk_size):
+                    known, vectors = old_client.call('export', moving[start:start + self.chunk_size])
+                    if known:
+                        client.call('upsert', known, vectors)
+                moves[old_name] = moving
+
+            self.shards = {**self.shards, name: client}
+            self.ring = ring
+            for old_name, moving in moves.items():
+                for start in range(0, len(moving), self.chunk_size):
+                    self.shards[old_name].call('remove', moving[start:start + self.chunk_size])
+        moved = sum(len(moving) for moving in moves.values())
+        logging.info(f"Added shard {name}; moved {moved} users")
+        return moved
+
+    def stats(self):
+        return {name: client.call('stats', timeout=self.timeout) for name, client in self.shards.items()}
+
+
+# Function to parse a list of shard addresses
+def parse_addresses(spec):
+    """
+    Parse "host:port,host:port" into a list of (host, port) tuples.
+    """
+    addresses = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        host, _, port = item.rpartition(':')
+        addresses.append((host, int(port)))
+    return addresses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve one similarity search shard.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7001)
+    args = parser.parse_args(argv)
+
+    authkey = os.getenv('SHARD_AUTHKEY')
+    if not authkey:
+        print('SHARD_AUTHKEY must be set', file=sys.stderr)
+        return 2
+    logging.basicConfig(level=logging.INFO)
+    logging.info(f"Serving shard on {args.host}:{args.port}")
+    serve_shard((args.host, args.port), authkey.encode('utf-8'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
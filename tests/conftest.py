@@ -0,0 +1,89 @@
+# tests/conftest.py
+"""
+Shared fixtures. The app reads its configuration from the environment at
+import time, so everything it writes (database, journal, cluster model) is
+pointed at a temporary directory before any app module is imported.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP_DIR = tempfile.mkdtemp(prefix='interweave-tests-')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TMP_DIR, 'test.db')}",
+    'SECRET_KEY': 'test-secret',
+    'PREWARM': '0',
+    'POPULATION_SYNC_INTERVAL': '0',
+    'GENERATION_BACKEND': 'rules',
+    'GENERATION_FALLBACK': 'rules',
+    'WRITE_BEHIND_JOURNAL_DIR': os.path.join(TMP_DIR, 'journal'),
+    'CLUSTER_MODEL_PATH': os.path.join(TMP_DIR, 'cluster', 'kmeans.joblib'),
+})
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app as app_module
+    from database import init_db
+
+    init_db()
+    return app_module
+
+
+@pytest.fixture(scope='session')
+def flask_app(app_module):
+    return app_module.create_app({'TESTING': True})
+
+
+@pytest.fixture
+def clean(app_module):
+    """
+    Empty every table and reset the in-process indexes and caches.
+    """
+    import vector_db
+    from database import Base, engine
+
+    app_module.interest_buffer.flush()
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+
+    index = vector_db.user_index
+    with index.lock:
+        index.loaded = False
+        index.user_ids = []
+        index.id_to_row = {}
+        index.user_data = {}
+        index.vectors[:] = 0.0
+    vector_db.similarity_engine.stale = True
+    vector_db.attribute_index.stale = True
+    app_module.rendered_cache.clear()
+    app_module.llm_cache.backend.clear()
+    app_module.identity_cache.backend.clear()
+    yield
+
+
+@pytest.fixture
+def client(flask_app, clean):
+    return flask_app.test_client()
+
+
+# Function to register and log in a user with the given interests
+def make_user(flask_app, name, interests=None):
+    """
+    Returns:
+    - FlaskClient: A client logged in as the new user.
+    """
+    client = flask_app.test_client()
+    client.post('/register', data={'username': name, 'email': f'{name}@example.com', 'password': 'secret'})
+    response = client.post('/login', data={'username': name, 'password': 'secret'})
+    assert response.status_code == 302
+    if interests:
+        assert client.post('/update_profile', json=interests).status_code == 200
+    return client
@@ -0,0 +1,145 @@
+# tests/test_ann_index.py
+
+import threading
+
+import numpy as np
+
+from ann_index import IVFIndex, load_index, recall_at_k, tune_n_probe
+from vector_db import DerivedIndex, UserVectorIndex
+
+
+def make_vectors(n_users=2000, dim=8):
+    rng = np.random.default_rng(3)
+    return list(range(1, n_users + 1)), rng.uniform(0, 10, size=(n_users, dim)).astype(np.float32)
+
+
+class ExactIndex:
+    kind = 'exact'
+
+    def __init__(self, user_ids, vectors):
+        self.user_ids = np.asarray(user_ids)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def search(self, query, k):
+        scores = self.vectors @ (query / np.linalg.norm(query))
+        order = np.argsort(-scores)[:k]
+        return [(int(self.user_ids[i]), float(scores[i])) for i in order]
+
+
+class SelfOnlyIndex(ExactIndex):
+    # Finds the query itself, then nothing useful
+    def search(self, query, k):
+        found = super().search(query, 1)
+        return found + [(-i, 0.0) for i in range(1, k)]
+
+
+def test_recall_does_not_count_the_query_itself():
+    user_ids, vectors = make_vectors(300)
+    assert recall_at_k(ExactIndex(user_ids, vectors), user_ids, vectors, k=10) == 1.0
+    assert recall_at_k(SelfOnlyIndex(user_ids, vectors), user_ids, vectors, k=10) == 0.0
+
+
+def test_tune_n_probe_reaches_the_target():
+    user_ids, vectors = make_vectors()
+    index = IVFIndex(vectors.shape[1], n_lists=64, n_probe=1)
+    index.build(user_ids, vectors)
+    recall = tune_n_probe(index, user_ids, vectors, target=0.95)
+    assert recall >= 0.95
+    assert index.n_probe > 1
+
+
+def test_load_applies_n_probe_override(tmp_path):
+    user_ids, vectors = make_vectors(500)
+    index = IVFIndex(vectors.shape[1], n_lists=16, n_probe=4)
+    index.build(user_ids, vectors)
+    path = str(tmp_path / 'ann.npz')
+    index.save(path)
+
+    assert load_index(path).n_probe == 4
+    loaded = load_index(path, n_probe=12)
+    assert loaded.n_probe == 12 and len(loaded) == 500
+    assert list(tmp_path.iterdir()) == [tmp_path / 'ann.npz']  # No temporary files left behind
+
+
+def test_changes_during_a_build_are_not_lost():
+    user_ids, vectors = make_vectors(200)
+    user_index = UserVectorIndex(initial_capacity=256)
+    user_index.loaded = True
+    fields = user_index.interest_fields
+    for user_id, vector in zip(user_ids, vectors):
+        user_index.add_user(user_id, f'user{user_id}')
+        user_index.update_interests(user_id, dict(zip(fields, vector)))
+
+    snapshot_taken = threading.Event()
+    resume = threading.Event()
+
+    def build():
+        user_vectors, ids, _ = user_index.snapshot()
+        snapshot_taken.set()
+        resume.wait(5)
+        return {user_id: vector for user_id, vector in zip(ids, user_vectors)}
+
+    derived = DerivedIndex('test', build, lambda index, user_id, vector: index.__setitem__(user_id, vector))
+    user_index.add_listener(derived.on_vector_changed)
+
+    builder = threading.Thread(target=derived.get)
+    builder.start()
+    snapshot_taken.wait(5)
+    user_index.update_interests(7, {fields[0]: 123.0})
+    user_index.add_user(999, 'late')
+    resume.set()
+    builder.join(5)
+
+    index = derived.get()
+    assert index[7][0] == 123.0
+    assert 999 in index
+
+    derived.invalidate()
+    assert derived.index is None
+    assert derived.get()[7][0] == 123.0
+
+
+def test_lists_follow_the_population(tmp_path):
+    user_ids, vectors = make_vectors(2500)
+    index = IVFIndex(vectors.shape[1])
+    index.build(user_ids[:400], vectors[:400])
+    assert len(index.centroids) == 20
+
+    # Reloading a much larger population retrains with more lists
+    path = str(tmp_path / 'ann.npz')
+    index.save(path)
+    loaded = load_index(path)
+    assert loaded.n_lists is None
+    loaded.refill(user_ids, vectors)
+    assert len(loaded.centroids) == 50 and len(loaded) == 2500
+
+    fixed = IVFIndex(vectors.shape[1], n_lists=16)
+    fixed.build(user_ids[:400], vectors[:400])
+    fixed.refill(user_ids, vectors)
+    assert len(fixed.centroids) == 16
+
+
+def test_blocks_stay_consistent_as_lists_grow_and_shrink():
+    user_ids, vectors = make_vectors(3000)
+    index = IVFIndex(vectors.shape[1], n_lists=8)
+    index.build(user_ids[:200], vectors[:200])
+    index.n_probe = 8  # Every list, so results are exact
+
+    # Enough inserts to move full lists and compact the gaps they leave
+    for user_id, vector in zip(user_ids[200:], vectors[200:]):
+        index.add(user_id, vector)
+    for user_id in user_ids[::3]:
+        index.remove(user_id)
+    for user_id in user_ids[1:600:3]:
+        index.add(user_id, vectors[user_id - 1][::-1])
+    assert len(index) == 2000
+
+    kept = [user_id for user_id in user_ids if user_id % 3 != 1]
+    current = np.array([vectors[user_id - 1][::-1] if user_id < 600 and user_id % 3 == 2 else vectors[user_id - 1]
+                        for user_id in kept])
+    exact = ExactIndex(kept, current)
+    for row in range(0, len(kept), 97):
+        expected = [user_id for user_id, _ in exact.search(current[row], 10)]
+        assert [user_id for user_id, _ in index.search(current[row], 10)] == expected
+    assert index.end <= len(index.ids)
+    assert sorted(index.ids[index._live_rows()].tolist()) == kept
@@ -0,0 +1,121 @@
+# tests/test_attribute_index.py
+
+import numpy as np
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from attribute_index import InterestAttributeIndex, parse_predicates
+from interests import INTEREST_FIELDS
+from vector_db import UserVectorIndex
+
+
+def make_index(n_users=2000, seed=5):
+    rng = np.random.default_rng(seed)
+    user_index = UserVectorIndex(initial_capacity=n_users)
+    user_index.loaded = True
+    scores = np.round(rng.uniform(0, 10, size=(n_users, len(INTEREST_FIELDS))), 1)
+    for user_id, row in enumerate(scores, start=1):
+        user_index.add_user(user_id, f'user{user_id}')
+        user_index.update_interests(user_id, dict(zip(INTEREST_FIELDS, row)))
+    attributes = InterestAttributeIndex(user_index)
+    user_index.add_listener(attributes.on_vector_changed)
+    return user_index, attributes
+
+
+def brute_force(user_index, predicates):
+    vectors, user_ids, _ = user_index.snapshot()
+    keep = np.ones(len(user_ids), dtype=bool)
+    for field, (low, high) in predicates.items():
+        values = vectors[:, INTEREST_FIELDS.index(field)]
+        if low is not None:
+            keep &= values >= low
+        if high is not None:
+            keep &= values <= high
+    return sorted(user_id for user_id, kept in zip(user_ids, keep) if kept)
+
+
+def plans_used(attributes, predicates):
+    # Record which candidate plan each query reads its rows with
+    used = []
+
+    def spy(plan, method):
+        def read(*args):
+            used.append(plan)
+            return method(attributes, *args)
+        return read
+
+    attributes._sorted_rows = spy('sorted', InterestAttributeIndex._sorted_rows)
+    attributes._bitmap_rows = spy('bitmap', InterestAttributeIndex._bitmap_rows)
+    try:
+        found = attributes.candidate_ids(predicates)
+    finally:
+        del attributes._sorted_rows, attributes._bitmap_rows
+    return sorted(found), used
+
+
+@pytest.mark.parametrize('predicates, plan', [
+    ({INTEREST_FIELDS[0]: (9.8, None)}, 'sorted'),
+    ({INTEREST_FIELDS[0]: (4.95, 5.05), INTEREST_FIELDS[1]: (2, None)}, 'sorted'),
+    ({INTEREST_FIELDS[0]: (3, None)}, 'bitmap'),
+    ({INTEREST_FIELDS[0]: (2.5, 7.5), INTEREST_FIELDS[1]: (None, 6.2)}, 'bitmap'),
+])
+def test_plans_match_brute_force(predicates, plan):
+    user_index, attributes = make_index()
+    found, used = plans_used(attributes, predicates)
+    assert used == [plan]
+    assert found == brute_force(user_index, predicates)
+
+
+def test_changes_after_the_sort_are_found():
+    user_index, attributes = make_index()
+    field = INTEREST_FIELDS[0]
+    narrow = {field: (9.95, None)}
+    attributes.candidate_ids(narrow)
+
+    # Moved into and out of the range, plus a new user, all in the unsorted delta
+    inside = brute_force(user_index, narrow)
+    user_index.update_interests(inside[0], {field: 1.0})
+    user_index.update_interests(7, {field: 10.0})
+    user_index.add_user(5000, 'late')
+    user_index.update_interests(5000, {field: 9.99})
+    assert attributes.delta
+
+    found, used = plans_used(attributes, narrow)
+    assert used == ['sorted']
+    assert found == brute_force(user_index, narrow)
+    assert 7 in found and 5000 in found and inside[0] not in found
+
+    broad = {field: (None, 5)}
+    found, used = plans_used(attributes, broad)
+    assert used == ['bitmap']
+    assert found == brute_force(user_index, broad)
+
+
+def test_delta_is_folded_into_the_sort():
+    user_index, attributes = make_index(n_users=500)
+    attributes.max_delta = 10
+    attributes.candidate_ids({})
+    field = INTEREST_FIELDS[0]
+    for user_id in range(1, 101):
+        user_index.update_interests(user_id, {field: 10.0})
+    assert len(attributes.delta) == 100
+
+    predicates = {field: (10, None)}
+    assert sorted(attributes.candidate_ids(predicates)) == brute_force(user_index, predicates)
+    assert not attributes.delta
+
+
+def test_parse_predicates():
+    first, second = INTEREST_FIELDS[:2]
+    args = MultiDict({f'min_{first}': '7', f'max_{first}': '9.5', f'max_{second}': '2', 'top_n': '5'})
+    assert parse_predicates(args) == {first: (7.0, 9.5), second: (None, 2.0)}
+    assert parse_predicates(MultiDict()) == {}
+
+    for args, message in [
+        ({'min_knitting_backwards': '1'}, 'Unknown interest: knitting_backwards'),
+        ({f'min_{first}': 'high'}, f'min_{first} must be a number'),
+        ({f'min_{first}': 'nan'}, f'min_{first} must be a number'),
+        ({f'min_{first}': '8', f'max_{first}': '3'}, f'min_{first} is greater than max_{first}'),
+    ]:
+        with pytest.raises(ValueError, match=message):
+            parse_predicates(MultiDict(args))
@@ -0,0 +1,115 @@
+# tests/test_batch_updates.py
+
+import io
+import json
+
+import pytest
+
+from batch_updates import BatchUpdateError, apply_interest_batch, iter_json_array, iter_ndjson, parse_update
+from conftest import make_user
+
+
+def test_json_array_is_parsed_across_chunks():
+    items = [{'user_id': i, 'interests': {'hiking': i, 'music': None}} for i in range(50)]
+    body = json.dumps(items).encode('utf-8')
+    assert list(iter_json_array(io.BytesIO(body), chunk_size=7)) == items
+    assert list(iter_json_array(io.BytesIO(b' [ ] '))) == []
+
+
+def test_multibyte_characters_split_across_chunks():
+    body = json.dumps([{'note': 'café ☕'}], ensure_ascii=False).encode('utf-8')
+    assert list(iter_json_array(io.BytesIO(body), chunk_size=1)) == [{'note': 'café ☕'}]
+
+
+@pytest.mark.parametrize('body, message', [
+    (b'{"user_id": 1}', 'Expected a JSON array'),
+    (b'[{"user_id": 1}, {"user_id": 2}', 'Truncated'),
+    (b'[{"user_id": 1} {"user_id": 2}]', "Expected ','"),
+    (b'[{"user_id": 1}] []', 'Unexpected data'),
+    (b'[{"user_id": ]', 'Invalid JSON'),
+    (b'["\xff"]', 'not valid UTF-8'),
+])
+def test_invalid_json_arrays(body, message):
+    with pytest.raises(BatchUpdateError, match=message):
+        list(iter_json_array(io.BytesIO(body), chunk_size=4))
+
+
+def test_items_before_a_truncation_are_yielded():
+    items = iter_json_array(io.BytesIO(b'[{"user_id": 1}, {"user_id": 2}, {"user_'))
+    assert next(items) == {'user_id': 1}
+    assert next(items) == {'user_id': 2}
+    with pytest.raises(BatchUpdateError):
+        next(items)
+
+
+def test_ndjson_invalid_line_becomes_an_error_item():
+    body = b'{"user_id": 1, "interests": {"hiking": 3}}\n\nnot json\n{"user_id": 2, "interests": {"music": 4}}\n'
+    items = list(iter_ndjson(io.BytesIO(body)))
+    assert len(items) == 3
+    assert items[0]['user_id'] == 1 and items[2]['user_id'] == 2
+    assert isinstance(items[1], BatchUpdateError)
+
+    with pytest.raises(BatchUpdateError, match='larger than'):
+        list(iter_ndjson(io.BytesIO(b'{"user_id": 1}' * 10), max_item_size=16))
+
+
+def test_parse_update():
+    item = {'user_id': 3, 'interests': {'hiking': 7, 'music': None}}
+    assert parse_update(item) == (3, {'hiking': 7.0, 'music': None})
+    assert parse_update({'interests': {'hiking': 1}}, default_user_id=9) == (9, {'hiking': 1.0})
+
+    for item, message in [
+        ([], 'must be an object'),
+        ({'interests': {'hiking': 1}}, 'user_id'),
+        ({'user_id': True, 'interests': {'hiking': 1}}, 'user_id'),
+        ({'user_id': 1, 'interests': {}}, 'non-empty'),
+        ({'user_id': 1, 'interests': {'knitting_backwards': 1}}, 'Unknown interests: knitting_backwards'),
+        ({'user_id': 1, 'interests': {'hiking': '7'}}, 'hiking must be a number'),
+        ({'user_id': 1, 'interests': {'hiking': float('nan')}}, 'hiking must be a number'),
+    ]:
+        with pytest.raises(BatchUpdateError, match=message):
+            parse_update(item)
+
+
+def test_apply_reports_a_status_per_item(flask_app, clean):
+    from database import SessionLocal
+    from models import User
+
+    make_user(flask_app, 'alice')
+    make_user(flask_app, 'bob')
+    session = SessionLocal()
+    ids = dict(session.query(User.username, User.id).all())
+    session.close()
+
+    committed = []
+    items = [
+        {'user_id': ids['alice'], 'interests': {'hiking': 8}},
+        {'user_id': ids['bob'], 'interests': {'hiking': 2}},
+        {'user_id': 999999, 'interests': {'hiking': 5}},
+        {'user_id': ids['alice'], 'interests': {'unknown_interest': 1}},
+        {'interests': {'music': 6}},
+    ]
+    results, error = apply_interest_batch(
+        items, SessionLocal, chunk_size=2, default_user_id=ids['alice'], allowed_user_id=ids['alice'],
+        on_commit=committed.append,
+    )
+
+    assert error is None
+    assert [result['status'] for result in results] == ['ok', 'error', 'error', 'error', 'ok']
+    assert [result['index'] for result in results] == [0, 1, 2, 3, 4]
+    assert results[1]['message'] == 'Not allowed to update this user'
+    assert results[2]['message'] == 'Not allowed to update this user'
+    assert results[3]['message'].startswith('Unknown interests')
+    assert committed == [{ids['alice']: {'hiking': 8.0, 'music': 6.0}}]
+
+    results, _ = apply_interest_batch([{'user_id': 999999, 'interests': {'hiking': 5}}], SessionLocal)
+    assert results == [{'index': 0, 'user_id': 999999, 'status': 'error', 'message': 'Unknown user'}]
+
+
+def test_apply_stops_at_an_unreadable_body(flask_app, clean):
+    from database import SessionLocal
+
+    body = io.BytesIO(b'[{"interests": {"hiking": 1}}, {"interests": ')
+    results, error = apply_interest_batch(iter_json_array(body), SessionLocal, default_user_id=999999)
+    assert len(results) == 1
+    assert 'Truncated' in error or 'Invalid JSON' in error
@@ -0,0 +1,126 @@
+# tests/test_batching.py
+
+import threading
+import time
+
+import pytest
+
+from batching import BatchingBackend, MicroBatcher
+from generation import DeadlineExceeded, GenerationBackend
+
+
+def test_next_batch_is_dispatched_while_one_is_running():
+    release = threading.Event()
+    running = []
+
+    def dispatch(prompts, max_new_tokens, deadline):
+        running.append(prompts)
+        if prompts == ['slow']:
+            release.wait(5)
+        return [prompt.upper() for prompt in prompts]
+
+    batcher = MicroBatcher(dispatch, max_batch_size=4, max_wait=0.01, max_in_flight=2)
+    results = {}
+
+    def submit(prompt):
+        results[prompt] = batcher.submit(prompt)
+
+    slow = threading.Thread(target=submit, args=('slow',))
+    slow.start()
+    time.sleep(0.05)
+    fast = threading.Thread(target=submit, args=('fast',))
+    fast.start()
+    fast.join(2)
+
+    assert results == {'fast': 'FAST'}  # Not stuck behind the running batch
+    release.set()
+    slow.join(2)
+    assert results['slow'] == 'SLOW'
+
+
+def test_prompts_wait_for_a_free_slot_and_go_out_together():
+    release = threading.Event()
+    batches = []
+
+    def dispatch(prompts, max_new_tokens, deadline):
+        batches.append(list(prompts))
+        release.wait(5)
+        return prompts
+
+    batcher = MicroBatcher(dispatch, max_batch_size=8, max_wait=0.01, max_in_flight=1)
+    threads = [threading.Thread(target=batcher.submit, args=(f'p{i}',)) for i in range(4)]
+    threads[0].start()
+    time.sleep(0.05)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+
+    assert batches[0] == ['p0']
+    assert sorted(batches[1]) == ['p1', 'p2', 'p3']
+
+
+def test_dispatch_errors_reach_every_caller():
+    def dispatch(prompts, max_new_tokens, deadline):
+        raise RuntimeError('backend down')
+
+    batcher = MicroBatcher(dispatch, max_wait=0.001)
+    try:
+        batcher.submit('hello')
+    except RuntimeError as e:
+        assert str(e) == 'backend down'
+    else:
+        raise AssertionError('expected the dispatch error')
+
+
+def test_submit_gives_up_at_the_deadline():
+    release = threading.Event()
+    batches = []
+
+    def dispatch(prompts, max_new_tokens, deadline):
+        batches.append((list(prompts), deadline))
+        release.wait(5)
+        return prompts
+
+    batcher = MicroBatcher(dispatch, max_wait=0.001, max_in_flight=1)
+    first = threading.Thread(target=batcher.submit, args=('running',))
+    first.start()
+    time.sleep(0.05)
+
+    # Queued behind the running batch: the caller gives up and the prompt is never sent
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        batcher.submit('queued', deadline=started + 0.1)
+    assert time.monotonic() - started < 1
+    release.set()
+    first.join(2)
+    assert batcher.submit('next', deadline=time.monotonic() + 5) == 'next'
+    assert [prompts for prompts, _ in batches] == [['running'], ['next']]
+    assert batches[0][1] is None and batches[1][1] is not None
+
+
+class SlowBatchBackend(GenerationBackend):
+    name = 'slow'
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.deadlines = []
+
+    def generate_batch(self, prompts, max_new_tokens=200, deadline=None):
+        self.deadlines.append(deadline)
+        self.release.wait(5)
+        return list(prompts)
+
+
+def test_batching_backend_passes_the_deadline_through():
+    backend = SlowBatchBackend()
+    batching = BatchingBackend(backend, max_wait=0.001)
+    deadline = time.monotonic() + 0.1
+    try:
+        with pytest.raises(DeadlineExceeded):
+            batching.generate('hi', deadline=deadline)
+        assert backend.deadlines == [deadline]
+    finally:
+        backend.release.set()
@@ -0,0 +1,34 @@
+# tests/test_benchmark.py
+
+import tracemalloc
+
+from benchmark import StageTimer, find_regressions
+
+
+def test_stages_are_timed_without_tracemalloc():
+    tracing = []
+
+    def stage():
+        tracing.append(tracemalloc.is_tracing())
+        return bytearray(1 << 20)
+
+    timer = StageTimer(10)
+    timer.run('stage', stage, repeat=3)
+
+    assert tracing == [False, False, False, True]  # Three timed calls, then the memory pass
+    assert timer.results[0]['peak_bytes'] >= 1 << 20
+    assert not tracemalloc.is_tracing()
+
+
+def test_memory_pass_can_be_skipped():
+    calls = []
+    timer = StageTimer(10, measure_memory=False)
+    timer.run('stage', lambda: calls.append(1))
+    assert calls == [1]
+    assert timer.results[0]['peak_bytes'] is None
+
+
+def test_find_regressions():
+    baseline = {'results': [{'users': 10, 'stage': 'load', 'seconds': 1.0}]}
+    results = [{'users': 10, 'stage': 'load', 'seconds': 1.5}, {'users': 10, 'stage': 'new', 'seconds': 9.0}]
+    assert [entry['stage'] for entry in find_regressions(results, baseline, 0.25)] == ['load']
@@ -0,0 +1,62 @@
+# tests/test_cache.py
+
+from cache import MemoryCache, ResponseCache, normalize_prompt
+from conftest import make_user
+
+
+def test_normalization_only_folds_case_and_whitespace():
+    assert normalize_prompt('  Yes\n\tplease ') == 'yes please'
+    assert normalize_prompt('no.') != normalize_prompt('no?')
+
+
+def test_prompts_differing_in_punctuation_have_their_own_entries():
+    cache = ResponseCache(MemoryCache())
+    cache.put('User: no.', 'Okay, noted.')
+    assert cache.get('User: no?') is None
+    assert cache.get('user:  NO.') == 'Okay, noted.'
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+
+
+def user_id_of(username):
+    from database import SessionLocal
+    from models import User
+
+    db_session = SessionLocal()
+    try:
+        return db_session.query(User.id).filter_by(username=username).scalar()
+    finally:
+        db_session.close()
+
+
+def test_profile_update_invalidates_the_cached_identity(app_module, flask_app, clean):
+    from database import SessionLocal
+    from models import User
+
+    client = make_user(flask_app, 'nia')
+    user_id = user_id_of('nia')
+    assert client.get('/profile').status_code == 200
+    assert app_module.identity_cache.get(user_id)['username'] == 'nia'
+
+    # Renamed behind the cache's back: the cached record is stale until the next write
+    db_session = SessionLocal()
+    db_session.query(User).filter_by(id=user_id).update({'username': 'nina'})
+    db_session.commit()
+    db_session.close()
+    client.get('/profile')
+    assert app_module.identity_cache.get(user_id)['username'] == 'nia'
+
+    assert client.post('/update_profile', json={'hiking': 6}).status_code == 200
+    assert app_module.identity_cache.get(user_id) is None
+    client.get('/profile')
+    assert app_module.identity_cache.get(user_id)['username'] == 'nina'
+
+
+def test_logout_invalidates_the_cached_identity(app_module, flask_app, clean):
+    client = make_user(flask_app, 'oli')
+    user_id = user_id_of('oli')
+    assert client.get('/profile').status_code == 200
+    assert app_module.identity_cache.get(user_id) is not None
+
+    assert client.post('/logout').status_code == 200
+    assert app_module.identity_cache.get(user_id) is None
+    assert client.get('/profile').status_code == 302
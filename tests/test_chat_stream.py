@@ -0,0 +1,96 @@
+# tests/test_chat_stream.py
+
+import json
+
+from conftest import make_user
+from generation import GenerationBackend, GenerationError
+from interests import INTEREST_POSITIONS
+
+
+class FakeStreamBackend(GenerationBackend):
+    # Streams the given chunks; fail_after raises once that many were sent
+    name = 'fake-stream'
+
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    def stream(self, prompt, max_new_tokens=200):
+        if self.fail_after == 0:
+            raise GenerationError('endpoint unreachable')
+        return self._tokens()
+
+    def _tokens(self):
+        for sent, chunk in enumerate(self.chunks):
+            if sent == self.fail_after:
+                raise GenerationError('connection reset')
+            yield chunk
+
+
+def read_events(response):
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        if block:
+            event_line, data_line = block.split('\n')
+            events.append((event_line[len('event: '):], json.loads(data_line[len('data: '):])))
+    return events
+
+
+def stream_chat(client, state, message='ok'):
+    response = client.post('/chat_api/stream', json={'message': message, 'conversation_state': state})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    return read_events(response)
+
+
+def user_id_of(username):
+    from database import SessionLocal
+    from models import User
+
+    db_session = SessionLocal()
+    try:
+        return db_session.query(User.id).filter_by(username=username).scalar()
+    finally:
+        db_session.close()
+
+
+def test_tokens_stream_and_end_with_done(app_module, flask_app, clean, monkeypatch):
+    monkeypatch.setattr(app_module, 'generation_backend', FakeStreamBackend(['  hello', ' there,', ' ready?']))
+    client = make_user(flask_app, 'pia')
+
+    events = stream_chat(client, 'start')
+    assert [name for name, _ in events] == ['token', 'token', 'token', 'done']
+    assert ''.join(data['text'] for _, data in events[:-1]) == '  hello there, ready?'
+    assert events[-1][1] == {'reply': 'Hello there, ready?', 'conversation_state': 'ready_check'}
+
+
+def test_internal_note_is_never_streamed(app_module, flask_app, clean, monkeypatch):
+    # The marker arrives split across chunks
+    chunks = ['Nice! How much ', 'do you like cooking?\nINTER', 'NAL_NO', 'TE: Interest: cooking, Value: 8']
+    monkeypatch.setattr(app_module, 'generation_backend', FakeStreamBackend(chunks))
+    client = make_user(flask_app, 'quin')
+
+    events = stream_chat(client, 'asking_questions')
+    streamed = ''.join(data['text'] for name, data in events if name == 'token')
+    assert streamed == 'Nice! How much do you like cooking?\n'
+    assert all('INTER' not in data['text'] for name, data in events if name == 'token')
+    assert events[-1] == ('done', {'reply': 'Nice! How much do you like cooking?',
+                                   'conversation_state': 'asking_questions'})
+    # The note itself still updates the profile
+    assert app_module.user_index.vector(user_id_of('quin'))[INTEREST_POSITIONS['cooking']] == 8
+
+
+def test_fallback_streams_when_the_backend_fails(app_module, flask_app, clean, monkeypatch):
+    client = make_user(flask_app, 'rex')
+
+    monkeypatch.setattr(app_module, 'generation_backend', FakeStreamBackend(['never sent'], fail_after=0))
+    events = stream_chat(client, 'start')
+    fallback = app_module.fallback_backend.generate(app_module.build_chat_prompt('start', 'ok'))
+    assert events == [('done', {'reply': fallback, 'conversation_state': 'start'})]
+
+    # Failing mid-stream: the tokens already sent are followed by the fallback reply
+    monkeypatch.setattr(app_module, 'generation_backend', FakeStreamBackend(['Hello', ' the', 're'], fail_after=2))
+    events = stream_chat(client, 'start')
+    assert [name for name, _ in events] == ['token', 'token', 'done']
+    assert events[-1][1] == {'reply': fallback, 'conversation_state': 'start'}
+    assert app_module.llm_cache.get(app_module.build_chat_prompt('start', 'ok')) is None
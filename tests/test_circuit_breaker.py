@@ -0,0 +1,201 @@
+# tests/test_circuit_breaker.py
+
+import threading
+import time
+
+import pytest
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError, DeadlineExceeded, ResilientBackend
+from conftest import make_user
+from generation import GenerationBackend, GenerationError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeBackend(GenerationBackend):
+    # Answers with `reply`, fails while `failing` is set, and blocks calls
+    # listed in `hold` (by call number) until `release` is set
+    name = 'fake'
+
+    def __init__(self, reply='ok', failing=False, hold=()):
+        self.reply = reply
+        self.failing = failing
+        self.hold = set(hold)
+        self.release = threading.Event()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate(self, prompt, max_new_tokens=200, deadline=None):
+        with self.lock:
+            self.calls += 1
+            number = self.calls
+        if number in self.hold:
+            self.release.wait(5)
+            return f'{self.reply} {number}'
+        if self.failing:
+            raise GenerationError('backend down')
+        return f'{self.reply} {number}'
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def make_breaker(clock, **options):
+    settings = dict(window_size=4, min_calls=4, failure_rate=0.5, open_seconds=10, half_open_probes=2, clock=clock)
+    settings.update(options)
+    return CircuitBreaker(**settings)
+
+
+def test_closed_open_half_open_closed():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    backend = FakeBackend(failing=True)
+    resilient = ResilientBackend(backend, breaker)
+
+    for _ in range(4):
+        with pytest.raises(GenerationError, match='backend down'):
+            resilient.generate('hi')
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # Rejected without reaching the backend until open_seconds have passed
+    with pytest.raises(CircuitOpenError):
+        resilient.generate('hi')
+    clock.advance(9.9)
+    with pytest.raises(CircuitOpenError):
+        resilient.generate('hi')
+    assert backend.calls == 4
+
+    clock.advance(0.1)
+    backend.failing = False
+    assert resilient.generate('hi') == 'ok 5'
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert resilient.generate('hi') == 'ok 6'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_a_failed_probe_reopens_the_circuit():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    backend = FakeBackend(failing=True)
+    resilient = ResilientBackend(backend, breaker)
+    for _ in range(4):
+        with pytest.raises(GenerationError):
+            resilient.generate('hi')
+
+    clock.advance(10)
+    with pytest.raises(GenerationError, match='backend down'):
+        resilient.generate('hi')
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        resilient.generate('hi')
+
+
+def test_half_open_admits_a_single_probe():
+    clock = FakeClock()
+    breaker = make_breaker(clock, half_open_probes=1)
+    backend = FakeBackend(hold={5})
+    resilient = ResilientBackend(backend, breaker)
+    backend.failing = True
+    for _ in range(4):
+        with pytest.raises(GenerationError):
+            resilient.generate('hi')
+    backend.failing = False
+    clock.advance(10)
+
+    # While the probe is in flight every other call is rejected
+    probe = threading.Thread(target=resilient.generate, args=('hi',))
+    probe.start()
+    assert wait_for(lambda: backend.calls == 5)
+    with pytest.raises(CircuitOpenError):
+        resilient.generate('hi')
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    backend.release.set()
+    probe.join(5)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert resilient.generate('hi') == 'ok 6'
+
+
+def test_stragglers_from_before_a_transition_are_ignored():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    straggler = breaker.acquire()
+    for _ in range(4):
+        breaker.record(breaker.acquire(), 0.01, False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.advance(10)
+    probes = [breaker.acquire(), breaker.acquire()]
+    assert all(permit.probe for permit in probes) and breaker.acquire() is None
+    breaker.record(straggler, 0.01, False)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_a_slow_call_is_hedged_after_the_latency_percentile():
+    breaker = make_breaker(time.monotonic, window_size=20, min_calls=5)
+    backend = FakeBackend(hold={1})
+    resilient = ResilientBackend(backend, breaker, hedge_percentile=90, min_hedge_delay=0.05)
+    for _ in range(5):
+        breaker.record(breaker.acquire(), 0.01, True)
+
+    started = time.monotonic()
+    try:
+        assert resilient.generate('hi') == 'ok 2'  # The hedge answered; the first call is still held
+        assert time.monotonic() - started < 1
+        assert backend.calls == 2
+    finally:
+        backend.release.set()
+
+
+def test_no_hedge_before_enough_latencies_are_known():
+    breaker = make_breaker(time.monotonic, window_size=20, min_calls=5)
+    backend = FakeBackend(hold={1})
+    resilient = ResilientBackend(backend, breaker, hedge_percentile=90, min_hedge_delay=0.05)
+
+    threading.Timer(0.3, backend.release.set).start()
+    assert resilient.generate('hi') == 'ok 1'
+    assert backend.calls == 1
+
+
+def test_deadline_exceeded_propagates_and_counts_as_a_failure():
+    breaker = make_breaker(time.monotonic)
+    backend = FakeBackend(hold={1})
+    resilient = ResilientBackend(backend, breaker)
+
+    started = time.monotonic()
+    try:
+        with pytest.raises(DeadlineExceeded):
+            resilient.generate('hi', deadline=started + 0.1)
+        assert time.monotonic() - started < 1
+        assert breaker.stats()['calls'] == 1 and breaker.stats()['failure_rate'] == 1.0
+    finally:
+        backend.release.set()
+
+
+def test_chat_falls_back_when_the_deadline_is_exceeded(app_module, flask_app, clean, monkeypatch):
+    backend = FakeBackend(reply='too late', hold={1})
+    monkeypatch.setattr(app_module, 'generation_backend', ResilientBackend(backend, make_breaker(time.monotonic)))
+    monkeypatch.setitem(app_module.GENERATION_DEADLINES, 'start', 0.1)
+    client = make_user(flask_app, 'dee')
+    try:
+        response = client.post('/chat_api', json={'message': 'hello', 'conversation_state': 'start'})
+    finally:
+        backend.release.set()
+    assert response.status_code == 200
+    assert 'too late' not in response.get_json()['reply']
+    assert backend.calls == 1
@@ -0,0 +1,62 @@
+# tests/test_clustering.py
+
+import os
+import threading
+
+import numpy as np
+
+from clustering import ClusteringService
+
+
+class FakeIndex:
+    def __init__(self, vectors):
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+
+    def snapshot(self):
+        user_ids = list(range(1, len(self.vectors) + 1))
+        return self.vectors.copy(), user_ids, {}
+
+
+def make_service(tmp_path, n_users=60):
+    rng = np.random.default_rng(0)
+    index = FakeIndex(rng.uniform(0, 10, size=(n_users, 4)))
+    return ClusteringService(index, model_path=str(tmp_path / 'model' / 'kmeans.joblib'), n_clusters=3)
+
+
+def test_concurrent_saves_leave_a_loadable_model(tmp_path):
+    service = make_service(tmp_path)
+    service.fit()
+
+    threads = [threading.Thread(target=service.save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(tmp_path / 'model') == ['kmeans.joblib']
+    reloaded = ClusteringService(service.user_index, model_path=service.model_path, n_clusters=3)
+    assert reloaded.load()
+    assert reloaded.user_clusters == service.user_clusters
+
+
+def test_record_change_defers_partial_fit(tmp_path):
+    service = make_service(tmp_path)
+    service.fit()
+    centroids = service.kmeans.cluster_centers_.copy()
+
+    service.record_change(1, np.full(4, 10.0))
+    service.record_change(999, np.zeros(4))
+    np.testing.assert_array_equal(service.kmeans.cluster_centers_, centroids)
+    assert 999 in service.user_clusters
+
+    assert service.apply_partial_fit() == 2
+    assert not np.array_equal(service.kmeans.cluster_centers_, centroids)
+    assert service.apply_partial_fit() == 0
+
+
+def test_refit_drops_pending_changes(tmp_path):
+    service = make_service(tmp_path)
+    service.fit()
+    service.record_change(1, np.full(4, 10.0))
+    service.fit()
+    assert service.apply_partial_fit() == 0
@@ -0,0 +1,31 @@
+# tests/test_database.py
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, TMP_DIR
+
+
+@pytest.mark.parametrize('url', ['sqlite://', 'sqlite:///:memory:'])
+def test_app_starts_on_an_in_memory_database(url):
+    # A fresh interpreter, since the engine is created when database.py is imported
+    script = (
+        'import threading\n'
+        'from database import init_db, SessionLocal\n'
+        'from models import User\n'
+        'import app\n'
+        'init_db()\n'
+        'app.create_app({"TESTING": True})\n'
+        'counts = []\n'
+        'thread = threading.Thread(target=lambda: counts.append(SessionLocal().query(User).count()))\n'
+        'thread.start(); thread.join()\n'
+        'print(counts[0])\n'
+    )
+    env = dict(os.environ, DATABASE_URL=url, WRITE_BEHIND_JOURNAL_DIR=os.path.join(TMP_DIR, 'memory-journal'))
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, capture_output=True, text=True,
+                            timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == '0'
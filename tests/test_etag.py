@@ -0,0 +1,111 @@
+# tests/test_etag.py
+
+from conftest import make_user
+
+
+def user_id_of(username):
+    from database import SessionLocal
+    from models import User
+
+    db_session = SessionLocal()
+    try:
+        return db_session.query(User.id).filter_by(username=username).scalar()
+    finally:
+        db_session.close()
+
+
+def test_first_revalidation_is_not_modified(app_module, flask_app, clean):
+    client = make_user(flask_app, 'fay', {'hiking': 8})
+    make_user(flask_app, 'gus', {'hiking': 7})
+    make_user(flask_app, 'hal', {'music': 9})
+    app_module.cluster_service.kmeans = None  # Cold worker: the model is loaded on the first request
+
+    first = client.get('/find_similar_users')
+    assert first.status_code == 200
+    again = client.get('/find_similar_users', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_write_by_another_worker_changes_the_etag(app_module, flask_app, clean):
+    from database import SessionLocal
+    from write_behind import write_interest_updates
+
+    client = make_user(flask_app, 'ivy', {'hiking': 8})
+    make_user(flask_app, 'jon', {'hiking': 7})
+    etag = client.get('/find_similar_users').headers['ETag']
+    version = app_module.user_index.version
+
+    # Committed by another process: this worker's index never sees it
+    write_interest_updates(SessionLocal, {user_id_of('jon'): {'hiking': 1}})
+    assert app_module.user_index.version == version
+
+    response = client.get('/find_similar_users', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_unflushed_chat_update_changes_the_etag_at_once(app_module, flask_app, clean):
+    client = make_user(flask_app, 'kim', {'hiking': 8})
+    make_user(flask_app, 'lou', {'hiking': 7})
+    etag = client.get('/find_similar_users').headers['ETag']
+
+    app_module.record_interest_updates(user_id_of('lou'), {'music': 9})
+    pending_etag = client.get('/find_similar_users', headers={'If-None-Match': etag}).headers['ETag']
+    assert pending_etag != etag
+
+    app_module.interest_buffer.flush()
+    flushed = client.get('/find_similar_users', headers={'If-None-Match': pending_etag})
+    assert flushed.status_code == 200 and flushed.headers['ETag'] not in (etag, pending_etag)
+
+
+def test_version_is_bumped_after_the_write_commits(app_module, flask_app, clean, monkeypatch):
+    import database
+
+    client = make_user(flask_app, 'max', {'hiking': 8})
+    session = database.SessionLocal()
+    before = database.read_population_version(session)[0]
+    session.close()
+
+    def fail(session_factory=None):
+        raise RuntimeError('counter row unavailable')
+
+    # The profile is saved even if the bump fails; the write is already committed
+    monkeypatch.setattr(database, 'bump_population_version', fail)
+    assert client.post('/update_profile', json={'hiking': 2}).status_code == 200
+    monkeypatch.undo()
+
+    assert client.post('/update_profile', json={'hiking': 3}).status_code == 200
+    session = database.SessionLocal()
+    assert database.read_population_version(session)[0] == before + 1
+    session.close()
+
+
+def test_body_matches_the_etag_after_another_workers_write(app_module, flask_app, clean):
+    from database import SessionLocal
+    from write_behind import write_interest_updates
+
+    client = make_user(flask_app, 'nia', {'hiking': 8})
+    make_user(flask_app, 'oz', {'hiking': 7})
+    first = client.get('/find_similar_users?min_hiking=5')
+    assert [user['username'] for user in first.get_json()['similar_users']] == ['oz']
+
+    # Committed by another process, then the same worker answers again
+    write_interest_updates(SessionLocal, {user_id_of('oz'): {'hiking': 1}})
+    second = client.get('/find_similar_users?min_hiking=5', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert second.get_json()['similar_users'] == []
+
+    # The body cached under the new ETag is the fresh one
+    assert client.get('/find_similar_users?min_hiking=5').get_json()['similar_users'] == []
+
+
+def test_own_write_changes_the_etag_between_syncs(app_module, flask_app, clean, monkeypatch):
+    client = make_user(flask_app, 'pia', {'hiking': 8})
+    make_user(flask_app, 'quin', {'hiking': 7})
+    monkeypatch.setattr(app_module.user_index, 'sync_interval', 3600.0)
+    etag = client.get('/find_similar_users?min_hiking=5').headers['ETag']
+
+    assert client.post('/update_profile', json={'hiking': 9}).status_code == 200
+    response = client.get('/find_similar_users?min_hiking=5', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
@@ -0,0 +1,59 @@
+# tests/test_extraction.py
+
+import pytest
+
+from conftest import make_user
+from extraction import extract_interests
+from interests import INTEREST_POSITIONS
+
+
+@pytest.mark.parametrize('message', [
+    "I don't have a pet",
+    "Sorry, I'm running late",
+    'I read your message',
+    'What is a podcast anyway?',
+])
+def test_bare_mentions_are_not_scored(message):
+    assert extract_interests(message) == {}
+
+
+@pytest.mark.parametrize('message, expected', [
+    ('zero interest in sports', {'sports': 2.0}),
+    ('I am not interested in video games', {'video_games': 2.0}),
+    ("I don't really love cooking", {'cooking': 2.0}),
+    ("Honestly I'm not a fan of chess", {'board_games': 2.0}),
+    ('I like movies but not so much podcasts', {'movies': 7.0, 'podcasts': 2.0}),
+])
+def test_negations(message, expected):
+    assert extract_interests(message) == expected
+
+
+@pytest.mark.parametrize('message, expected', [
+    ('Hiking? 8/10', {'hiking': 8.0}),
+    ('cooking is a 7 out of 10', {'cooking': 7.0}),
+    ('gardening: 5', {'gardening': 5.0}),
+    ('I love hiking', {'hiking': 9.0}),
+    ('I hike a lot. I love hiking!', {'hiking': 9.0}),
+])
+def test_ratings_and_sentiment(message, expected):
+    assert extract_interests(message) == expected
+
+
+def test_bare_mention_does_not_override_the_note(app_module, flask_app, clean):
+    import vector_db
+    from database import SessionLocal
+    from models import User
+
+    make_user(flask_app, 'erin', {'pets': 8})
+    db_session = SessionLocal()
+    user_id = db_session.query(User.id).filter_by(username='erin').scalar()
+    db_session.close()
+    response = 'Got it!\nINTERNAL_NOTE: Interest: pets, Value: 3'
+
+    extracted = app_module.apply_message_interests(user_id, "I don't have a pet")
+    app_module.finish_chat_turn('asking_questions', response, user_id, extracted)
+    assert vector_db.user_index.vector(user_id)[INTEREST_POSITIONS['pets']] == 3
+
+    extracted = app_module.apply_message_interests(user_id, 'My pets? 10/10')
+    app_module.finish_chat_turn('asking_questions', response, user_id, extracted)
+    assert vector_db.user_index.vector(user_id)[INTEREST_POSITIONS['pets']] == 10
@@ -0,0 +1,57 @@
+# tests/test_generation.py
+
+import time
+
+import pytest
+
+from generation import DeadlineExceeded, GenerationError, HuggingFaceBackend
+
+
+class FakeClient:
+    def __init__(self, fail_at_start=False, slow_prompts=()):
+        self.fail_at_start = fail_at_start
+        self.slow_prompts = slow_prompts
+
+    def text_generation(self, prompt, max_new_tokens=200, stream=False):
+        if prompt in self.slow_prompts:
+            time.sleep(0.5)
+        if self.fail_at_start:
+            raise ConnectionError('endpoint unreachable')
+        if not stream:
+            return 'Hello there'
+        return self._tokens()
+
+    def _tokens(self):
+        yield 'Hello'
+        raise ConnectionError('connection reset')
+
+
+def make_backend(**options):
+    backend = HuggingFaceBackend('fake-model')
+    backend.client = FakeClient(**options)
+    return backend
+
+
+def test_transport_error_before_the_stream_is_a_generation_error():
+    with pytest.raises(GenerationError):
+        make_backend(fail_at_start=True).stream('hi')
+
+
+def test_transport_error_while_streaming_is_a_generation_error():
+    tokens = make_backend().stream('hi')
+    assert next(tokens) == 'Hello'
+    with pytest.raises(GenerationError, match='connection reset'):
+        next(tokens)
+
+
+def test_generate():
+    assert make_backend().generate('hi') == 'Hello there'
+
+
+def test_batch_results_missing_at_the_deadline_are_deadline_errors():
+    backend = make_backend(slow_prompts={'slow'})
+    started = time.monotonic()
+    results = backend.generate_batch(['fast', 'slow'], deadline=started + 0.1)
+    assert time.monotonic() - started < 0.4
+    assert results[0] == 'Hello there'
+    assert isinstance(results[1], DeadlineExceeded)
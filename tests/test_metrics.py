@@ -0,0 +1,80 @@
+# tests/test_metrics.py
+
+from conftest import make_user
+from metrics import Registry
+
+
+def test_render_text_format():
+    registry = Registry(enabled=True)
+    requests = registry.counter('test_requests_total', 'Requests.', ['route'])
+    depth = registry.gauge('test_queue_depth', 'Queue depth.')
+    latency = registry.histogram('test_seconds', 'Latency.', ['stage'], buckets=(0.1, 1.0))
+
+    requests.inc(route='/home')
+    requests.inc(2, route='/home')
+    requests.inc(route='say "hi"\n')
+    depth.set(7)
+    latency.observe(0.05, stage='build')
+    latency.observe(0.5, stage='build')
+    latency.observe(3.0, stage='build')
+
+    assert registry.render().splitlines() == [
+        '# HELP test_requests_total Requests.',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{route="/home"} 3',
+        'test_requests_total{route="say \\"hi\\"\\n"} 1',
+        '# HELP test_queue_depth Queue depth.',
+        '# TYPE test_queue_depth gauge',
+        'test_queue_depth 7',
+        '# HELP test_seconds Latency.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="build",le="0.1"} 1',
+        'test_seconds_bucket{stage="build",le="1.0"} 2',
+        'test_seconds_bucket{stage="build",le="+Inf"} 3',
+        'test_seconds_sum{stage="build"} 3.55',
+        'test_seconds_count{stage="build"} 3',
+    ]
+
+
+def test_disabled_registry_records_nothing():
+    registry = Registry(enabled=False)
+    requests = registry.counter('test_requests_total', 'Requests.')
+    depth = registry.gauge('test_queue_depth', 'Queue depth.')
+    latency = registry.histogram('test_seconds', 'Latency.')
+
+    requests.inc()
+    depth.set(3)
+    latency.observe(0.2)
+    with latency.time():
+        pass
+    assert not requests.values and not depth.values and not latency.values
+    assert '\ntest_' not in registry.render()
+
+    # Turning it on takes effect without re-creating the metrics
+    registry.enabled = True
+    with latency.time():
+        pass
+    requests.inc()
+    assert 'test_requests_total 1' in registry.render()
+    assert 'test_seconds_count 1' in registry.render()
+
+
+def test_metrics_endpoint_is_off_by_default(app_module, client):
+    assert not app_module.metrics_registry.enabled
+    assert client.get('/metrics').status_code == 404
+
+
+def test_scrape_after_a_request(app_module, flask_app, clean, monkeypatch):
+    monkeypatch.setattr(app_module.metrics_registry, 'enabled', True)
+    client = make_user(flask_app, 'mia')
+    assert client.post('/chat_api', json={'message': 'hi', 'conversation_state': 'start'}).status_code == 200
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert '# TYPE interweave_llm_cache_requests_total counter' in body
+    assert 'interweave_llm_cache_requests_total{result="miss"}' in body
+    assert '# TYPE interweave_request_seconds histogram' in body
+    assert 'interweave_request_seconds_bucket{route="main.chat_api",status="200",le="+Inf"}' in body
+    assert 'interweave_request_seconds_count{route="main.chat_api",status="200"}' in body
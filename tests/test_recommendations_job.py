@@ -0,0 +1,90 @@
+# tests/test_recommendations_job.py
+
+import os
+
+from sqlalchemy import text
+
+from conftest import make_user
+
+
+def latest_run():
+    from database import SessionLocal
+    from models import RecommendationRun
+
+    db_session = SessionLocal()
+    try:
+        return db_session.query(RecommendationRun).order_by(RecommendationRun.id.desc()).first()
+    finally:
+        db_session.close()
+
+
+def make_groups(flask_app):
+    # Three well separated groups: every seed finds the same clusters, numbered differently
+    centres = [{'hiking': 9, 'music': 1}, {'hiking': 1, 'music': 9}, {'cooking': 9, 'video_games': 9}]
+    for i in range(15):
+        make_user(flask_app, f'rec{i}', dict(centres[i % 3], reading=i % 5 / 10))
+
+
+def test_match_labels():
+    from recommendations_job import match_labels
+
+    previous = {1: 0, 2: 0, 3: 1, 4: 1, 5: 2}
+    # Renumbered, plus a new user in a cluster of its own
+    translation, moved = match_labels(previous, {1: 4, 2: 4, 3: 0, 4: 0, 5: 1, 6: 2, 7: -1})
+    assert translation == {-1: -1, 4: 0, 0: 1, 1: 2, 2: 5}
+    assert moved == []
+
+    translation, moved = match_labels(previous, {1: 4, 2: 0, 3: 0, 4: 0, 5: 1})
+    assert translation[4] == 0 and translation[0] == 1
+    assert moved == [2]
+
+
+def test_refit_of_unchanged_data_keeps_runs_incremental(flask_app, clean):
+    import recommendations_job
+    from clustering import ClusteringService
+    from database import engine
+    from vector_db import UserVectorIndex
+
+    make_groups(flask_app)
+    index = UserVectorIndex()
+    index.load()
+    ClusteringService(index, os.environ['CLUSTER_MODEL_PATH'], n_clusters=3).fit()
+
+    assert recommendations_job.run(top_k=3, workers=1) == 15
+    first = latest_run()
+    assert first.full and first.model_hash
+
+    # Another worker refits with another seed: new parameters and labels, the same clusters
+    ClusteringService(index, os.environ['CLUSTER_MODEL_PATH'], n_clusters=3, random_state=7).fit()
+
+    assert recommendations_job.run(top_k=3, workers=1) == 0
+    second = latest_run()
+    assert not second.full
+    assert second.model_hash != first.model_hash and second.model_fitted_at != first.model_fitted_at
+
+    with engine.connect() as connection:
+        foreign_keys = connection.execute(text("PRAGMA foreign_key_list('recommendations')")).all()
+        indexes = [row[1] for row in connection.execute(text("PRAGMA index_list('recommendations')"))]
+    assert {row[2] for row in foreign_keys} == {'users'}
+    assert 'ix_recommendations_recommended_user_id' in indexes
+
+
+def test_many_users_changing_cluster_force_a_full_run(flask_app, clean):
+    import recommendations_job
+    from clustering import ClusteringService
+    from database import engine
+    from models import RecommendationState
+    from vector_db import UserVectorIndex
+
+    make_groups(flask_app)
+    index = UserVectorIndex()
+    index.load()
+    ClusteringService(index, os.environ['CLUSTER_MODEL_PATH'], n_clusters=3).fit()
+    assert recommendations_job.run(top_k=3, workers=1) == 15
+
+    # As if the previous run had seen a different split of two users
+    with engine.begin() as connection:
+        connection.execute(RecommendationState.__table__.update().where(
+            RecommendationState.user_id.in_([1, 2])).values(cluster_label=9))
+    assert recommendations_job.run(top_k=3, workers=1) == 15
+    assert latest_run().full
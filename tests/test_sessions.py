@@ -0,0 +1,18 @@
+# tests/test_sessions.py
+
+
+def test_login_without_secret_key_uses_server_side_sessions(app_module, clean, tmp_path, monkeypatch):
+    monkeypatch.setenv('SESSION_FILE_DIR', str(tmp_path / 'sessions'))
+    app = app_module.create_app({'TESTING': True, 'SECRET_KEY': None})
+    assert app.config['SESSION_TYPE'] == 'cachelib'
+
+    client = app.test_client()
+    client.post('/register', data={'username': 'dana', 'email': 'dana@example.com', 'password': 'secret'})
+    response = client.post('/login', data={'username': 'dana', 'password': 'secret'})
+    assert response.status_code == 302
+    assert client.get('/profile').status_code == 200
+    assert any((tmp_path / 'sessions').iterdir())
+
+
+def test_cookie_sessions_with_secret_key(flask_app):
+    assert 'SESSION_TYPE' not in flask_app.config
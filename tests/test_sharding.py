@@ -0,0 +1,138 @@
+# tests/test_sharding.py
+
+import socket
+import threading
+import time
+from multiprocessing import Pipe
+from multiprocessing.connection import Listener
+
+import numpy as np
+import pytest
+
+from sharding import ShardClient, ShardCoordinator, ShardTimeout, ensure_local_shards, serve_shard
+from vector_db import DerivedIndex
+
+AUTHKEY = b'test-authkey'
+
+
+def start_shard():
+    receiver, sender = Pipe(duplex=False)
+    threading.Thread(target=serve_shard, args=(('127.0.0.1', 0), AUTHKEY, sender), daemon=True).start()
+    return tuple(receiver.recv())
+
+
+def start_hung_shard():
+    # Accepts calls and never answers them
+    listener = Listener(('127.0.0.1', 0), authkey=AUTHKEY)
+    connections = []
+
+    def accept():
+        while True:
+            connections.append(listener.accept())
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.address
+
+
+def start_silent_server():
+    # Completes TCP connects from its backlog but never authenticates them
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+    return server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_writes_are_sent_in_the_background():
+    coordinator = ShardCoordinator([start_shard(), start_shard()], AUTHKEY)
+    try:
+        coordinator.upsert(1, np.array([1.0, 0.0], dtype=np.float32))
+        coordinator.upsert(2, np.array([0.0, 1.0], dtype=np.float32))
+
+        assert wait_for(lambda: len(coordinator.search(np.array([1.0, 0.1]), 5)) == 2)
+        assert coordinator.search(np.array([1.0, 0.1]), 1)[0][0] == 1
+    finally:
+        coordinator.close()
+
+
+def test_a_hung_shard_does_not_block_writes():
+    coordinator = ShardCoordinator([start_hung_shard()], AUTHKEY, write_timeout=0.1, retry_interval=0.05)
+    try:
+        started = time.perf_counter()
+        for user_id in range(20):
+            coordinator.upsert(user_id, np.ones(4, dtype=np.float32))
+        assert time.perf_counter() - started < 0.05
+
+        # The writes time out and stay queued for the next attempt
+        time.sleep(0.3)
+        assert len(coordinator.pending_writes) == 20
+    finally:
+        coordinator.close()
+    assert not coordinator.writer.is_alive()
+
+
+def test_connecting_to_a_silent_shard_times_out():
+    server = start_silent_server()
+    try:
+        client = ShardClient(server.getsockname(), AUTHKEY, connect_timeout=0.2)
+        started = time.perf_counter()
+        with pytest.raises(ShardTimeout, match='did not accept a connection'):
+            client.call('stats')
+        with pytest.raises(ShardTimeout):
+            client.call('stats', timeout=0.05)
+        assert time.perf_counter() - started < 1
+    finally:
+        server.close()
+
+
+def test_changes_before_the_first_build_are_replayed():
+    derived = DerivedIndex('test', dict, lambda index, user_id, vector: index.__setitem__(user_id, vector),
+                           replay=True)
+    derived.on_vector_changed(1, 'early')
+    assert derived.get() == {1: 'early'}
+
+    derived.invalidate()
+    derived.on_vector_changed(2, 'while invalid')
+    assert derived.get() == {2: 'while invalid'}
+
+
+def test_local_shards_are_shared(tmp_path):
+    base_port = free_port()
+    addresses, authkey, processes = ensure_local_shards(2, base_port=base_port, state_dir=str(tmp_path))
+    try:
+        assert len(processes) == 2
+        again, same_authkey, started = ensure_local_shards(2, base_port=base_port, state_dir=str(tmp_path))
+        assert again == addresses and same_authkey == authkey and started == []
+
+        user_ids = list(range(1, 101))
+        vectors = np.random.default_rng(0).uniform(0, 10, size=(100, 4)).astype(np.float32)
+        first = ShardCoordinator(addresses, authkey)
+        second = ShardCoordinator(again, same_authkey)
+        try:
+            assert first.load_missing(user_ids, vectors) == 100
+
+            # A second worker attaches to the loaded shards and sees the first one's writes
+            assert second.load_missing(user_ids, vectors[::-1]) == 0
+            first.upsert(500, vectors[0])
+            assert wait_for(lambda: any(user_id == 500 for user_id, _ in second.search(vectors[0], 3)))
+        finally:
+            first.close()
+            second.close()
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
@@ -0,0 +1,58 @@
+# tests/test_similarity_engine.py
+
+import numpy as np
+
+from vector_db import CosineSimilarityEngine, UserVectorIndex
+
+
+def make_engine(n_users=300, dim=22, **options):
+    rng = np.random.default_rng(1)
+    index = UserVectorIndex(initial_capacity=n_users)
+    index.loaded = True
+    for user_id in range(1, n_users + 1):
+        index.add_user(user_id, f'user{user_id}')
+        index.update_interests(user_id, dict(zip(index.interest_fields, rng.uniform(0, 10, dim))))
+    engine = CosineSimilarityEngine(index, **options)
+    index.add_listener(engine.on_vector_changed)
+    return index, engine
+
+
+def brute_force(index, target_user_id, top_n):
+    vectors, user_ids, _ = index.snapshot()
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ normalized[user_ids.index(target_user_id)]
+    order = [i for i in np.argsort(-scores) if user_ids[i] != target_user_id]
+    return [user_ids[i] for i in order[:top_n]]
+
+
+def test_top_k_matches_brute_force():
+    index, engine = make_engine()
+    for target in (1, 77, 300):
+        assert [user_id for user_id, _ in engine.top_k(target, 10)] == brute_force(index, target, 10)
+
+
+def test_top_k_batch_bounds_the_score_matrix():
+    index, engine = make_engine(max_block_bytes=4 * 300 * 7)  # Room for 7 targets per chunk
+    results = engine.top_k_batch(list(range(1, 51)) + [12345], top_n=5)
+
+    assert engine._chunk_size() == 7
+    for target in (1, 25, 50):
+        assert [user_id for user_id, _ in results[target]] == brute_force(index, target, 5)
+    assert results[12345] == []
+
+
+def test_chunk_size_shrinks_with_the_population():
+    _, engine = make_engine(n_users=10)
+    engine.refresh()
+    engine.user_ids = list(range(200000))
+    assert engine._chunk_size() * 200000 * 4 <= engine.max_block_bytes
+    assert engine._chunk_size() < engine.batch_size
+
+
+def test_changed_vector_is_ranked_with_its_new_norm():
+    index, engine = make_engine(n_users=50)
+    engine.top_k(1, 5)
+    index.update_interests(2, {field: 1.0 for field in index.interest_fields})
+    index.update_interests(1, {field: 1.0 for field in index.interest_fields})
+    user_id, similarity = engine.top_k(1, 1)[0]
+    assert user_id == 2 and abs(similarity - 1.0) < 1e-5
@@ -0,0 +1,170 @@
+# tests/test_user_index.py
+
+import numpy as np
+import pytest
+
+from conftest import make_user
+from interests import INTEREST_POSITIONS, pack_interests
+from models import User
+
+
+def test_index_matches_database_after_writes(flask_app, clean):
+    import vector_db
+
+    make_user(flask_app, 'alice', {'hiking': 8, 'cooking': 3})
+    make_user(flask_app, 'bob', {'hiking': 2})
+    vector_db.user_index.ensure_loaded()
+    make_user(flask_app, 'carol', {'music': 9})
+
+    vectors, user_ids, _ = vector_db.user_index.snapshot()
+    fresh = vector_db.UserVectorIndex()
+    fresh.load()
+    fresh_vectors, fresh_ids, _ = fresh.snapshot()
+
+    assert sorted(user_ids) == sorted(fresh_ids)
+    order = [user_ids.index(user_id) for user_id in fresh_ids]
+    np.testing.assert_array_equal(vectors[order], fresh_vectors)
+
+
+def test_update_interests_changes_row_in_place(clean):
+    import vector_db
+
+    index = vector_db.UserVectorIndex()
+    index.loaded = True
+    index.add_user(1, 'alice')
+    index.update_interests(1, {'hiking': 7, 'cooking': None})
+
+    vector = index.vector(1)
+    assert vector[INTEREST_POSITIONS['hiking']] == 7
+    assert vector[INTEREST_POSITIONS['cooking']] == 0
+    assert index.usernames([1]) == {1: 'alice'}
+
+
+def test_listeners_see_every_change(clean):
+    import vector_db
+
+    index = vector_db.UserVectorIndex()
+    index.loaded = True
+    seen = []
+    index.add_listener(lambda user_id, vector: seen.append((user_id, vector[INTEREST_POSITIONS['music']])))
+    index.add_user(1, 'alice')
+    index.update_interests(1, {'music': 4})
+    assert seen == [(1, 0.0), (1, 4.0)]
+
+
+def make_store_index(tmp_path, vectors, **options):
+    import vector_db
+    from vector_store import VectorStore, write_vector_store
+
+    path = str(tmp_path / 'users.vec')
+    write_vector_store(path, [1, 2, 3], vectors)
+    index = vector_db.UserVectorIndex()
+    index.use_store(VectorStore(path, check_interval=0), **options)
+    index.ensure_loaded()
+    return index, path
+
+
+def test_remap_rebuilds_derived_indexes(tmp_path):
+    import time
+
+    import vector_db
+    from vector_store import write_vector_store
+
+    dim = len(INTEREST_POSITIONS)
+    index, path = make_store_index(tmp_path, np.ones((3, dim), dtype=np.float32))
+
+    def build():
+        vectors, user_ids, _ = index.snapshot()
+        return {user_id: vector[0] for user_id, vector in zip(user_ids, vectors)}
+
+    derived = vector_db.DerivedIndex(
+        'test', build, lambda built, user_id, vector: built.__setitem__(user_id, vector[0])
+    )
+    index.add_listener(derived.on_vector_changed)
+    index.add_reload_listener(derived.rebuild)
+    assert derived.get() == {1: 1.0, 2: 1.0, 3: 1.0}
+
+    write_vector_store(path, [1, 2, 3], np.full((3, dim), 5.0, dtype=np.float32))
+    index.ensure_loaded()
+
+    deadline = time.monotonic() + 5
+    while derived.index[2] != 5.0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert derived.get() == {1: 5.0, 2: 5.0, 3: 5.0}
+
+
+def test_recent_changes_are_capped(tmp_path):
+    import time
+
+    dim = len(INTEREST_POSITIONS)
+    index, _ = make_store_index(tmp_path, np.zeros((3, dim), dtype=np.float32), max_recent_changes=3)
+    for user_id in range(1, 11):
+        index.update_interests(user_id, {'hiking': user_id})
+    assert list(index.recent_changes) == [8, 9, 10]
+
+    # Changes older than change_ttl are dropped on the next change
+    index.recent_changes[8] = (time.time() - 7200, index.recent_changes[8][1])
+    index.update_interests(9, {'hiking': 1})
+    assert list(index.recent_changes) == [10, 9]
+
+
+def user_id_of(username):
+    from database import SessionLocal
+    from models import User
+
+    db_session = SessionLocal()
+    try:
+        return db_session.query(User.id).filter_by(username=username).scalar()
+    finally:
+        db_session.close()
+
+
+def test_writes_by_other_workers_are_synced(app_module, flask_app, clean):
+    from database import SessionLocal
+    from write_behind import write_interest_updates
+
+    client = make_user(flask_app, 'ivy', {'hiking': 8})
+    make_user(flask_app, 'jon', {'hiking': 7})
+    ranked = client.get('/similar_users_ranked').get_json()['similar_users']
+    assert ranked[0]['username'] == 'jon' and ranked[0]['similarity'] == pytest.approx(1.0)
+
+    # Committed by another process: only the shared change log tells this worker
+    write_interest_updates(SessionLocal, {user_id_of('jon'): {'hiking': None, 'music': 9}})
+    ranked = client.get('/similar_users_ranked').get_json()['similar_users']
+    assert ranked[0]['username'] == 'jon' and ranked[0]['similarity'] == pytest.approx(0.0)
+
+
+def test_sync_keeps_buffered_updates_and_reloads_when_the_log_is_pruned(app_module, flask_app, clean):
+    import vector_db
+    from database import SessionLocal, bump_population_version
+    from models import PopulationVersion
+    from write_behind import write_interest_updates
+
+    make_user(flask_app, 'kim', {'hiking': 8})
+    make_user(flask_app, 'lou', {'hiking': 7})
+    index = vector_db.user_index
+    index.sync()
+    kim, lou = user_id_of('kim'), user_id_of('lou')
+
+    # A chat update still waiting in this worker's buffer survives the reload of the row
+    app_module.record_interest_updates(kim, {'music': 5})
+    write_interest_updates(SessionLocal, {kim: {'cooking': 3}})
+    assert index.sync() == index.synced_version
+    vector = index.vector(kim)
+    assert vector[INTEREST_POSITIONS['music']] == 5 and vector[INTEREST_POSITIONS['cooking']] == 3
+    app_module.interest_buffer.flush()
+
+    # Another worker's change whose log entry is gone: everything is reloaded
+    session = SessionLocal()
+    session.execute(User.__table__.update().where(User.id == lou).values(
+        interest_vector=pack_interests({'hiking': 1})
+    ))
+    session.commit()
+    session.close()
+    version = bump_population_version()
+    session = SessionLocal()
+    session.query(PopulationVersion).update({'pruned_through': version})
+    session.commit()
+    session.close()
+    assert index.sync() == version
+    assert index.vector(lou)[INTEREST_POSITIONS['hiking']] == 1
@@ -0,0 +1,157 @@
+# tests/test_vector_store.py
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from interests import INTEREST_DIM, INTEREST_POSITIONS
+from vector_store import LEGACY_HEADERS, VectorStore, VectorStoreWriter, write_vector_store
+
+
+def make_vectors(n_users, dim=INTEREST_DIM, seed=0):
+    return np.random.default_rng(seed).uniform(0, 10, size=(n_users, dim)).astype(np.float32)
+
+
+def make_store_index(path, **options):
+    import vector_db
+
+    index = vector_db.UserVectorIndex()
+    index.use_store(VectorStore(path, check_interval=0), **options)
+    index.ensure_loaded()
+    return index
+
+
+def test_float32_round_trip(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    user_ids = [3, 7, 11, 20]
+    vectors = make_vectors(4)
+    write_vector_store(path, user_ids, vectors, created_at=123.5, population_version=42)
+
+    mapped = VectorStore(path).open()
+    assert mapped.ids.tolist() == user_ids
+    assert mapped.count == 4 and mapped.created_at == 123.5 and mapped.population_version == 42
+    np.testing.assert_array_equal(mapped.vectors[:4], vectors)
+    # Headroom rows for new users are mapped but empty
+    assert mapped.vectors.shape == (4 + 1024, INTEREST_DIM)
+    assert not mapped.vectors[4:].any()
+
+
+def test_int8_round_trip(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    vectors = make_vectors(50)
+    vectors[3] = 0.0
+    write_vector_store(path, range(1, 51), vectors, quantize=True)
+
+    mapped = VectorStore(path).open()
+    assert mapped.ids.tolist() == list(range(1, 51))
+    scales = np.abs(vectors).max(axis=1, keepdims=True) / 127
+    assert np.all(np.abs(mapped.vectors[:50] - vectors) <= scales / 2 + 1e-6)
+    assert not mapped.vectors[3].any()
+
+    write_vector_store(str(tmp_path / 'float.vec'), range(1, 51), vectors)
+    assert os.path.getsize(path) < os.path.getsize(str(tmp_path / 'float.vec'))
+
+
+def test_chunked_writes_and_capacity(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    vectors = make_vectors(10)
+    writer = VectorStoreWriter(path, INTEREST_DIM, capacity=10)
+    writer.append(range(1, 6), vectors[:5])
+    writer.append(range(6, 11), vectors[5:])
+    with pytest.raises(ValueError, match='capacity 10 exceeded'):
+        writer.append([11], vectors[:1])
+    writer.close()
+
+    mapped = VectorStore(path).open()
+    assert mapped.ids.tolist() == list(range(1, 11))
+    np.testing.assert_array_equal(mapped.vectors[:10], vectors)
+
+    aborted = VectorStoreWriter(path, INTEREST_DIM, capacity=10)
+    aborted.append([1], vectors[:1])
+    aborted.abort()
+    assert os.listdir(tmp_path) == ['users.vec']
+
+
+def test_a_new_version_is_swapped_in_atomically(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    write_vector_store(path, [1, 2], np.ones((2, INTEREST_DIM), dtype=np.float32))
+    store = VectorStore(path, check_interval=0)
+    old = store.open()
+    assert not store.changed()
+
+    # Until close() the new version is only a temporary file
+    writer = VectorStoreWriter(path, INTEREST_DIM, capacity=4)
+    writer.append([1, 2, 3], np.full((3, INTEREST_DIM), 2.0, dtype=np.float32))
+    assert VectorStore(path).open().count == 2
+    writer.close()
+
+    assert store.changed()
+    assert os.listdir(tmp_path) == ['users.vec']
+    new = store.open()
+    assert new.ids.tolist() == [1, 2, 3] and new.vectors[2, 0] == 2.0
+    # A mapping of the replaced version keeps reading it
+    assert old.ids.tolist() == [1, 2] and old.vectors[1, 0] == 1.0
+
+
+def test_legacy_files_have_no_population_version(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    write_vector_store(path, [1], make_vectors(1), created_at=5.0)
+    with open(path, 'r+b') as f:
+        header = f.read(LEGACY_HEADERS[b'IWVECS01'].size)
+        f.seek(0)
+        f.write(b'IWVECS01' + header[8:])
+
+    mapped = VectorStore(path).open()
+    assert mapped.ids.tolist() == [1] and mapped.created_at == 5.0 and mapped.population_version is None
+
+    with open(path, 'r+b') as f:
+        f.write(b'NOTAVECS')
+    with pytest.raises(ValueError, match='not a vector store file'):
+        VectorStore(path).open()
+
+
+def test_new_users_use_the_headroom_without_touching_the_file(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    write_vector_store(path, [1, 2, 3], make_vectors(3), population_version=1)
+    index = make_store_index(path)
+    capacity = index.vectors.shape[0]
+
+    index.add_user(4, 'dana')
+    index.update_interests(4, {'hiking': 9})
+    index.update_interests(1, {'hiking': 1})
+    assert index.vectors.shape[0] == capacity and isinstance(index.vectors, np.memmap)
+    assert index.vector(4)[INTEREST_POSITIONS['hiking']] == 9
+
+    # Rows are copied on write: the file and other workers' mappings are unchanged
+    mapped = VectorStore(path).open()
+    assert mapped.ids.tolist() == [1, 2, 3]
+    assert not mapped.vectors[3].any()
+    assert mapped.vectors[0, INTEREST_POSITIONS['hiking']] != 1
+
+
+def test_recent_writes_are_replayed_onto_a_remapped_version(tmp_path):
+    path = str(tmp_path / 'users.vec')
+    vectors = make_vectors(3)
+    write_vector_store(path, [1, 2, 3], vectors, population_version=1)
+    index = make_store_index(path, replay_margin=60)
+    index.add_user(4, 'dana')
+    index.update_interests(4, {'hiking': 9})
+    index.update_interests(2, {'hiking': 1})
+
+    # Written while those changes happened: it may have missed them
+    write_vector_store(path, [1, 2, 3], vectors + 1, created_at=time.time(), population_version=2)
+    index.ensure_loaded()
+    assert index.synced_version == 2
+    assert index.vector(2)[INTEREST_POSITIONS['hiking']] == 1
+    assert index.vector(4)[INTEREST_POSITIONS['hiking']] == 9
+    assert index.vector(1)[0] == vectors[0, 0] + 1
+
+    # Written well after them: the file wins and the changes are dropped
+    later = make_vectors(4, seed=1)
+    write_vector_store(path, [1, 2, 3, 4], later, created_at=time.time() + 600, population_version=3)
+    index.ensure_loaded()
+    assert not index.recent_changes
+    np.testing.assert_array_equal(index.vector(2), later[1])
+    np.testing.assert_array_equal(index.vector(4), later[3])
@@ -0,0 +1,116 @@
+# tests/test_write_behind.py
+
+import os
+
+import pytest
+
+from write_behind import InterestWriteBuffer
+
+
+class RecordingBuffer(InterestWriteBuffer):
+    def __init__(self, journal_dir):
+        super().__init__(None, str(journal_dir), flush_interval=3600, fsync=False)
+        self.written = []
+
+    def _write(self, batch):
+        self.written.append(batch)
+
+
+def segments(journal_dir):
+    return sorted(name for name in os.listdir(journal_dir) if name.endswith('.jsonl'))
+
+
+def crash(buffer):
+    # Drop the process's locks and files without flushing, as if it was killed
+    buffer.stopped.set()
+    buffer.journal.close()
+    buffer.owner_lock.close()
+
+
+@pytest.fixture
+def journal_dir(tmp_path):
+    return tmp_path / 'journal'
+
+
+def test_workers_do_not_replay_each_others_live_segments(journal_dir):
+    first = RecordingBuffer(journal_dir)
+    first.start()
+    first.record(1, 'hiking', 7)
+
+    second = RecordingBuffer(journal_dir)
+    second.start()
+    second.record(2, 'music', 3)
+    assert second.pending == {2: {'music': 3}}
+    assert len(set(segments(journal_dir))) == 2  # One segment per worker, never the same name
+
+    assert first.flush() == 1 and second.flush() == 1
+    assert first.written == [{1: {'hiking': 7}}]
+    assert second.written == [{2: {'music': 3}}]
+    first.close()
+    second.close()
+    assert segments(journal_dir) == []
+
+
+def test_segments_of_a_dead_worker_are_replayed_once(journal_dir):
+    dead = RecordingBuffer(journal_dir)
+    dead.start()
+    dead.record(1, 'hiking', 7)
+    dead.record(1, 'hiking', 8)
+    crash(dead)
+
+    live = RecordingBuffer(journal_dir)
+    live.start()  # Claims the segments and asks its flush thread to write them
+
+    late = RecordingBuffer(journal_dir)
+    late.start()
+    assert late.pending == {}  # Already claimed by the live worker
+
+    live.flush()
+    assert live.written == [{1: {'hiking': 8}}]
+    live.close()
+    late.close()
+    assert segments(journal_dir) == []
+    assert not any(name.startswith('owner-') for name in os.listdir(journal_dir))
+
+
+def test_unnamed_segments_from_older_versions_are_replayed(journal_dir):
+    os.makedirs(journal_dir)
+    with open(journal_dir / 'interest-updates-0000000003.jsonl', 'w') as f:
+        f.write('{"user_id": 4, "interest": "music", "value": 2}\n{"user_id": 4, "inte')  # Torn last line
+
+    buffer = RecordingBuffer(journal_dir)
+    buffer.start()
+    buffer.close()
+    assert buffer.written == [{4: {'music': 2}}]
+
+
+def test_concurrent_merges_into_one_user_are_not_lost(flask_app, clean):
+    import threading
+
+    from conftest import make_user
+    from database import SessionLocal
+    from interests import INTEREST_FIELDS, INTEREST_POSITIONS, unpack_interests
+    from models import User
+    from write_behind import write_interest_updates
+
+    make_user(flask_app, 'alice')
+    session = SessionLocal()
+    user_id = session.query(User.id).filter_by(username='alice').scalar()
+    session.close()
+
+    fields = INTEREST_FIELDS[:4]
+
+    def merge(field):
+        for value in range(1, 31):
+            write_interest_updates(SessionLocal, {user_id: {field: float(value)}})
+
+    threads = [threading.Thread(target=merge, args=(field,)) for field in fields]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    session = SessionLocal()
+    vector = unpack_interests(session.get(User, user_id).interest_vector)
+    session.close()
+    assert [vector[INTEREST_POSITIONS[field]] for field in fields] == [30.0] * len(fields)
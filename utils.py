@@ -1,6 +1,7 @@
 import numpy as np
 import json
-from sklearn.metrics.pairwise import cosine_similarity
+
+from extraction import interest_extractor
 
 
 # Function to compute user embedding from their interests or activity
@@ -31,28 +32,17 @@ def deduce_interest_and_relevance(message):
     Takes a user message as input and returns a tuple:
     (interest, interest_score, relevance_score).
 
-    This is a simple example function. In a more advanced implementation,
-    NLP techniques (such as a pre-trained model) can be used to extract
-    topics of interest from the message.
+    Uses the compiled lexicon in extraction.py and reports the most relevant
+    interest mentioned (the first one on ties); use
+    extraction.interest_extractor directly to get every match.
     """
-    # For this example, we'll check for predefined keywords (this could be replaced with NLP models)
-    possible_interests = {
-        'sports': ['football', 'soccer', 'basketball', 'tennis'],
-        'music': ['guitar', 'piano', 'singing', 'rock', 'pop'],
-        'movies': ['film', 'cinema', 'actor', 'director'],
-        # Add more categories and keywords as needed
-    }
+    matches = interest_extractor.extract(message)
+    if not matches:
+        # No interest found
+        return None, 0.0, 0.0
 
-    for interest, keywords in possible_interests.items():
-        for keyword in keywords:
-            if keyword.lower() in message.lower():
-                # Assign arbitrary scores (this can be more sophisticated)
-                interest_score = np.random.uniform(0.7, 1.0)  # Interest score (0-1)
-                relevance_score = np.random.uniform(0.5, 1.0)  # Relevance score (0-1)
-                return interest, interest_score, relevance_score
-
-    # No interest found
-    return None, 0.0, 0.0
+    best = max(matches, key=lambda found: found.relevance)
+    return best.interest, best.score / 10.0, best.relevance
 
 
 # Function to calculate similarity between two embeddings
@@ -60,6 +50,8 @@ def calculate_similarity(embedding1, embedding2):
     """
     Computes the cosine similarity between two embeddings.
     """
+    from sklearn.metrics.pairwise import cosine_similarity  # Heavy import, only needed here
+
     if embedding1 is None or embedding2 is None:
         return 0.0
 
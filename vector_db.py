@@ -1,9 +1,925 @@
 # vector_db.py
 
+import atexit
+import logging
+import os
+import threading
+import time
+
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from database import SessionLocal
+from database import SessionLocal, ReadSessionLocal, read_population_changes, read_population_version
 from models import User
+from ann_index import create_index, load_index, recall_at_k, tune_n_probe
+from attribute_index import InterestAttributeIndex
+from sharding import ShardCoordinator, ensure_local_shards, parse_addresses
+from vector_store import VectorStore
+from interests import INTEREST_FIELDS, unpack_interest_matrix
+from metrics import ANN_N_PROBE, ANN_RECALL, RECOMMENDATION_STAGE_SECONDS
+
+class UserVectorIndex:
+    """
+    Process-resident interest matrix for all users.
+
+    The matrix is a contiguous float32 array with one row per user, loaded
+    from the database once and then kept up to date in place by the write
+    paths (profile updates, chat-derived interests, registrations), so the
+    recommendation routes never have to scan the users table. Writes made
+    by other workers are picked up by sync(), which reloads just the rows
+    the shared population change log names.
+
+    Every change bumps version, so (epoch, version) identifies the population
+    this process ranks against; epoch is random per process, so stamps from
+    different workers never collide.
+
+    With a vector store (see use_store()) the matrix is mapped from the shared
+    file instead of read from the database, and remapped when the updater
+    publishes a new version; this process's own recent changes are replayed
+    onto it, since the new file may predate them. Usernames are then looked
+    up on demand. Indexes built from the matrix are told about a remap
+    through their reload listeners.
+    """
+
+    def __init__(self, interest_fields=INTEREST_FIELDS, initial_capacity=1024):
+        self.interest_fields = list(interest_fields)
+        self.field_positions = {field: i for i, field in enumerate(self.interest_fields)}
+        self.vectors = np.zeros((initial_capacity, len(self.interest_fields)), dtype=np.float32)
+        self.user_ids = []
+        self.id_to_row = {}
+        self.user_data = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.reload_listeners = []
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.modified_at = time.time()
+        self.store = None
+        self.replay_margin = 0.0
+        self.change_ttl = 0.0
+        self.max_recent_changes = 0
+        self.recent_changes = {}  # user_id -> (time, vector) changed since the mapped version, oldest first
+        self.synced_version = 0  # Shared population version the matrix reflects
+        self.sync_interval = 1.0
+        self.synced_at = 0.0
+        self.version_at_sync = None  # Local version after the last sync
+        self.sync_lock = threading.Lock()
+        self.pending_overlay = None  # pending_overlay(user_id) -> {interest: value} not committed yet
+
+    def _bump(self):
+        # Called with the lock held after any change to the population
+        self.version += 1
+        self.modified_at = time.time()
+
+    def version_stamp(self):
+        """
+        Return a string that changes whenever any user's vector changes.
+
+        Returns:
+        - stamp (str): The population version.
+        - modified_at (float): Unix time of the last change.
+        """
+        with self.lock:
+            return f"{self.epoch}.{self.version}", self.modified_at
+
+    def add_listener(self, listener):
+        """
+        Register a callable invoked as listener(user_id, vector) after a row changes.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, user_id, vector):
+        for listener in self.listeners:
+            listener(user_id, vector)
+
+    def add_reload_listener(self, listener):
+        """
+        Register a callable invoked as listener() after a loaded matrix is
+        replaced, e.g. by a new version of the vector store, when per-row
+        notifications were not sent for the rows that changed.
+        """
+        self.reload_listeners.append(listener)
+
+    def _notify_reload(self):
+        for listener in self.reload_listeners:
+            try:
+                listener()
+            except Exception as e:
+                logging.error(f"Reload listener failed: {e}")
+
+    def use_store(self, store, replay_margin=60.0, change_ttl=3600.0, max_recent_changes=100000):
+        """
+        Map the matrix from a shared vector file instead of the database.
+
+        Args:
+        - store (VectorStore): The vector file; the database is still used
+          while it does not exist yet.
+        - replay_margin (float): Seconds before a version's creation time from
+          which local changes are replayed onto it, to cover writes the
+          updater may have missed while reading.
+        - change_ttl (float): Seconds a local change is kept for replay; only
+          a version that took longer than this to write could still need it.
+        - max_recent_changes (int): Most local changes kept for replay; the
+          oldest are dropped first.
+        """
+        with self.lock:
+            self.store = store
+            self.replay_margin = replay_margin
+            self.change_ttl = change_ttl
+            self.max_recent_changes = max_recent_changes
+            self.loaded = False
+
+    def _map_store(self):
+        with RECOMMENDATION_STAGE_SECONDS.time(stage='store_map'):
+            mapped = self.store.open()
+            user_ids = mapped.ids.tolist()
+            id_to_row = {user_id: i for i, user_id in enumerate(user_ids)}
+        population_version = mapped.population_version
+        if population_version is None:
+            # Written before files kept it: the best guess is the current one
+            db_session = ReadSessionLocal()
+            try:
+                population_version, _ = read_population_version(db_session)
+            finally:
+                db_session.close()
+
+        with self.lock:
+            self.vectors = mapped.vectors
+            self.user_ids = user_ids
+            self.id_to_row = id_to_row
+            cutoff = mapped.created_at - self.replay_margin
+            self.recent_changes = {
+                user_id: change for user_id, change in self.recent_changes.items() if change[0] >= cutoff
+            }
+            for user_id, (_, vector) in self.recent_changes.items():
+                self.vectors[self._row_for(user_id)] = vector
+            self.synced_version = population_version
+            self.loaded = True
+            self._bump()
+        logging.info(f"Mapped {mapped.count} user vectors from {self.store.path}")
+
+    def load(self):
+        """
+        Load every user's packed interest vector with a single column query,
+        or map them from the vector store if one is configured.
+        """
+        reloading = self.loaded
+        if self.store is not None and self.store.exists():
+            self._map_store()
+            if reloading:
+                self._notify_reload()
+            return
+
+        with RECOMMENDATION_STAGE_SECONDS.time(stage='db_load'):
+            db_session = ReadSessionLocal()
+            try:
+                # Read first: the rows are at least as new as this version
+                population_version, _ = read_population_version(db_session)
+                rows = db_session.query(User.id, User.username, User.interest_vector).all()
+            finally:
+                db_session.close()
+
+        with self.lock:
+            capacity = max(len(rows), self.vectors.shape[0])
+            self.vectors = np.zeros((capacity, len(self.interest_fields)), dtype=np.float32)
+            if rows:
+                self.vectors[:len(rows)] = unpack_interest_matrix([row[2] for row in rows])
+            self.user_ids = [row[0] for row in rows]
+            self.id_to_row = {user_id: i for i, user_id in enumerate(self.user_ids)}
+            self.user_data = {row[0]: {'username': row[1]} for row in rows}
+            self.synced_version = population_version
+            self.loaded = True
+            self._bump()
+        if reloading:
+            self._notify_reload()
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+        elif self.store is not None and self.store.changed():
+            self.load()  # The updater published a new version
+
+    def sync(self, force=False):
+        """
+        Apply the writes other workers committed since the matrix was loaded
+        or last synced: the users changed since then are read from the
+        shared population change log and their rows reloaded from the
+        database. Runs at most every sync_interval seconds unless forced or
+        the matrix changed locally since the last sync (a local write bumps
+        the shared version too, so the version returned would otherwise not
+        cover it), and reloads everything if the log was pruned past this
+        version.
+
+        Returns:
+        - int: The population version the matrix now reflects.
+        """
+        self.ensure_loaded()
+        if not force and self._synced_recently():
+            return self.synced_version
+        with self.sync_lock:
+            if not force and self._synced_recently():
+                return self.synced_version
+            self.synced_at = time.monotonic()
+            since = self.synced_version
+            with RECOMMENDATION_STAGE_SECONDS.time(stage='population_sync'):
+                db_session = ReadSessionLocal()
+                try:
+                    version, user_ids = read_population_changes(db_session, since)
+                    rows = []
+                    for start in range(0, len(user_ids or ()), 500):
+                        chunk = user_ids[start:start + 500]
+                        rows.extend(
+                            db_session.query(User.id, User.username, User.interest_vector)
+                            .filter(User.id.in_(chunk))
+                            .all()
+                        )
+                finally:
+                    db_session.close()
+            if user_ids is None:
+                logging.info(f"Population change log was pruned past version {since}; reloading the index")
+                with self.lock:
+                    self.load()
+                    self.version_at_sync = self.version
+                    return self.synced_version
+            self.apply_rows(rows)
+            with self.lock:
+                self.synced_version = max(self.synced_version, version)
+                self.version_at_sync = self.version
+                return self.synced_version
+
+    def _synced_recently(self):
+        return self.version == self.version_at_sync and time.monotonic() - self.synced_at < self.sync_interval
+
+    def apply_rows(self, rows):
+        """
+        Overwrite users' rows with vectors read from the database, adding the
+        users not seen yet. Updates this worker has not committed yet (see
+        pending_overlay) are kept on top; listeners hear only about rows
+        that actually changed.
+
+        Args:
+        - rows (list): (user_id, username, packed interest vector) tuples.
+
+        Returns:
+        - int: The number of rows that changed.
+        """
+        if not rows:
+            return 0
+        matrix = unpack_interest_matrix([row[2] for row in rows])
+        changed = []
+        with self.lock:
+            for (user_id, username, _), vector in zip(rows, matrix):
+                pending = self.pending_overlay(user_id) if self.pending_overlay else None
+                for field, value in (pending or {}).items():
+                    position = self.field_positions.get(field)
+                    if position is not None:
+                        vector[position] = value or 0.0
+                row = self.id_to_row.get(user_id)
+                if row is not None and np.array_equal(self.vectors[row], vector):
+                    continue
+                row = self._row_for(user_id, username)
+                self.vectors[row] = vector
+                self._remember(user_id, row)
+                changed.append((user_id, vector.copy()))
+            if changed:
+                self._bump()
+        for user_id, vector in changed:
+            self._notify(user_id, vector)
+        return len(changed)
+
+    def _grow(self):
+        # Double the capacity so appends stay amortized O(1)
+        grown = np.zeros((self.vectors.shape[0] * 2, self.vectors.shape[1]), dtype=np.float32)
+        grown[:len(self.user_ids)] = self.vectors[:len(self.user_ids)]
+        self.vectors = grown
+
+    def _row_for(self, user_id, username=None):
+        row = self.id_to_row.get(user_id)
+        if row is None:
+            if len(self.user_ids) == self.vectors.shape[0]:
+                self._grow()
+            row = len(self.user_ids)
+            self.vectors[row] = 0.0
+            self.user_ids.append(user_id)
+            self.id_to_row[user_id] = row
+        if username is not None:
+            self.user_data[user_id] = {'username': username}
+        return row
+
+    def _remember(self, user_id, row):
+        # Called with the lock held; kept only while a store may be remapped
+        if self.store is None:
+            return
+        now = time.time()
+        self.recent_changes.pop(user_id, None)  # Move the user to the end
+        self.recent_changes[user_id] = (now, self.vectors[row].copy())
+        cutoff = now - self.change_ttl
+        while self.recent_changes:
+            oldest, (changed_at, _) = next(iter(self.recent_changes.items()))
+            if changed_at >= cutoff and len(self.recent_changes) <= self.max_recent_changes:
+                break
+            del self.recent_changes[oldest]
+
+    def add_user(self, user_id, username):
+        """
+        Register a new user with an all-zero interest vector.
+        """
+        with self.lock:
+            self._bump()
+            if not self.loaded:
+                return  # The user will be picked up by the initial load
+            row = self._row_for(user_id, username)
+            self._remember(user_id, row)
+            vector = self.vectors[row].copy()
+        self._notify(user_id, vector)
+
+    def update_interests(self, user_id, interests):
+        """
+        Apply interest values to a user's row in place.
+
+        Args:
+        - user_id (int): The ID of the user.
+        - interests (dict): Mapping of interest field to value (None means 0).
+        """
+        with self.lock:
+            self._bump()
+            if not self.loaded:
+                return  # The next load reads the committed values
+            row = self._row_for(user_id)
+            for field, value in interests.items():
+                position = self.field_positions.get(field)
+                if position is not None:
+                    self.vectors[row, position] = value or 0.0
+            self._remember(user_id, row)
+            vector = self.vectors[row].copy()
+        self._notify(user_id, vector)
+
+    def usernames(self, user_ids):
+        """
+        Map the given user IDs to their usernames, fetching the ones not seen yet.
+        """
+        self.ensure_loaded()
+        user_ids = list(user_ids)
+        with self.lock:
+            missing = [user_id for user_id in user_ids if user_id not in self.user_data]
+        if missing:
+            db_session = ReadSessionLocal()
+            try:
+                rows = []
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    rows.extend(db_session.query(User.id, User.username).filter(User.id.in_(chunk)).all())
+            finally:
+                db_session.close()
+            with self.lock:
+                for user_id, username in rows:
+                    self.user_data[user_id] = {'username': username}
+        with self.lock:
+            return {user_id: self.user_data.get(user_id, {}).get('username') for user_id in user_ids}
+
+    def vector(self, user_id):
+        """
+        Return a copy of a user's interest vector, or None for unknown users.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            row = self.id_to_row.get(user_id)
+            return None if row is None else self.vectors[row].copy()
+
+    def matrix_view(self):
+        """
+        Return the matrix itself, without copying it.
+
+        Returns:
+        - vectors (np.ndarray): The live float32 array; its first len(user_ids)
+          rows are users and are updated in place. It is replaced, not
+          resized, when the index grows or reloads.
+        - user_ids (list): List of user IDs corresponding to the rows.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            return self.vectors, list(self.user_ids)
+
+    def snapshot(self):
+        """
+        Return a consistent copy of the matrix and its id mappings.
+
+        Returns:
+        - user_vectors (np.ndarray): float32 array of shape (n_users, n_fields).
+        - user_ids (list): List of user IDs corresponding to the rows.
+        - user_data (dict): Mapping of user IDs to their data (e.g., username)
+          for the users seen so far; see usernames().
+        """
+        self.ensure_loaded()
+        with self.lock:
+            count = len(self.user_ids)
+            return self.vectors[:count].copy(), list(self.user_ids), dict(self.user_data)
+
+
+class CosineSimilarityEngine:
+    """
+    Vectorized top-k cosine similarity over the user index.
+
+    Ranks directly over the index's own matrix: only one inverse L2 norm per
+    row is kept, so the similarities for a target user are a single
+    matrix-vector product scaled by those norms, and the top k are selected
+    with argpartition instead of sorting the whole population. No second copy
+    of the matrix is made, so a memory-mapped matrix stays shared. Changed
+    rows update their norm in place; new users, or a reloaded matrix, trigger
+    a refresh on the next query.
+    """
+
+    def __init__(self, user_index, batch_size=1024, max_block_bytes=32 * 1024 * 1024):
+        self.user_index = user_index
+        self.batch_size = batch_size
+        self.max_block_bytes = max_block_bytes
+        self.source = None  # The index array the view below was taken from
+        self.vectors = None
+        self.inv_norms = None
+        self.user_ids = []
+        self.id_to_row = {}
+        self.stale = True
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _inverse_norms(vectors):
+        norms = np.linalg.norm(vectors, axis=-1)
+        norms[norms == 0] = np.inf  # Zero vectors score 0 against everyone
+        return (1.0 / norms).astype(np.float32)
+
+    def refresh(self):
+        """
+        Re-read the matrix and its row norms from the user index.
+        """
+        with self.lock:
+            vectors, user_ids = self.user_index.matrix_view()
+            self.source = vectors
+            self.vectors = vectors[:len(user_ids)]
+            self.inv_norms = self._inverse_norms(self.vectors)
+            self.user_ids = user_ids
+            self.id_to_row = {user_id: i for i, user_id in enumerate(user_ids)}
+            self.stale = False
+
+    def on_vector_changed(self, user_id, vector):
+        """
+        Listener for the user index: keep the changed row's norm up to date.
+        """
+        with self.lock:
+            row = self.id_to_row.get(user_id)
+            if row is None or self.inv_norms is None:
+                self.stale = True
+            else:
+                self.inv_norms[row] = self._inverse_norms(np.asarray(vector, dtype=np.float32)[None, :])[0]
+
+    def _ensure_fresh(self):
+        self.user_index.ensure_loaded()
+        if self.stale or self.source is not self.user_index.vectors:
+            self.refresh()
+
+    @staticmethod
+    def _select_top_k(scores, top_n):
+        # argpartition finds the k best in O(n); only those k are sorted
+        if top_n < len(scores):
+            candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+        else:
+            candidates = np.arange(len(scores))
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return order[np.isfinite(scores[order])]
+
+    def top_k(self, target_user_id, top_n=5, candidate_ids=None):
+        """
+        Rank users by cosine similarity to the target user.
+
+        Args:
+        - target_user_id (int): The ID of the target user.
+        - top_n (int): Number of similar users to return.
+        - candidate_ids (iterable): Optional subset of user IDs to rank.
+
+        Returns:
+        - List of (user_id, similarity) tuples, most similar first.
+        """
+        with self.lock:
+            self._ensure_fresh()
+            target_row = self.id_to_row.get(target_user_id)
+            if target_row is None or top_n <= 0:
+                return []
+
+            target = self.vectors[target_row] * self.inv_norms[target_row]
+            if candidate_ids is None:
+                rows = None
+                scores = (self.vectors @ target) * self.inv_norms
+                scores[target_row] = -np.inf  # Skip comparing with oneself
+            else:
+                rows = np.array([
+                    self.id_to_row[user_id] for user_id in candidate_ids
+                    if user_id in self.id_to_row and user_id != target_user_id
+                ], dtype=np.intp)
+                scores = (self.vectors[rows] @ target) * self.inv_norms[rows]
+
+            selected = self._select_top_k(scores, top_n)
+            result_rows = selected if rows is None else rows[selected]
+            return [(self.user_ids[row], float(scores[i])) for row, i in zip(result_rows, selected)]
+
+    def _chunk_size(self):
+        # Targets per chunk whose float32 scores against everyone fit in max_block_bytes
+        return max(1, min(self.batch_size, self.max_block_bytes // (4 * max(1, len(self.user_ids)))))
+
+    def top_k_batch(self, target_user_ids, top_n=5):
+        """
+        Rank users for many targets at once, one matrix product per chunk.
+
+        Chunks are sized so a chunk's float32 score matrix (targets x users)
+        stays under max_block_bytes, whatever the population size.
+
+        Args:
+        - target_user_ids (list): IDs of the target users.
+        - top_n (int): Number of similar users to return per target.
+
+        Returns:
+        - dict: Mapping of target user ID to a list of (user_id, similarity) tuples.
+        """
+        results = {}
+        with self.lock:
+            self._ensure_fresh()
+            known = [user_id for user_id in target_user_ids if user_id in self.id_to_row]
+            chunk_size = self._chunk_size()
+            for start in range(0, len(known), chunk_size):
+                chunk = known[start:start + chunk_size]
+                target_rows = np.array([self.id_to_row[user_id] for user_id in chunk], dtype=np.intp)
+                targets = self.vectors[target_rows] * self.inv_norms[target_rows, None]
+                scores = (targets @ self.vectors.T) * self.inv_norms
+                scores[np.arange(len(chunk)), target_rows] = -np.inf
+                for user_id, row_scores in zip(chunk, scores):
+                    selected = self._select_top_k(row_scores, top_n)
+                    results[user_id] = [(self.user_ids[row], float(row_scores[row])) for row in selected]
+        for user_id in target_user_ids:
+            results.setdefault(user_id, [])
+        return results
+
+
+# Shared index and similarity engine used by the request handlers
+user_index = UserVectorIndex()
+similarity_engine = CosineSimilarityEngine(user_index)
+user_index.add_listener(similarity_engine.on_vector_changed)
+attribute_index = InterestAttributeIndex(user_index)
+user_index.add_listener(attribute_index.on_vector_changed)
+
+
+# Function to map the user index from the shared vector file
+def configure_vector_store(path, check_interval=5.0):
+    """
+    Map the user index from a file written by vector_store.py, so all workers
+    share one copy of the matrix, and pick up new versions of the file.
+
+    Args:
+    - path (str): The vector file.
+    - check_interval (float): Seconds between checks for a new version.
+    """
+    user_index.use_store(VectorStore(path, check_interval=check_interval))
+
+
+class DerivedIndex:
+    """
+    An index built from the user index on first use and then kept up to date
+    from its change listener, e.g. the ANN index.
+
+    Building reads a snapshot and can take a while; changes announced during
+    the build are queued and applied to the new index before it is
+    published, so none is lost. invalidate() drops the index, and a build
+    that was running at the time is not published, so the next get()
+    rebuilds from the current matrix. rebuild() builds a replacement in the
+    background while the current index keeps serving.
+
+    Args:
+    - name (str): Used in log messages.
+    - build (callable): build() -> index, from the current user index.
+    - apply (callable): apply(index, user_id, vector) for one changed user.
+    - replay (bool): Also queue the changes made while there is no index and
+      apply them after the next build, for a build that does not load
+      everything from the snapshot (the shards).
+    """
+
+    def __init__(self, name, build, apply, replay=False):
+        self.name = name
+        self.build = build
+        self.apply = apply
+        self.replay = replay
+        self.index = None
+        self.pending = {} if replay else None  # user_id -> vector changed while a build runs
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()  # One build at a time
+
+    def _build(self):
+        # Called with build_lock held
+        with self.lock:
+            if self.pending is None:
+                self.pending = {}
+            generation = self.generation
+        applied = {}
+        try:
+            index = self.build()
+            while True:
+                with self.lock:
+                    changes, self.pending = self.pending, {}
+                    if not changes:
+                        if generation == self.generation:
+                            self.index = index
+                            self.pending = None
+                        elif not self.replay:
+                            self.pending = None
+                        else:
+                            self.pending = applied  # Invalidated meanwhile: keep them for the next build
+                        return index
+                for user_id, vector in changes.items():
+                    self.apply(index, user_id, vector)
+                applied.update(changes)
+        except Exception:
+            with self.lock:
+                self.pending = {**applied, **self.pending} if self.replay else None
+            raise
+
+    def get(self):
+        """
+        Return the index, building it first if needed.
+        """
+        index = self.index
+        if index is not None:
+            return index
+        with self.build_lock:
+            if self.index is not None:
+                return self.index
+            return self._build()
+
+    def rebuild(self):
+        """
+        Build a new index from the current user index in a background thread
+        and swap it in when it is ready; until then the current index keeps
+        serving and receiving changes. Does nothing if there is no index yet.
+        """
+        if self.index is None:
+            return None
+
+        def run():
+            try:
+                with self.build_lock:
+                    self._build()
+            except Exception as e:
+                logging.error(f"Rebuilding the {self.name} failed: {e}")
+
+        thread = threading.Thread(target=run, name=f'{self.name} rebuild', daemon=True)
+        thread.start()
+        return thread
+
+    def invalidate(self):
+        """
+        Drop the index so the next get() rebuilds it.
+        """
+        with self.lock:
+            self.generation += 1
+            self.index = None
+            if self.replay and self.pending is None:
+                self.pending = {}
+
+    def on_vector_changed(self, user_id, vector):
+        """
+        Listener for the user index.
+        """
+        with self.lock:
+            if self.pending is not None:
+                self.pending[user_id] = vector
+            index = self.index
+        if index is not None:
+            self.apply(index, user_id, vector)
+
+
+# Optional approximate nearest-neighbour index, see configure_ann_index()
+ann_config = None
+ann_saved_version = None
+
+
+# Function to enable approximate nearest-neighbour search
+def configure_ann_index(kind='ivf', path=None, target_recall=0.95, **params):
+    """
+    Route find_similar_users_cosine through an ANN index.
+
+    The index is built (or loaded from path) on first use and then kept up to
+    date incrementally from the user index. Its recall@10 against exact
+    search is measured after every build and exported as a metric; unless
+    n_probe is given, an IVF index probes more lists until it reaches
+    target_recall.
+
+    Args:
+    - kind (str): 'ivf' for the inverted-file index, 'brute' for exact search.
+    - path (str): Optional .npz file the index is loaded from and saved to.
+    - target_recall (float): recall@10 the IVF n_probe is tuned to.
+    - params: Extra parameters for the index (e.g., n_lists, n_probe).
+    """
+    global ann_config
+    ann_config = {'kind': kind, 'path': path, 'target_recall': target_recall, 'params': params}
+    ann_search.invalidate()
+
+
+def _report_ann_recall(index, recall):
+    ANN_RECALL.set(round(recall, 4), kind=index.kind)
+    if index.kind == 'ivf':
+        ANN_N_PROBE.set(index.n_probe)
+    logging.info(f"ANN index ({index.kind}) recall@10 is {recall:.3f}"
+                 + (f" with n_probe={index.n_probe}" if index.kind == 'ivf' else ''))
+
+
+def _build_ann_index():
+    global ann_saved_version
+    version = user_index.version
+    user_vectors, user_ids, _ = user_index.snapshot()
+    params = ann_config['params']
+    path = ann_config['path']
+    if path and os.path.exists(path):
+        index = load_index(path, n_probe=params.get('n_probe'))
+        index.refill(user_ids, user_vectors)
+    else:
+        index = create_index(ann_config['kind'], len(INTEREST_FIELDS), **params)
+        index.build(user_ids, user_vectors)
+
+    if 'n_probe' in params:
+        recall = recall_at_k(index, user_ids, user_vectors)
+    else:
+        recall = tune_n_probe(index, user_ids, user_vectors, target=ann_config['target_recall'])
+    _report_ann_recall(index, recall)
+    if path:
+        index.save(path)
+        ann_saved_version = version
+    logging.info(f"ANN index ({index.kind}) ready with {len(index)} users")
+    return index
+
+
+ann_search = DerivedIndex('ANN index', _build_ann_index, lambda index, user_id, vector: index.add(user_id, vector))
+user_index.add_listener(ann_search.on_vector_changed)
+# A remapped vector store changes rows without per-row notifications
+user_index.add_reload_listener(ann_search.rebuild)
+
+
+def get_ann_index():
+    """
+    Return the configured ANN index, building or loading it on first use.
+    """
+    if ann_config is None:
+        return None
+    return ann_search.get()
+
+
+# Function to save the ANN index to its configured path
+def save_ann_index():
+    """
+    Save the ANN index if it was built and changed since it was last saved,
+    so the next start only has to load it and refill its lists.
+    """
+    global ann_saved_version
+    index = ann_search.index
+    if index is None or ann_config is None or not ann_config['path']:
+        return False
+    version = user_index.version
+    if version == ann_saved_version:
+        return False
+    index.save(ann_config['path'])
+    ann_saved_version = version
+    return True
+
+
+# Function to report the recall of the ANN index against exact search
+def ann_recall_at_k(k=10, sample_size=100):
+    """
+    Returns:
+    - float: recall@k of the configured ANN index, or None if it is disabled.
+    """
+    index = get_ann_index()
+    if index is None:
+        return None
+    user_vectors, user_ids, _ = user_index.snapshot()
+    recall = recall_at_k(index, user_ids, user_vectors, k=k, sample_size=sample_size)
+    if k == 10:
+        _report_ann_recall(index, recall)
+    return recall
+
+
+# Function to save the ANN index and re-measure its recall periodically
+def start_ann_maintenance(interval=300.0):
+    """
+    Start a daemon thread that saves the ANN index every interval seconds
+    while it changes and re-measures its recall, and save it once more at exit.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            if ann_search.index is None:
+                continue
+            try:
+                save_ann_index()
+                ann_recall_at_k()
+            except Exception as e:
+                logging.error(f"ANN index maintenance failed: {e}")
+
+    atexit.register(save_ann_index)
+    thread = threading.Thread(target=run, name='ann-maintenance', daemon=True)
+    thread.start()
+    return thread
+
+
+# Optional sharded search, see configure_shards()
+shard_config = None
+
+
+# Function to enable sharded scatter-gather similarity search
+def configure_shards(spec, authkey=None, timeout=0.25, write_timeout=1.0, local_port=7101):
+    """
+    Route find_similar_users_cosine through shard servers.
+
+    The shards are started (for local:N) and loaded on first use, then kept
+    up to date from the user index like the ANN index; writes are queued and
+    sent in the background. Only shards that hold no users yet are loaded
+    from this worker's index: the others already have the population, kept
+    current by every worker's writes.
+
+    Args:
+    - spec (str): "local:N" for N shard servers on this host, shared by all
+      workers, or "host:port,host:port" for shard servers started with
+      sharding.py.
+    - authkey (bytes): Shared secret; required for remote shards.
+    - timeout (float): Seconds a query waits for shards before merging
+      whatever has arrived.
+    - write_timeout (float): Seconds a queued write waits for its shard.
+    - local_port (int): Port of the first local:N shard.
+    """
+    global shard_config
+    if not spec.startswith('local:') and not authkey:
+        raise ValueError('Remote shards need an authkey (SHARD_AUTHKEY)')
+    if shard_config is None:
+        user_index.add_listener(shard_search.on_vector_changed)
+        user_index.add_reload_listener(_reload_shards)
+    shard_config = {
+        'spec': spec, 'authkey': authkey, 'timeout': timeout, 'write_timeout': write_timeout,
+        'local_port': local_port,
+    }
+    shard_search.invalidate()
+
+
+def _build_shards():
+    spec = shard_config['spec']
+    authkey = shard_config['authkey']
+    if spec.startswith('local:'):
+        addresses, authkey, _ = ensure_local_shards(
+            int(spec.split(':', 1)[1]), authkey, base_port=shard_config['local_port']
+        )
+    else:
+        addresses = parse_addresses(spec)
+    coordinator = ShardCoordinator(
+        addresses, authkey, timeout=shard_config['timeout'], write_timeout=shard_config['write_timeout']
+    )
+    user_vectors, user_ids, _ = user_index.snapshot()
+    loaded = coordinator.load_missing(user_ids, user_vectors)
+    logging.info(f"Sharded search ready on {len(addresses)} shards; loaded {loaded} users into empty shards")
+    return coordinator
+
+
+# Changes are queued from configure_shards() on, so those made before the
+# first search still reach shards that another worker loaded
+shard_search = DerivedIndex(
+    'sharded search', _build_shards, lambda coordinator, user_id, vector: coordinator.upsert(user_id, vector),
+    replay=True,
+)
+
+
+def _reload_shards():
+    # Shards get every worker's writes as they happen, so after a remap only
+    # shards that came back empty are refilled; reloading the rest from the
+    # file could put back vectors older than what other workers wrote since
+    coordinator = shard_search.index
+    if coordinator is None:
+        return None
+
+    def run():
+        try:
+            user_vectors, user_ids, _ = user_index.snapshot()
+            loaded = coordinator.load_missing(user_ids, user_vectors)
+            if loaded:
+                logging.info(f"Reloaded {loaded} users into empty shards")
+        except Exception as e:
+            logging.error(f"Could not refill empty shards: {e}")
+
+    thread = threading.Thread(target=run, name='shard-reload', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_shard_coordinator():
+    """
+    Return the configured shard coordinator, starting and loading the shards on first use.
+    """
+    if shard_config is None:
+        return None
+    return shard_search.get()
+
 
 # Function to create an embedding from a user's interests
 def create_user_embedding(user):
@@ -16,58 +932,27 @@ def create_user_embedding(user):
     Returns:
     numpy.ndarray: The vector embedding of the user.
     """
-    # List of interest fields
-    interest_fields = [
-        'sci_fi_movies', 'cooking', 'hiking', 'travel', 'reading', 'sports',
-        'music', 'photography', 'gardening', 'video_games', 'board_games',
-        'diy_projects', 'volunteering', 'movies', 'podcasts', 'social_media',
-        'pets', 'workout', 'meditation', 'travel_adventure',
-        'music_instruments', 'arts_crafts'
-    ]
-
-    # Retrieve interest scores, defaulting to 0 if None
-    interest_scores = [getattr(user, field) or 0 for field in interest_fields]
-
-    # Convert to numpy array
-    embedding = np.array(interest_scores, dtype=float)
-
-    return embedding
+    # Decode the packed interest scores, defaulting to 0 if unset
+    return unpack_interest_matrix([user.interest_vector])[0].astype(float)
 
 # Function to get user vectors for clustering
 def get_user_vectors():
     """
     Retrieve all users' interest vectors and related data.
 
+    The vectors come from the in-memory user index, which is loaded from the
+    database on first use and kept current by the write paths.
+
     Returns:
     - user_vectors (np.ndarray): Array of user interest vectors.
     - user_ids (list): List of user IDs corresponding to the vectors.
     - user_data (dict): Mapping of user IDs to their data (e.g., username).
     - interest_fields (list): List of interest fields used.
     """
-    db_session = SessionLocal()
-    users = db_session.query(User).all()
-    db_session.close()
-
-    # List of interest fields
-    interest_fields = [
-        'sci_fi_movies', 'cooking', 'hiking', 'travel', 'reading', 'sports',
-        'music', 'photography', 'gardening', 'video_games', 'board_games',
-        'diy_projects', 'volunteering', 'movies', 'podcasts', 'social_media',
-        'pets', 'workout', 'meditation', 'travel_adventure',
-        'music_instruments', 'arts_crafts'
-    ]
-
-    user_vectors = []
-    user_ids = []
-    user_data = {}  # To map user_id to username and other data if needed
-
-    for user in users:
-        interest_scores = [getattr(user, field) or 0 for field in interest_fields]
-        user_vectors.append(interest_scores)
-        user_ids.append(user.id)
-        user_data[user.id] = {'username': user.username}
-
-    return np.array(user_vectors), user_ids, user_data, interest_fields
+    user_vectors, user_ids, _ = user_index.snapshot()
+    usernames = user_index.usernames(user_ids)
+    user_data = {user_id: {'username': usernames[user_id]} for user_id in user_ids}
+    return user_vectors, user_ids, user_data, list(INTEREST_FIELDS)
 
 # Function to find similar users using K-Means clustering
 def find_similar_users_clustering(target_user_id, user_clusters):
@@ -113,7 +998,7 @@ def build_vector_db():
 
     db_session.close()
 
-# Optional function to find similar users using cosine similarity
+# Function to find similar users using cosine similarity
 def find_similar_users_cosine(target_user_id, top_n=5):
     """
     Finds the top N most similar users to the target user using cosine similarity.
@@ -125,49 +1010,82 @@ def find_similar_users_cosine(target_user_id, top_n=5):
     Returns:
     - List of dictionaries containing user IDs and usernames of the most similar users.
     """
-    db_session = SessionLocal()
-    users = db_session.query(User).all()
-    db_session.close()
+    try:
+        coordinator = get_shard_coordinator()
+    except Exception as e:
+        logging.error(f"Sharded search is unavailable, ranking locally: {e}")
+        coordinator = None
+    index = get_ann_index() if coordinator is None else None
+    if coordinator is not None:
+        target_vector = user_index.vector(target_user_id)
+        if target_vector is None:
+            return []
+        ranked = coordinator.search(target_vector, top_n, exclude=[target_user_id])
+    elif index is None:
+        ranked = similarity_engine.top_k(target_user_id, top_n)
+    else:
+        target_vector = user_index.vector(target_user_id)
+        if target_vector is None:
+            return []
+        matches = index.search(target_vector, top_n + 1)
+        ranked = [(user_id, similarity) for user_id, similarity in matches if user_id != target_user_id][:top_n]
+    usernames = user_index.usernames([user_id for user_id, _ in ranked])
 
-    # Create embeddings
-    user_embeddings = {}
-    interest_fields = [
-        'sci_fi_movies', 'cooking', 'hiking', 'travel', 'reading', 'sports',
-        'music', 'photography', 'gardening', 'video_games', 'board_games',
-        'diy_projects', 'volunteering', 'movies', 'podcasts', 'social_media',
-        'pets', 'workout', 'meditation', 'travel_adventure',
-        'music_instruments', 'arts_crafts'
+    return [
+        {'user_id': user_id, 'username': usernames[user_id], 'similarity': similarity}
+        for user_id, similarity in ranked
     ]
 
-    target_embedding = None
-    for user in users:
-        embedding = np.array([getattr(user, field) or 0 for field in interest_fields], dtype=float)
-        user_embeddings[user.id] = {'embedding': embedding, 'username': user.username}
-        if user.id == target_user_id:
-            target_embedding = embedding
 
-    if target_embedding is None:
-        return []
+# Function to find similar users among those matching interest predicates
+def find_similar_users_filtered(target_user_id, predicates, top_n=5):
+    """
+    Finds the top N most similar users among those whose interest scores
+    satisfy every predicate, e.g. {'hiking': (7, None)} for hiking >= 7.
 
-    similarities = []
-    for user_id, data in user_embeddings.items():
-        if user_id == target_user_id:
-            continue  # Skip comparing with oneself
+    The predicates are resolved to candidates with the attribute indexes
+    first, so cosine similarity is only computed for those candidates.
 
-        similarity = cosine_similarity(
-            target_embedding.reshape(1, -1),
-            data['embedding'].reshape(1, -1)
-        )[0][0]
-        similarities.append({
-            'user_id': user_id,
-            'username': data['username'],
-            'similarity': similarity
-        })
+    Args:
+    - target_user_id (int): The ID of the target user.
+    - predicates (dict): Mapping of interest field to inclusive (low, high) bounds.
+    - top_n (int): Number of similar users to return.
 
-    # Sort by similarity in descending order
-    similarities.sort(key=lambda x: x['similarity'], reverse=True)
+    Returns:
+    - List of dictionaries as returned by find_similar_users_cosine.
+    """
+    with RECOMMENDATION_STAGE_SECONDS.time(stage='attribute_filter'):
+        candidate_ids = attribute_index.candidate_ids(predicates)
+    with RECOMMENDATION_STAGE_SECONDS.time(stage='rank'):
+        ranked = similarity_engine.top_k(target_user_id, top_n, candidate_ids=candidate_ids)
+    usernames = user_index.usernames([user_id for user_id, _ in ranked])
+
+    return [
+        {'user_id': user_id, 'username': usernames[user_id], 'similarity': similarity}
+        for user_id, similarity in ranked
+    ]
+
+
+# Function to find similar users for many users at once (e.g., nightly jobs)
+def find_similar_users_cosine_batch(target_user_ids, top_n=5):
+    """
+    Finds the top N most similar users for each of the target users.
+
+    Args:
+    - target_user_ids (list): IDs of the target users.
+    - top_n (int): Number of similar users to return per target.
 
-    # Return the top N similar users
-    similar_users = similarities[:top_n]
+    Returns:
+    - dict: Mapping of target user ID to a list of dictionaries as returned
+      by find_similar_users_cosine.
+    """
+    ranked = similarity_engine.top_k_batch(target_user_ids, top_n)
+    usernames = user_index.usernames({user_id for matches in ranked.values() for user_id, _ in matches})
 
-    return similar_users
+    return {
+        target_user_id: [
+            {'user_id': user_id, 'username': usernames[user_id], 'similarity': similarity}
+            for user_id, similarity in matches
+        ]
+        for target_user_id, matches in ranked.items()
+    }
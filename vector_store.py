@@ -0,0 +1,286 @@
+# vector_store.py
+"""
+Memory-mapped interest vector file shared by every worker.
+
+A single updater writes the whole population to one file:
+
+    python vector_store.py --path ./.vectors/users.vec            # once
+    python vector_store.py --path ./.vectors/users.vec --every 300  # keep refreshing
+
+Workers started with VECTOR_STORE_PATH map the file copy-on-write instead of
+loading every user from the database, so the float32 matrix lives once in
+the page cache no matter how many workers there are; a row is only copied
+into a worker when that worker changes it. A new version is written to a
+temporary file and renamed over the old one, and workers remap it on their
+next access after it appears, without a restart.
+
+Layout (little-endian, sections page-aligned):
+
+    header   magic, dtype, dim, count, capacity, created_at, population version
+    ids      int64[capacity]
+    scales   float32[capacity]          (int8 files only)
+    matrix   float32 or int8 [capacity, dim]
+
+Rows past count are headroom for users registered after the file was
+written; they are never written to disk, so they cost nothing until used.
+int8 files quantize each row with its own scale: they are a quarter of the
+size, but each worker holds a dequantized float32 copy.
+"""
+
+import argparse
+import logging
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b'IWVECS02'
+HEADER = struct.Struct('<8sIIQQdQ')  # magic, dtype code, dim, count, capacity, created_at, population version
+LEGACY_HEADERS = {b'IWVECS01': struct.Struct('<8sIIQQd')}  # Without the population version
+PAGE = 4096
+DTYPES = {0: np.float32, 1: np.int8}
+
+MappedVectors = namedtuple('MappedVectors', ['ids', 'vectors', 'count', 'created_at', 'population_version'])
+
+
+def _align(offset):
+    return (offset + PAGE - 1) // PAGE * PAGE
+
+
+def _layout(dtype_code, dim, capacity):
+    ids_offset = PAGE
+    scales_offset = _align(ids_offset + capacity * 8)
+    matrix_offset = _align(scales_offset + capacity * 4) if dtype_code == 1 else scales_offset
+    size = matrix_offset + capacity * dim * np.dtype(DTYPES[dtype_code]).itemsize
+    return ids_offset, scales_offset, matrix_offset, size
+
+
+# Function to quantize rows to int8 with one scale per row
+def quantize_rows(vectors):
+    """
+    Returns:
+    - quantized (np.ndarray): int8 rows.
+    - scales (np.ndarray): float32 scale per row; row ~= quantized * scale.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+class VectorStoreWriter:
+    """
+    Writes a vector file in chunks to a temporary path and publishes it
+    atomically on close(); readers see either the old or the new file.
+    """
+
+    def __init__(self, path, dim, capacity, quantize=False, created_at=None, population_version=0):
+        self.path = path
+        self.dim = dim
+        self.capacity = capacity
+        self.dtype_code = 1 if quantize else 0
+        self.created_at = time.time() if created_at is None else created_at
+        self.population_version = population_version
+        self.count = 0
+        self.ids_offset, self.scales_offset, self.matrix_offset, size = _layout(self.dtype_code, dim, capacity)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.tmp_path = f"{path}.tmp{os.getpid()}"
+        self.file = open(self.tmp_path, 'wb')
+        self.file.truncate(size)  # Sparse: unwritten headroom takes no disk space
+
+    def append(self, user_ids, vectors):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(user_ids), self.dim)
+        if self.count + len(user_ids) > self.capacity:
+            raise ValueError(f"Vector store capacity {self.capacity} exceeded")
+
+        self.file.seek(self.ids_offset + self.count * 8)
+        self.file.write(user_ids.tobytes())
+        if self.dtype_code == 1:
+            vectors, scales = quantize_rows(vectors)
+            self.file.seek(self.scales_offset + self.count * 4)
+            self.file.write(scales.tobytes())
+        self.file.seek(self.matrix_offset + self.count * self.dim * vectors.itemsize)
+        self.file.write(np.ascontiguousarray(vectors).tobytes())
+        self.count += len(user_ids)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(HEADER.pack(
+            MAGIC, self.dtype_code, self.dim, self.count, self.capacity, self.created_at, self.population_version
+        ))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+# Function to write a whole population to a vector file at once
+def write_vector_store(path, user_ids, vectors, quantize=False, headroom=0.1, created_at=None, population_version=0):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    capacity = len(user_ids) + max(1024, int(len(user_ids) * headroom))
+    writer = VectorStoreWriter(path, vectors.shape[1], capacity, quantize=quantize, created_at=created_at,
+                               population_version=population_version)
+    try:
+        writer.append(user_ids, vectors)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+
+class VectorStore:
+    """
+    Read side of a vector file: maps the current version and notices new ones.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.identity = None  # (inode, mtime) of the mapped version
+        self.checked_at = 0.0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _identity(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def open(self):
+        """
+        Map the current version of the file.
+
+        Returns:
+        - MappedVectors: ids (int64, count rows), vectors (float32, capacity
+          rows, copy-on-write), count, created_at and the population version
+          the file was read at (None for files written before it was kept).
+        """
+        identity = self._identity()
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER.size)
+        magic = header[:len(MAGIC)]
+        if magic == MAGIC:
+            _, dtype_code, dim, count, capacity, created_at, population_version = HEADER.unpack(header)
+        elif magic in LEGACY_HEADERS:
+            legacy = LEGACY_HEADERS[magic]
+            _, dtype_code, dim, count, capacity, created_at = legacy.unpack(header[:legacy.size])
+            population_version = None
+        else:
+            dtype_code = None
+        if dtype_code not in DTYPES:
+            raise ValueError(f"{self.path} is not a vector store file")
+        ids_offset, scales_offset, matrix_offset, _ = _layout(dtype_code, dim, capacity)
+
+        ids = np.memmap(self.path, dtype=np.int64, mode='r', offset=ids_offset, shape=(capacity,))[:count]
+        if dtype_code == 0:
+            # Copy-on-write: pages stay shared until this process writes a row
+            vectors = np.memmap(self.path, dtype=np.float32, mode='c', offset=matrix_offset, shape=(capacity, dim))
+        else:
+            quantized = np.memmap(self.path, dtype=np.int8, mode='r', offset=matrix_offset, shape=(capacity, dim))
+            scales = np.memmap(self.path, dtype=np.float32, mode='r', offset=scales_offset, shape=(capacity,))
+            vectors = np.zeros((capacity, dim), dtype=np.float32)
+            vectors[:count] = quantized[:count] * scales[:count, None]
+
+        self.identity = identity
+        self.checked_at = time.monotonic()
+        return MappedVectors(ids, vectors, count, created_at, population_version)
+
+    def changed(self):
+        """
+        True if a newer version was published since open(), or the first one
+        since the store was found missing; checks the file at most every
+        check_interval seconds.
+        """
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = now
+        try:
+            return self._identity() != self.identity
+        except FileNotFoundError:
+            return False
+
+
+# Function to export every user's interest vector from the database
+def build_from_database(path, quantize=False, headroom=0.1, chunk_size=50000):
+    """
+    Stream all users' vectors into a new version of the file.
+
+    Returns:
+    - int: The number of users written.
+    """
+    from sqlalchemy import func
+
+    from database import ReadSessionLocal, read_population_version
+    from interests import INTEREST_DIM, unpack_interest_matrix
+    from models import User
+
+    created_at = time.time()
+    db_session = ReadSessionLocal()
+    try:
+        # Workers apply the changes logged after this version on top of the file
+        population_version, _ = read_population_version(db_session)
+        max_id, count = db_session.query(func.max(User.id), func.count(User.id)).one()
+        capacity = count + max(1024, int(count * headroom))
+        writer = VectorStoreWriter(path, INTEREST_DIM, capacity, quantize=quantize, created_at=created_at,
+                                   population_version=population_version)
+        try:
+            # Users registered after the count are left to the next version
+            rows = (
+                db_session.query(User.id, User.interest_vector)
+                .filter(User.id <= (max_id or 0))
+                .order_by(User.id)
+                .yield_per(chunk_size)
+            )
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    writer.append([r[0] for r in chunk], unpack_interest_matrix([r[1] for r in chunk]))
+                    chunk = []
+            if chunk:
+                writer.append([r[0] for r in chunk], unpack_interest_matrix([r[1] for r in chunk]))
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.count
+    finally:
+        db_session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write the shared memory-mapped vector file.')
+    parser.add_argument('--path', default=os.getenv('VECTOR_STORE_PATH', './.vectors/users.vec'))
+    parser.add_argument('--int8', action='store_true', help='quantize rows to int8')
+    parser.add_argument('--headroom', type=float, default=0.1, help='spare rows for new users, as a share')
+    parser.add_argument('--every', type=float, help='rewrite every N seconds instead of once')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    while True:
+        start = time.perf_counter()
+        count = build_from_database(args.path, quantize=args.int8, headroom=args.headroom)
+        logging.info(f"Wrote {count} users to {args.path} in {time.perf_counter() - start:.1f}s")
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+# write_behind.py
+
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+from sqlalchemy import update
+
+from database import announce_population_change, begin_write
+from interests import INTEREST_POSITIONS, unpack_interests
+from metrics import WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_UPDATES
+from models import User
+
+# interest-updates-<owner>-<sequence>.jsonl, where owner is <pid>-<random token>;
+# segments from before owners were named (no owner) are always orphans
+SEGMENT_PATTERN = re.compile(r'^interest-updates-(?:(\d+-[0-9a-f]+)-)?(\d+)\.jsonl$')
+
+
+# Function to write partial interest updates for many users in one transaction
+def write_interest_updates(session_factory, batch):
+    """
+    Merge interest values into the users' stored vectors and write them with
+    a single bulk UPDATE by primary key.
+
+    Args:
+    - session_factory (callable): Creates the database session.
+    - batch (dict): Mapping of user ID to {interest: value}; None unsets.
+
+    Returns:
+    - set: IDs of the users that exist and were updated.
+    """
+    db_session = session_factory()
+    try:
+        # Lock the rows until commit, so a concurrent merge into the same user
+        # (another worker's flush, a batch update) waits instead of being
+        # overwritten; locked in id order so two batches cannot deadlock
+        begin_write(db_session)
+        user_ids = sorted(batch)
+        rows = []
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows.extend(
+                db_session.query(User.id, User.interest_vector)
+                .filter(User.id.in_(chunk))
+                .order_by(User.id)
+                .with_for_update()
+                .all()
+            )
+        params = []
+        for user_id, blob in rows:
+            vector = unpack_interests(blob).copy()
+            for interest, value in batch[user_id].items():
+                vector[INTEREST_POSITIONS[interest]] = np.nan if value is None else value
+            params.append({'id': user_id, 'interest_vector': vector.tobytes()})
+        if params:
+            db_session.execute(update(User), params)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+    if rows:
+        announce_population_change([user_id for user_id, _ in rows], session_factory)
+    return {user_id for user_id, _ in rows}
+
+
+class InterestWriteBuffer:
+    """
+    Write-behind buffer for interest updates made outside the profile form.
+
+    record() appends the update to a journal segment on disk and coalesces it
+    in memory (the last value per user and interest wins), then returns. A
+    background thread writes all pending users in one transaction every
+    flush_interval seconds, or sooner once max_pending users are waiting, and
+    deletes the journal segments it covered. close() flushes at shutdown.
+
+    Several workers can share one journal directory. Each buffer names its
+    segments after an owner id (pid plus a random token) and holds an
+    exclusive lock on owner-<id>.lock for as long as it runs. start() takes
+    the directory's replay.lock and claims only the segments whose owner is
+    gone (its lock file is missing or no longer locked), renaming them to its
+    own id before replaying them, so a live worker's segments are never
+    touched and an orphan is replayed once.
+
+    Pending updates live in the worker that recorded them: flush() only
+    writes this process's buffer, not updates other workers still hold.
+    """
+
+    def __init__(self, session_factory, journal_dir, flush_interval=1.0, max_pending=100, fsync=True):
+        self.session_factory = session_factory
+        self.journal_dir = journal_dir
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.fsync = fsync
+
+        self.pending = {}  # user_id -> {interest: value}
+        self.writing = False  # A flush has taken pending and not committed yet
+        self.segments = []  # journal segments covering self.pending
+        self.journal = None
+        self.sequence = 0
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self.owner_lock = None  # Open, exclusively locked owner-<id>.lock
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def _segment_path(self, sequence):
+        return os.path.join(self.journal_dir, f"interest-updates-{self.owner}-{sequence:010d}.jsonl")
+
+    def _owner_lock_path(self, owner):
+        return os.path.join(self.journal_dir, f"owner-{owner}.lock")
+
+    def _owner_is_gone(self, owner):
+        # Called with replay.lock held; a live owner keeps its lock file locked
+        path = self._owner_lock_path(owner)
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
+        os.remove(path)
+        return True
+
+    def _claim_orphans(self):
+        # Called with replay.lock held: rename dead owners' segments to ours
+        orphans = []
+        gone = {}
+        for path in glob.glob(os.path.join(self.journal_dir, 'interest-updates-*.jsonl')):
+            match = SEGMENT_PATTERN.match(os.path.basename(path))
+            if match is None or match.group(1) == self.owner:
+                continue
+            owner = match.group(1) or ''
+            if owner not in gone:
+                gone[owner] = not owner or self._owner_is_gone(owner)
+            if gone[owner]:
+                orphans.append((os.path.getmtime(path), owner, int(match.group(2)), path))
+
+        claimed = []
+        for _, _, _, path in sorted(orphans):
+            self.sequence += 1
+            claimed_path = self._segment_path(self.sequence)
+            os.rename(path, claimed_path)
+            claimed.append(claimed_path)
+
+        # Lock files of owners that exited cleanly, with nothing left to replay
+        for path in glob.glob(os.path.join(self.journal_dir, 'owner-*.lock')):
+            owner = os.path.basename(path)[len('owner-'):-len('.lock')]
+            if owner != self.owner and owner not in gone:
+                self._owner_is_gone(owner)
+        return claimed
+
+    def _open_segment(self):
+        self.sequence += 1
+        path = self._segment_path(self.sequence)
+        self.journal = open(path, 'a', encoding='utf-8')
+        self.segments.append(path)
+
+    def start(self):
+        """
+        Replay journal segments left by workers that are gone and start the flush thread.
+        """
+        if self.worker is not None:
+            return
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.owner_lock = open(self._owner_lock_path(self.owner), 'a')
+        fcntl.flock(self.owner_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with open(os.path.join(self.journal_dir, 'replay.lock'), 'a') as replay_lock:
+            fcntl.flock(replay_lock.fileno(), fcntl.LOCK_EX)
+            with self.lock:
+                for path in self._claim_orphans():
+                    self._replay(path)
+                    self.segments.append(path)
+                self._open_segment()
+        if self.pending:
+            logging.info(f"Replaying journaled interest updates for {len(self.pending)} users")
+            self.flush_requested.set()
+
+        self.worker = threading.Thread(target=self._run, name='interest-write-behind', daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    def _replay(self, path):
+        with open(path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    continue
+                self.pending.setdefault(entry['user_id'], {})[entry['interest']] = entry['value']
+
+    def record(self, user_id, interest, value):
+        """
+        Queue an interest update; it is durable once this returns.
+
+        Args:
+        - user_id (int): The ID of the user.
+        - interest (str): The interest field.
+        - value (float): The new interest score.
+        """
+        line = json.dumps({'user_id': user_id, 'interest': interest, 'value': value}) + '\n'
+        with self.lock:
+            if self.journal is None:
+                raise RuntimeError('InterestWriteBuffer.start() has not been called')
+            self.journal.write(line)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.pending.setdefault(user_id, {})[interest] = value
+            if len(self.pending) >= self.max_pending:
+                self.flush_requested.set()
+
+    def has_pending(self):
+        """
+        True while updates recorded by this process are not committed yet.
+        """
+        with self.lock:
+            return bool(self.pending) or self.writing
+
+    def pending_for(self, user_id):
+        """
+        Return the updates not yet written for a user, as {interest: value}.
+        """
+        with self.lock:
+            return dict(self.pending.get(user_id, {}))
+
+    def flush(self):
+        """
+        Write every update pending in this process in one transaction.
+
+        Returns:
+        - int: The number of users written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                batch, self.pending = self.pending, {}
+                self.writing = True
+                segments, self.segments = self.segments, []
+                if self.journal is not None:
+                    self.journal.close()
+                    self._open_segment()
+
+            start = time.perf_counter()
+            try:
+                self._write(batch)
+            except Exception:
+                # Put the batch back under any newer updates and keep its journal
+                with self.lock:
+                    for user_id, updates in batch.items():
+                        self.pending[user_id] = {**updates, **self.pending.get(user_id, {})}
+                    self.segments = segments + self.segments
+                raise
+            finally:
+                with self.lock:
+                    self.writing = False
+            WRITE_BEHIND_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            WRITE_BEHIND_UPDATES.inc(sum(len(updates) for updates in batch.values()))
+
+            self._remove_segments(segments)
+            return len(batch)
+
+    def _write(self, batch):
+        write_interest_updates(self.session_factory, batch)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.flush_requested.wait(timeout=self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Flushing interest updates failed: {e}")
+
+    def close(self):
+        """
+        Stop the flush thread and write whatever is still pending.
+        """
+        self.stopped.set()
+        self.flush_requested.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error(f"Final flush of interest updates failed; they stay journaled: {e}")
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if not self.pending:
+                self._remove_segments(self.segments)
+                self.segments = []
+            if self.owner_lock is not None:
+                if not self.segments:
+                    self._remove_segments([self.owner_lock.name])
+                self.owner_lock.close()  # Releases the lock; leftover segments become orphans
+                self.owner_lock = None
+
+    def _remove_segments(self, segments):
+        for path in segments:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass